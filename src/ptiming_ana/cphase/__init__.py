@@ -1,5 +1,14 @@
 from .utils import add_mjd, dl2time_totim, merge_dl2_pulsar, model_fromephem
-from .pulsarphase_cal import DL2_calphase, DL3_calphase, fermi_calphase
+from .pulsarphase_cal import (
+    DL2_calphase,
+    DL3_calphase,
+    fermi_calphase,
+    calphase_events,
+    calphase_observations,
+)
+from .phase_predictor import PhasePredictor, get_phase_predictor
+from .observatory_cache import ObservatoryCache, get_observatory_cache
+from .profiling import set_profiling, aggregate_profiles
 
 
 __all__ = [
@@ -10,4 +19,12 @@ __all__ = [
     "DL2_calphase",
     "merge_dl2_pulsar",
     "fermi_calphase",
+    "calphase_events",
+    "calphase_observations",
+    "PhasePredictor",
+    "get_phase_predictor",
+    "ObservatoryCache",
+    "get_observatory_cache",
+    "set_profiling",
+    "aggregate_profiles",
 ]
@@ -28,9 +28,40 @@ Parameters:
 --interpolation: boolean
   Set to True if want to use the interpolation method (faster but loses some precision)
 
+--create-tim: boolean
+  Set to True to read the TOAs with PINT through a temporary .tim file instead of building them in memory from the arrays of times (slower, for debugging)
+
 --number-interpolation: int
   Number of events between two interpolation points.
 
+--interpolation-tolerance: float
+  Maximum phase error (in cycles) of the interpolation. If given, the interpolation method is used with nodes placed adaptively in time (--number-interpolation is not used)
+
+--chunk-size: int
+  Number of events per chunk. If given, the phases are computed and written chunk by chunk to keep the memory bounded.
+
+--ephem-cache: string
+  Directory where the timing models built from a .gro ephemeris are cached (reused between runs)
+
+--obs-cache: string
+  Use the observatory cache: clock corrections, TDBs and observatory/solar system positions are computed once per night and interpolated for every file. If a directory is given, the caches are stored there (reused between runs)
+
+--jobs: int
+  Number of files processed in parallel (only if --dir is given)
+
+--predictor: boolean
+  Set to True if want to use a polynomial phase predictor built for the whole night (faster, precision given by the residuals of the fit)
+
+--sidecar: boolean
+  Write the phases to a Parquet file next to each DL2 file ({name}.phase.parquet) instead of adding the 'phase_info' table to the DL2 file
+
+--audit: int
+  Check the phases given by the interpolation or the phase predictor against the exact PINT phases of a stratified random subsample of events (100 by default, or the number given).
+  The maximum and RMS phase errors are saved as metadata ('phase_audit') of the 'phase_info' table
+
+--profile: boolean
+  Save the wall time of each stage, the throughput (events/s) and the peak memory in a JSON file next to each output ({output}.timing.json). With --dir, the profiles of all the files are aggregated in profile_summary.json
+
 
 Usage:
 ------------------------
@@ -63,8 +94,14 @@ python add_DL2_phase_table.py
 import pandas as pd
 import argparse
 import os
-from ptiming_ana.cphase.pulsarphase_cal import DL2_calphase
-from ptiming_ana.cphase.utils import add_source_info_dl2
+from ptiming_ana.cphase.pulsarphase_cal import DL2_calphase, DL2_calphase_batch
+from ptiming_ana.cphase.utils import (
+    add_source_info_dl2,
+    get_phase_sidecar_name,
+    set_model_cache_dir,
+    set_observatory_cache,
+)
+from ptiming_ana.cphase.profiling import set_profiling, aggregate_profiles
 
 
 def main():
@@ -128,6 +165,13 @@ def main():
         dest="interpolation",
         help="Set to True if want to use the interpolation method (faster but loses some precision)",
     )
+    parser.add_argument(
+        "--create-tim",
+        "-tim",
+        action="store_true",
+        dest="create_tim",
+        help="Set True to read the TOAs through a temporary .tim file instead of building them in memory (for debugging)",
+    )
     parser.add_argument(
         "--number-interpolation",
         "-ninterp",
@@ -137,6 +181,82 @@ def main():
         default=1000,
         help="Number of events between two interpolation points",
     )
+    parser.add_argument(
+        "--interpolation-tolerance",
+        "-tol",
+        action="store",
+        type=float,
+        dest="interp_tolerance",
+        default=None,
+        help="Maximum phase error (in cycles) of the interpolation, placing the interpolation points adaptively",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        "-chunk",
+        action="store",
+        type=int,
+        dest="chunk_size",
+        default=None,
+        help="Number of events per chunk (process the file in chunks to bound the memory)",
+    )
+    parser.add_argument(
+        "--ephem-cache",
+        "-ephemcache",
+        action="store",
+        type=str,
+        dest="ephem_cache",
+        default=None,
+        help="Directory where to cache the timing models created from a .gro ephemeris",
+    )
+    parser.add_argument(
+        "--obs-cache",
+        "-obscache",
+        action="store",
+        type=str,
+        nargs="?",
+        const="",
+        dest="obs_cache",
+        default=None,
+        help="Use the observatory cache (computed once per night), optionally stored in the given directory",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="Number of files processed in parallel (only if --dir is given)",
+    )
+    parser.add_argument(
+        "--predictor",
+        "-pred",
+        action="store_true",
+        dest="predictor",
+        help="Set to True if want to use a polynomial phase predictor built for the whole night",
+    )
+    parser.add_argument(
+        "--sidecar",
+        action="store_true",
+        dest="sidecar",
+        help="Write the phases to a Parquet file next to each DL2 file instead of modifying the DL2 file",
+    )
+    parser.add_argument(
+        "--audit",
+        action="store",
+        type=int,
+        nargs="?",
+        const=100,
+        dest="n_audit",
+        default=None,
+        help="Check the interpolated or predicted phases of a subsample of events (100 by default) against the exact phases",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        dest="profile",
+        help="Save the timing of each stage and the peak memory next to each output",
+    )
 
     args = parser.parse_args()
 
@@ -145,8 +265,18 @@ def main():
     in_file = args.in_file
     run = args.run
     include_theta = args.include_theta
-    interpolation = args.interpolation
+    interpolation = args.interpolation or (args.interp_tolerance is not None)
     ninterp = args.ninterp
+    chunk_size = args.chunk_size
+
+    if args.ephem_cache is not None:
+        set_model_cache_dir(args.ephem_cache)
+
+    if args.obs_cache is not None:
+        set_observatory_cache(True, args.obs_cache or None)
+
+    if args.profile:
+        set_profiling(True)
 
     pd.set_option("display.precision", 10)
     if ephem is None:
@@ -162,20 +292,56 @@ def main():
         for x in os.listdir(args.directory):
             rel_dir = os.path.relpath(args.directory)
             rel_file = os.path.join(rel_dir, x)
-            if run in rel_file:
+            # Only the DL2 files (not the phase or profile files written next to them)
+            if run in rel_file and rel_file.endswith(".h5"):
                 filelist.append(rel_file)
 
-        filelist.sort()
-        for i in range(0, len(filelist)):
-            # Calculate the phases
-            DL2_calphase(filelist[i], ephem, "lst", interpolation, ninterp, pickle)
-            if include_theta:
-                add_source_info_dl2(filelist[i], "Crab")
+        # Calculate the phases
+        failures = DL2_calphase_batch(
+            filelist,
+            ephem,
+            "lst",
+            interpolation,
+            ninterp,
+            pickle,
+            chunk_size=chunk_size,
+            use_predictor=args.predictor,
+            interp_tolerance=args.interp_tolerance,
+            n_audit=args.n_audit,
+            sidecar=args.sidecar,
+            source_name="Crab" if include_theta else None,
+            jobs=args.jobs,
+            create_tim_file=args.create_tim,
+        )
+        if args.profile:
+            aggregate_profiles(
+                [
+                    (get_phase_sidecar_name(f) if args.sidecar else f) + ".timing.json"
+                    for f in filelist
+                    if f not in failures
+                ],
+                os.path.join(args.directory, "profile_summary.json"),
+            )
+        if len(failures) > 0:
+            raise RuntimeError("Failed files: " + ", ".join(failures))
 
     else:
         if in_file is not None:
             # Calculate the phases
-            DL2_calphase(in_file, ephem, "lst", interpolation, ninterp, pickle)
+            DL2_calphase(
+                in_file,
+                ephem,
+                "lst",
+                interpolation,
+                ninterp,
+                pickle,
+                chunk_size=chunk_size,
+                use_predictor=args.predictor,
+                interp_tolerance=args.interp_tolerance,
+                n_audit=args.n_audit,
+                sidecar=args.sidecar,
+                create_tim_file=args.create_tim,
+            )
             if include_theta:
                 add_source_info_dl2(in_file, "Crab")
         else:
@@ -30,6 +30,31 @@ Parameters:
 --number-interpolation: int
    Number of events between two interpolation points.
 
+--interpolation-tolerance: float
+   Maximum phase error (in cycles) of the interpolation. If given, the interpolation method is used with nodes placed adaptively in time (--number-interpolation is not used)
+
+--chunk-size: int
+   Number of events per chunk. If given, the phases are computed and written chunk by chunk to keep the memory bounded. Compressed input files (e.g. .fits.gz) cannot be memory mapped, so their whole event table is still loaded in memory.
+
+--ephem-cache: string
+   Directory where the timing models built from a .gro ephemeris are cached (reused between runs)
+
+--obs-cache: string
+   Use the observatory cache: clock corrections, TDBs and observatory/solar system positions are computed once per night and interpolated for every file. If a directory is given, the caches are stored there (reused between runs)
+
+--jobs: int
+   Number of files processed in parallel (only if --dir is given)
+
+--predictor: boolean
+   Set to True if want to use a polynomial phase predictor built for the whole night (faster, precision given by the residuals of the fit)
+
+--audit: int
+   Check the phases given by the interpolation or the phase predictor against the exact PINT phases of a stratified random subsample of events (100 by default, or the number given).
+   The maximum and RMS phase errors are saved in the header of the event table (PHAUDITN, PHERRMAX, PHERRRMS)
+
+--profile: boolean
+   Save the wall time of each stage, the throughput (events/s) and the peak memory in a JSON file next to each output ({output}.timing.json). With --dir, the profiles of all the files are aggregated in profile_summary.json
+
 Usage:
 ------------------------
 1. An example of usage for a given file is:
@@ -57,7 +82,13 @@ python add_DL3_phase_table.py
 import argparse
 import os
 import warnings
-from ptiming_ana.cphase.pulsarphase_cal import DL3_calphase
+from ptiming_ana.cphase.pulsarphase_cal import (
+    DL3_calphase,
+    DL3_calphase_batch,
+    get_DL3_output_name,
+)
+from ptiming_ana.cphase.utils import set_model_cache_dir, set_observatory_cache
+from ptiming_ana.cphase.profiling import set_profiling, aggregate_profiles
 
 
 def main():
@@ -125,6 +156,15 @@ def main():
         default=1000,
         help="Number of events between two interpolation points.",
     )
+    parser.add_argument(
+        "--interpolation-tolerance",
+        "-tol",
+        action="store",
+        type=float,
+        dest="interp_tolerance",
+        default=None,
+        help="Maximum phase error (in cycles) of the interpolation, placing the interpolation points adaptively",
+    )
     parser.add_argument(
         "--observatory",
         "-obs",
@@ -148,6 +188,67 @@ def main():
         dest="create_tim",
         help="Set True to create and save a .tim file",
     )
+    parser.add_argument(
+        "--chunk-size",
+        "-chunk",
+        action="store",
+        type=int,
+        dest="chunk_size",
+        default=None,
+        help="Number of events per chunk (process the file in chunks to bound the memory, compressed files are still fully loaded in memory)",
+    )
+    parser.add_argument(
+        "--ephem-cache",
+        "-ephemcache",
+        action="store",
+        type=str,
+        dest="ephem_cache",
+        default=None,
+        help="Directory where to cache the timing models created from a .gro ephemeris",
+    )
+    parser.add_argument(
+        "--obs-cache",
+        "-obscache",
+        action="store",
+        type=str,
+        nargs="?",
+        const="",
+        dest="obs_cache",
+        default=None,
+        help="Use the observatory cache (computed once per night), optionally stored in the given directory",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="Number of files processed in parallel (only if --dir is given)",
+    )
+    parser.add_argument(
+        "--predictor",
+        "-pred",
+        action="store_true",
+        dest="predictor",
+        help="Set to True if want to use a polynomial phase predictor built for the whole night",
+    )
+    parser.add_argument(
+        "--audit",
+        action="store",
+        type=int,
+        nargs="?",
+        const=100,
+        dest="n_audit",
+        default=None,
+        help="Check the interpolated or predicted phases of a subsample of events (100 by default) against the exact phases",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        dest="profile",
+        help="Save the timing of each stage and the peak memory next to each output",
+    )
 
     args = parser.parse_args()
 
@@ -156,10 +257,20 @@ def main():
     pickle = args.pickle
     in_file = args.in_file
     run = args.run
-    interpolation = args.interpolation
+    interpolation = args.interpolation or (args.interp_tolerance is not None)
     observatory = args.observatory
     create_tim = args.create_tim
     ninterp = args.ninterp
+    chunk_size = args.chunk_size
+
+    if args.ephem_cache is not None:
+        set_model_cache_dir(args.ephem_cache)
+
+    if args.obs_cache is not None:
+        set_observatory_cache(True, args.obs_cache or None)
+
+    if args.profile:
+        set_profiling(True)
 
     if output_dir is None:
         warnings.warn(
@@ -182,19 +293,34 @@ def main():
             if run in rel_file:
                 filelist.append(rel_file)
 
-        filelist.sort()
-        for i in range(0, len(filelist)):
-            # Calculate the phases
-            DL3_calphase(
-                filelist[i],
-                ephem,
-                output_dir,
-                create_tim,
-                observatory,
-                interpolation,
-                ninterp,
-                pickle,
+        # Calculate the phases
+        failures = DL3_calphase_batch(
+            filelist,
+            ephem,
+            output_dir,
+            create_tim,
+            observatory,
+            interpolation,
+            ninterp,
+            pickle,
+            chunk_size=chunk_size,
+            use_predictor=args.predictor,
+            interp_tolerance=args.interp_tolerance,
+            n_audit=args.n_audit,
+            jobs=args.jobs,
+        )
+        if args.profile and output_dir is not None:
+            aggregate_profiles(
+                [
+                    get_DL3_output_name(f, output_dir) + ".timing.json"
+                    for f in filelist
+                    if f not in failures
+                ],
+                os.path.join(output_dir, "profile_summary.json"),
             )
+        if len(failures) > 0:
+            raise RuntimeError("Failed files: " + ", ".join(failures))
+
     else:
         if in_file is not None:
             # Calculate the phases
@@ -207,6 +333,10 @@ def main():
                 interpolation,
                 ninterp,
                 pickle,
+                chunk_size=chunk_size,
+                use_predictor=args.predictor,
+                interp_tolerance=args.interp_tolerance,
+                n_audit=args.n_audit,
             )
         else:
             raise ValueError("No input file or directory given")
@@ -0,0 +1,394 @@
+#####################
+# Batch driver to add the pulsar phases to many DL2, DL3 or Fermi-LAT files, keeping a manifest of the files already processed.
+###################
+
+"""
+Script that adds the pulsar phases to a list of DL2, DL3 or Fermi-LAT files (e.g. a whole season). It keeps a manifest with the hash of every input file,
+the hash of the ephemeris, the options used and the output path, so that files that are already up to date are skipped and an interrupted job can be
+resumed by running the same command again. The work can be split among several nodes with --shard.
+
+Parameters:
+----------------------
+--type: string
+  Type of the input files: dl2, dl3 or fermi
+
+--input-glob: string
+  Glob pattern of the input files (e.g. "/data/DL2/2023*/dl2_LST-1.Run*.h5"). It can be given several times
+
+--dir: string
+  Directory where to find the input files (used with --runs)
+
+--runs: string
+  Run numbers to process (only with --dir), as a comma-separated list or as a text file with one run number per line. The files of a run are the ones named Run{run}. (with any number of leading zeros)
+
+--ephem: string
+  Path to the ephemeris file (.par or .gro)
+
+--output: string
+  Directory where to store the output files (DL3 and Fermi-LAT). DL2 files are modified in place (unless --sidecar is given)
+
+--manifest: string
+  Path to the manifest of the job (by default manifest.json in the output directory, or in the current directory for DL2 files)
+
+--shard: string
+  Process only one part of the files, given as i/N (part i, starting at 0, of N). Each shard writes its own manifest
+
+--force: boolean
+  Process all the files even if they are up to date
+
+--jobs: int
+  Number of files processed in parallel
+
+--interpolation, --number-interpolation, --interpolation-tolerance, --predictor, --chunk-size, --ephem-cache, --obs-cache, --audit:
+  Same as in add_DL2_phase_table and add_DL3_phase_table
+
+--include-theta: boolean
+  Add the source position and theta2 values of the Crab to the DL2 files
+
+--sidecar: boolean
+  Write the phases of DL2 files to a Parquet file next to each file ({name}.phase.parquet) instead of modifying the DL2 files
+
+--ft2: string
+  FT2 file of the Fermi-LAT data
+
+--profile: boolean
+  Save the wall time of each stage, the throughput (events/s) and the peak memory next to each output ({output}.timing.json), and the aggregated profile of
+  the files processed in the job next to the manifest ({manifest}.profile.json)
+
+Usage:
+------------------------
+python batch_phase_tagging.py
+       --type dl3
+       --input-glob "./DL3_directory/*.fits.gz"
+       --output ./DL3_pulsar_directory/
+       --ephem crab.gro
+       --shard 0/4
+"""
+
+import argparse
+import glob
+import os
+import re
+from ptiming_ana.cphase.manifest import JobManifest, parse_shard, select_shard
+from ptiming_ana.cphase.profiling import set_profiling, aggregate_profiles
+from ptiming_ana.cphase.pulsarphase_cal import (
+    DL2_calphase,
+    DL3_calphase,
+    fermi_calphase,
+    get_DL3_output_name,
+)
+from ptiming_ana.cphase.utils import (
+    add_source_info_dl2,
+    get_ephem_hash,
+    get_phase_sidecar_name,
+    run_batch,
+    set_model_cache_dir,
+    set_observatory_cache,
+)
+
+
+def tag_file(file, kind, ephem, output_dir=None, source_name=None, ft2_file=None, **options):
+    # Phases of one file of the batch. Returns the path of the output file
+    if kind == "dl2":
+        DL2_calphase(file, ephem, **options)
+        if source_name is not None:
+            add_source_info_dl2(file, source_name)
+        return get_phase_sidecar_name(file) if options.get("sidecar") else file
+
+    elif kind == "dl3":
+        DL3_calphase(file, ephem, output_dir, **options)
+        return get_DL3_output_name(file, output_dir)
+
+    elif kind == "fermi":
+        fermi_calphase(file, ephem, output_dir, ft2_file=ft2_file)
+        return get_DL3_output_name(file, output_dir)
+
+    raise ValueError(f"Unknown type of files: {kind}")
+
+
+def find_files(input_globs=None, directory=None, runs=None):
+    # Input files from the glob patterns and/or the run numbers in a directory
+    files = set()
+    for pattern in input_globs or []:
+        files.update(glob.glob(pattern))
+
+    if directory is not None:
+        if runs is None:
+            raise ValueError("The run numbers must be given with --runs")
+        if os.path.exists(runs):
+            with open(runs) as f:
+                run_list = [line.strip() for line in f if line.strip()]
+        else:
+            run_list = [run.strip() for run in runs.split(",") if run.strip()]
+
+        # The whole run number of the file name must match (leading zeros are ignored), e.g. run 2967 matches
+        # dl2_LST-1.Run02967.0000.h5 but not dl2_LST-1.Run12967.0000.h5
+        patterns = [
+            re.compile(rf"Run0*{re.escape(run.lstrip('0'))}\.") for run in run_list
+        ]
+        for x in os.listdir(directory):
+            if any(pattern.search(x) for pattern in patterns):
+                files.add(os.path.join(directory, x))
+
+    return sorted(files)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--type",
+        "-t",
+        action="store",
+        type=str,
+        dest="kind",
+        choices=["dl2", "dl3", "fermi"],
+        required=True,
+        help="Type of the input files",
+    )
+    parser.add_argument(
+        "--input-glob",
+        "-g",
+        action="append",
+        type=str,
+        dest="input_globs",
+        default=None,
+        help="Glob pattern of the input files (can be given several times)",
+    )
+    parser.add_argument(
+        "--dir", "-d", action="store", type=str, dest="directory", default=None
+    )
+    parser.add_argument(
+        "--runs",
+        "-r",
+        action="store",
+        type=str,
+        dest="runs",
+        default=None,
+        help="Comma-separated run numbers or text file with one run number per line",
+    )
+    parser.add_argument(
+        "--ephem", "-ephem", action="store", type=str, dest="ephem", default=None
+    )
+    parser.add_argument(
+        "--output", "-out", action="store", type=str, dest="dir_output", default=None
+    )
+    parser.add_argument(
+        "--manifest",
+        "-m",
+        action="store",
+        type=str,
+        dest="manifest",
+        default=None,
+        help="Path to the manifest of the job",
+    )
+    parser.add_argument(
+        "--shard",
+        action="store",
+        type=str,
+        dest="shard",
+        default=None,
+        help="Part of the files to process, as i/N",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        dest="force",
+        help="Process all the files even if they are up to date",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="Number of files processed in parallel",
+    )
+    parser.add_argument(
+        "--interpolation",
+        "-interp",
+        action="store_true",
+        dest="interpolation",
+        help="Set to True if want to use the interpolation method (faster but loses some precision)",
+    )
+    parser.add_argument(
+        "--number-interpolation",
+        "-ninterp",
+        action="store",
+        type=int,
+        dest="ninterp",
+        default=1000,
+        help="Number of events between two interpolation points",
+    )
+    parser.add_argument(
+        "--interpolation-tolerance",
+        "-tol",
+        action="store",
+        type=float,
+        dest="interp_tolerance",
+        default=None,
+        help="Maximum phase error (in cycles) of the interpolation, with adaptive nodes",
+    )
+    parser.add_argument(
+        "--predictor",
+        "-pred",
+        action="store_true",
+        dest="predictor",
+        help="Set to True if want to use a polynomial phase predictor built for the whole night",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        "-chunk",
+        action="store",
+        type=int,
+        dest="chunk_size",
+        default=None,
+        help="Number of events per chunk",
+    )
+    parser.add_argument(
+        "--ephem-cache",
+        "-ephemcache",
+        action="store",
+        type=str,
+        dest="ephem_cache",
+        default=None,
+        help="Directory where to cache the timing models created from a .gro ephemeris",
+    )
+    parser.add_argument(
+        "--obs-cache",
+        "-obscache",
+        action="store",
+        type=str,
+        nargs="?",
+        const="",
+        dest="obs_cache",
+        default=None,
+        help="Use the observatory cache (computed once per night), optionally stored in the given directory",
+    )
+    parser.add_argument(
+        "--include-theta",
+        "-theta",
+        action="store_true",
+        dest="include_theta",
+        help="Add the source position and theta2 values of the Crab to the DL2 files",
+    )
+    parser.add_argument(
+        "--ft2", "-ft2", action="store", type=str, dest="ft2_file", default=None
+    )
+    parser.add_argument(
+        "--sidecar",
+        action="store_true",
+        dest="sidecar",
+        help="Write the phases of DL2 files to a Parquet file next to each file instead of modifying the DL2 files",
+    )
+    parser.add_argument(
+        "--audit",
+        action="store",
+        type=int,
+        nargs="?",
+        const=100,
+        dest="n_audit",
+        default=None,
+        help="Check the interpolated or predicted phases of a subsample of events (100 by default) against the exact phases",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        dest="profile",
+        help="Save the timing of each stage and the peak memory next to each output",
+    )
+
+    args = parser.parse_args()
+
+    if args.ephem is None:
+        raise ValueError("No ephemeris provided")
+
+    if args.kind != "dl2" and args.dir_output is None:
+        raise ValueError("No output directory provided")
+
+    if args.ephem_cache is not None:
+        set_model_cache_dir(args.ephem_cache)
+
+    if args.obs_cache is not None:
+        set_observatory_cache(True, args.obs_cache or None)
+
+    if args.profile:
+        set_profiling(True)
+
+    files = find_files(args.input_globs, args.directory, args.runs)
+    if len(files) == 0:
+        raise ValueError("No input files found")
+
+    shard = None
+    if args.shard is not None:
+        shard = parse_shard(args.shard)
+        files = select_shard(files, *shard)
+
+    manifest_file = args.manifest
+    if manifest_file is None:
+        manifest_file = os.path.join(args.dir_output or ".", "manifest.json")
+    manifest = JobManifest(manifest_file, shard=shard)
+
+    # Options that change the output (they are stored in the manifest)
+    options = {
+        "kind": args.kind,
+        "source_name": "Crab" if args.include_theta and args.kind == "dl2" else None,
+        "ft2_file": args.ft2_file if args.kind == "fermi" else None,
+    }
+    if args.kind == "dl2":
+        options["sidecar"] = args.sidecar
+    if args.kind != "fermi":
+        options.update(
+            {
+                "use_interpolation": args.interpolation
+                or args.interp_tolerance is not None,
+                "n_interp": args.ninterp,
+                "interp_tolerance": args.interp_tolerance,
+                "use_predictor": args.predictor,
+                "chunk_size": args.chunk_size,
+                "n_audit": args.n_audit,
+            }
+        )
+
+    ephem_hash = get_ephem_hash(args.ephem)
+    todo = [
+        file
+        for file in files
+        if args.force or not manifest.is_up_to_date(file, ephem_hash, options)
+    ]
+    print(f"{len(files) - len(todo)} of {len(files)} files are already up to date")
+
+    outputs = []
+
+    def record(i, output, error):
+        # Update the manifest as soon as each file finishes, so that the job can be resumed
+        if error is None:
+            manifest.record(todo[i], ephem_hash, options, output)
+            outputs.append(output)
+
+    failures = run_batch(
+        tag_file,
+        [(file,) for file in todo],
+        jobs=args.jobs,
+        callback=record,
+        ephem=args.ephem,
+        output_dir=args.dir_output,
+        **options,
+    )[1]
+
+    if args.profile and len(outputs) > 0:
+        root = manifest.filename[:-5] if manifest.filename.endswith(".json") else manifest.filename
+        summary = aggregate_profiles(
+            [output + ".timing.json" for output in outputs], root + ".profile.json"
+        )
+        print(
+            f"Processed {summary['events']} events of {summary['files']} files in {summary['wall_time']:.1f} s "
+            f"(peak memory {summary['peak_rss_mb']:.0f} MB)"
+        )
+
+    if len(failures) > 0:
+        raise RuntimeError("Failed files: " + ", ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+
+__all__ = ["JobManifest", "get_file_hash", "parse_shard", "select_shard"]
+
+logger = logging.getLogger(__name__)
+
+
+def get_file_hash(filename, block_size=1 << 20):
+    """
+    Computes the SHA-256 hash of the content of a file, reading it in blocks so that large files are not loaded in memory.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file
+    block_size : int
+        Number of bytes read at once
+
+    Returns
+    -------
+    str
+        Hexadecimal digest of the file content
+    """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def parse_shard(shard):
+    """
+    Parses a shard specification of the form 'i/N' (shard i, starting at 0, of N).
+
+    Returns
+    -------
+    tuple
+        Index and total number of shards
+    """
+    try:
+        index, nshards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Wrong shard specification '{shard}', it should be i/N")
+    if nshards < 1 or not 0 <= index < nshards:
+        raise ValueError(f"Wrong shard specification '{shard}', it needs 0 <= i < N")
+    return index, nshards
+
+
+def select_shard(files, index, nshards):
+    """
+    Selects the files of a shard. The files are sorted and distributed in turns, so that every node gets the same list regardless of the order in which the files were found.
+    """
+    return sorted(files)[index::nshards]
+
+
+class JobManifest:
+    """
+    A class to keep a record (JSON file) of the files already processed by a batch job, so that an interrupted job can be resumed and finished files are not processed again.
+    Each entry stores the hash of the input file, the hash of the ephemeris, the processing options and the output path. A file is up to date if all of them are unchanged and the output exists.
+
+    When the work is split in shards, each shard writes its own manifest ({name}.shard{i}of{N}.json), but the entries of all the manifests with the same name are taken into account
+    to decide if a file is up to date.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the manifest
+    shard : tuple
+        Index and total number of shards of the job. If None, the job is not sharded
+    """
+
+    def __init__(self, filename, shard=None):
+        if shard is None:
+            self.filename = filename
+        else:
+            root = filename[:-5] if filename.endswith(".json") else filename
+            self.filename = f"{root}.shard{shard[0]}of{shard[1]}.json"
+
+        self.entries = {}
+        self._read(filename)
+
+    def _read(self, filename):
+        root = filename[:-5] if filename.endswith(".json") else filename
+        manifests = sorted(set([filename] + glob.glob(glob.escape(root) + ".shard*.json")))
+
+        # The own manifest is read last so that its entries prevail
+        if self.filename in manifests:
+            manifests.remove(self.filename)
+        for name in manifests + [self.filename]:
+            if os.path.exists(name):
+                with open(name) as f:
+                    self.entries.update(json.load(f))
+
+        # Only the entries of the own manifest (and the ones written by this job) are saved
+        self._own = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self._own = json.load(f)
+
+    def _stat(self, file):
+        st = os.stat(file)
+        return st.st_size, st.st_mtime_ns
+
+    def get_input_hash(self, file):
+        """
+        Gets the hash of an input file. If the size and modification time of the file are the ones recorded in the manifest, the recorded hash is used instead of reading the file again.
+        """
+        entry = self.entries.get(os.path.abspath(file))
+        size, mtime = self._stat(file)
+        if entry is not None and entry["size"] == size and entry["mtime_ns"] == mtime:
+            return entry["input_hash"]
+        return get_file_hash(file)
+
+    def is_up_to_date(self, file, ephem_hash, options):
+        """
+        Checks whether a file was already processed with the same ephemeris and options, and both the input and the output are unchanged.
+
+        Parameters
+        ----------
+        file : str
+            Input file
+        ephem_hash : str
+            Hash of the ephemeris file
+        options : dict
+            Processing options (must be JSON serializable)
+
+        Returns
+        -------
+        bool
+        """
+        entry = self.entries.get(os.path.abspath(file))
+        if entry is None:
+            return False
+        return (
+            entry["ephem_hash"] == ephem_hash
+            and entry["options"] == options
+            and os.path.exists(entry["output"])
+            and entry["input_hash"] == self.get_input_hash(file)
+        )
+
+    def record(self, file, ephem_hash, options, output):
+        """
+        Records a processed file and writes the manifest. The hash is computed after processing, so that files modified in place (e.g. DL2 files) are recorded with their final content.
+
+        Parameters
+        ----------
+        file : str
+            Input file
+        ephem_hash : str
+            Hash of the ephemeris file
+        options : dict
+            Processing options (must be JSON serializable)
+        output : str
+            Path of the output file
+        """
+        size, mtime = self._stat(file)
+        entry = {
+            "input_hash": get_file_hash(file),
+            "size": size,
+            "mtime_ns": mtime,
+            "ephem_hash": ephem_hash,
+            "options": options,
+            "output": os.path.abspath(output),
+        }
+        self.entries[os.path.abspath(file)] = entry
+        self._own[os.path.abspath(file)] = entry
+        self.save()
+
+    def save(self):
+        """
+        Writes the manifest. It is written to a temporary name and renamed so that an interruption never leaves a partial manifest.
+        """
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(directory, exist_ok=True)
+        tmp_file = self.filename + f".{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._own, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.filename)
@@ -23,6 +23,15 @@ def main():
     parser.add_argument(
         "--run-number", "-r", action="store", type=str, dest="run", default=False
     )
+    parser.add_argument(
+        "--chunk-size",
+        "-chunk",
+        action="store",
+        type=int,
+        dest="chunk_size",
+        default=1000000,
+        help="Maximum number of events copied at once to the merged file",
+    )
 
     args = parser.parse_args()
     output_dir = args.dir_output
@@ -30,7 +39,7 @@ def main():
     run = args.run
     directory = args.directory
 
-    merge_dl2_pulsar(directory, run, output_dir, src_dep)
+    merge_dl2_pulsar(directory, run, output_dir, src_dep, chunk_size=args.chunk_size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,397 @@
+import os
+import logging
+import numpy as np
+import astropy.units as u
+from astropy import table
+from astropy.time import Time, TimeDelta
+from scipy.interpolate import CubicSpline
+from pint import toa
+from pint.observatory import get_observatory
+
+import ptiming_ana.cphase.utils as utils
+from ptiming_ana.cphase.utils import create_toas
+from ptiming_ana.cphase.profiling import stage
+
+__all__ = ["ObservatoryCache", "get_observatory_cache"]
+
+logger = logging.getLogger(__name__)
+
+# Caches already built in this process, keyed by observatory, nights and settings
+_observatory_cache = {}
+
+_posvel_meta = {
+    "ssb_obs_pos": (u.km, {"origin": "SSB", "obj": "OBS"}),
+    "ssb_obs_vel": (u.km / u.s, {"origin": "SSB", "obj": "OBS"}),
+    "obs_sun_pos": (u.km, {"origin": "OBS", "obj": "SUN"}),
+}
+for _planet in toa.all_planets:
+    _posvel_meta[f"obs_{_planet}_pos"] = (u.km, {"origin": "OBS", "obj": _planet})
+
+
+def _mjd_long(t):
+    # MJDs in long double precision of an array of Time objects
+    return (np.longdouble(t.jd1) - np.longdouble(2400000.5)) + np.longdouble(t.jd2)
+
+
+class ObservatoryCache:
+    """
+    A class to store the clock corrections, TDB conversion and observatory/solar system positions of a site on a regular time grid.
+    These quantities only depend on the time and the site (not on the pulsar), so they are computed exactly with PINT once on the grid and interpolated for all the events
+    of the runs and subruns covered by the grid.
+
+    Parameters
+    ----------
+    mjd_start : float
+        First time of the grid in topocentric MJD (UTC)
+    step : float
+        Spacing of the grid in seconds
+    clock_corr : array
+        Clock corrections (in seconds) at the nodes of the grid
+    tdb_offset : array
+        Difference between the TDB and the clock-corrected UTC MJDs (in seconds) at the nodes of the grid
+    posvels : dict
+        Positions (km) and velocities (km/s) at the nodes of the grid, named as the columns of the PINT TOAs table (ssb_obs_pos, ssb_obs_vel, obs_sun_pos, obs_{planet}_pos)
+    obs : str
+        Observatory code given to PINT
+    ephem : str
+        Solar system ephemeris used
+    include_bipm : bool
+        True if the BIPM clock correction is included
+    include_gps : bool
+        True if the GPS clock correction is included
+    """
+
+    def __init__(
+        self,
+        mjd_start,
+        step,
+        clock_corr,
+        tdb_offset,
+        posvels,
+        obs="lst",
+        ephem="DE421",
+        include_bipm=True,
+        include_gps=True,
+    ):
+        self.mjd_start = float(mjd_start)
+        self.step = float(step)
+        self.clock_corr = np.asarray(clock_corr, dtype=np.float64)
+        self.tdb_offset = np.asarray(tdb_offset, dtype=np.float64)
+        self.posvels = {
+            name: np.asarray(value, dtype=np.float64) for name, value in posvels.items()
+        }
+        self.obs = obs
+        self.ephem = ephem
+        self.include_bipm = include_bipm
+        self.include_gps = include_gps
+
+        self.planets = "obs_earth_pos" in self.posvels
+        self.grid = np.arange(len(self.clock_corr)) * self.step
+        self.mjd_stop = self.mjd_start + self.grid[-1] / 86400
+
+        # Positions are smooth on the scale of the grid, so cubic splines reproduce them well below the nanosecond level
+        self._tdb_spline = CubicSpline(self.grid, self.tdb_offset)
+        self._posvel_splines = {
+            name: CubicSpline(self.grid, value, axis=0)
+            for name, value in self.posvels.items()
+        }
+
+    @classmethod
+    def compute(
+        cls,
+        tstart,
+        tstop,
+        obs="lst",
+        step=60,
+        include_planets=True,
+        include_bipm=True,
+        include_gps=True,
+        ephem="DE421",
+    ):
+        """
+        Computes the cache with PINT on a regular grid covering a time interval.
+
+        Parameters
+        ----------
+        tstart : float
+            Start of the interval in MJD (UTC)
+        tstop : float
+            End of the interval in MJD (UTC)
+        obs : str
+            Observatory code to give to PINT
+        step : float
+            Spacing of the grid in seconds
+        include_planets : bool
+            True if want to store the positions of the planets (needed for the Shapiro delay)
+        include_bipm : bool
+            True if want to apply the BIPM clock correction
+        include_gps : bool
+            True if want to apply the GPS clock correction
+        ephem : str
+            Solar system ephemeris
+
+        Returns
+        -------
+        ObservatoryCache
+        """
+        # One extra node on each side so that the splines are also accurate at the edges of the interval
+        n_nodes = int(np.ceil((tstop - tstart) * 86400 / step)) + 3
+        mjd_start = tstart - step / 86400
+        nodes = mjd_start + np.arange(n_nodes, dtype=np.longdouble) * step / 86400
+
+        # A leap second stretches the UTC day that contains it, so the TDB conversion cannot be interpolated across the limits of that day
+        days = Time(
+            [np.floor(float(nodes[0])), np.floor(float(nodes[-1])) + 1],
+            format="mjd",
+            scale="utc",
+        )
+        tai_utc = np.round((days.tai.mjd - days.mjd) * 86400)
+        if tai_utc[0] != tai_utc[1]:
+            raise ValueError(
+                "There is a leap second inside the interval, the TDB conversion cannot be interpolated"
+            )
+
+        logger.info(
+            f"Computing observatory cache for {obs} between MJD {tstart} and {tstop} ({n_nodes} nodes)"
+        )
+        toas = toa.get_TOAs_array(
+            nodes,
+            obs,
+            errors=0,
+            ephem=ephem,
+            include_bipm=include_bipm,
+            include_gps=include_gps,
+            planets=include_planets,
+        )
+        # The TOAs are kept in the order of the nodes
+        order = np.argsort(toas.table["index"])
+
+        clock_corr = toas.get_flag_value("clkcorr", 0, float)[0]
+        corrected = _mjd_long(Time(toas.table["mjd"]))
+        tdb_offset = (toas.table["tdbld"] - corrected) * 86400
+
+        posvels = {
+            name: np.asarray(toas.table[name])[order]
+            for name in _posvel_meta
+            if name in toas.table.colnames
+        }
+
+        return cls(
+            mjd_start,
+            step,
+            np.asarray(clock_corr, dtype=np.float64)[order],
+            np.asarray(tdb_offset, dtype=np.float64)[order],
+            posvels,
+            obs=obs,
+            ephem=ephem,
+            include_bipm=include_bipm,
+            include_gps=include_gps,
+        )
+
+    def covers(self, times):
+        """
+        Checks whether the times (MJD, UTC) are inside the grid of the cache.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        return bool(np.all((times >= self.mjd_start) & (times <= self.mjd_stop)))
+
+    def get_toas(self, times):
+        """
+        Creates the PINT TOAs object for the given arrival times, interpolating the clock corrections, TDBs and posvels from the cache.
+        The TOAs are equivalent to the ones given by get_toas_from_times, and can be used directly to compute phases with a timing model.
+
+        Parameters
+        ----------
+        times : array or astropy.time.Time
+            Times of arrival. If not given as a Time object, they are interpreted as MJDs (UTC, long double precision is kept)
+
+        Returns
+        -------
+        PINT TOAs object with clock corrections, TDBs and posvels computed.
+        """
+        if isinstance(times, Time):
+            times = _mjd_long(times.utc)
+        times = np.atleast_1d(np.asarray(times, dtype=np.longdouble))
+        if not self.covers(times):
+            raise ValueError(
+                f"Times outside of the observatory cache (MJD {self.mjd_start} to {self.mjd_stop})"
+            )
+
+        x = np.asarray((times - self.mjd_start) * 86400, dtype=np.float64)
+        n = len(times)
+
+        site = get_observatory(self.obs)
+        t = Time(times, scale="utc", format="pulsar_mjd", precision=9)
+        loc = site.earth_location_itrf(time=t)
+
+        with stage("clock_corrections", n):
+            # Clock corrections are linear between the tabulated values of the clock files
+            clock_corr = np.interp(x, self.grid, self.clock_corr)
+            mjd = Time(t + TimeDelta(clock_corr * u.s), location=loc, precision=9)
+
+        with stage("toas", n):
+            toas = create_toas(mjd, self.obs)
+            for flags, corr in zip(toas.table["flags"], clock_corr):
+                if corr != 0:
+                    flags["clkcorr"] = str(corr)
+        toas.clock_corr_info.update(
+            {
+                "include_bipm": self.include_bipm,
+                "bipm_version": None,
+                "include_gps": self.include_gps,
+            }
+        )
+
+        with stage("tdb", n):
+            tdb_offset = self._tdb_spline(x)
+            tdb = Time(
+                mjd.jd1,
+                mjd.jd2 + tdb_offset / 86400,
+                format="jd",
+                scale="tdb",
+                precision=9,
+            )
+            toas.table["tdb"] = tdb
+            toas.table["tdbld"] = tdb.to_value("mjd", "long")
+            toas.ephem = self.ephem
+
+        with stage("posvels", n):
+            toas.table.meta["ephem"] = self.ephem
+            toas.planets = self.planets
+            for name, spline in self._posvel_splines.items():
+                unit, meta = _posvel_meta[name]
+                toas.table.add_column(
+                    table.Column(name=name, data=spline(x), unit=unit, meta=meta)
+                )
+
+        return toas
+
+    def save(self, filename):
+        """
+        Saves the cache in a numpy .npz file.
+        """
+        np.savez(
+            filename,
+            mjd_start=self.mjd_start,
+            step=self.step,
+            clock_corr=self.clock_corr,
+            tdb_offset=self.tdb_offset,
+            obs=self.obs,
+            ephem=self.ephem,
+            include_bipm=self.include_bipm,
+            include_gps=self.include_gps,
+            **self.posvels,
+        )
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Reads a cache saved with save.
+        """
+        with np.load(filename) as data:
+            posvels = {name: data[name] for name in _posvel_meta if name in data}
+            return cls(
+                float(data["mjd_start"]),
+                float(data["step"]),
+                data["clock_corr"],
+                data["tdb_offset"],
+                posvels,
+                obs=str(data["obs"]),
+                ephem=str(data["ephem"]),
+                include_bipm=bool(data["include_bipm"]),
+                include_gps=bool(data["include_gps"]),
+            )
+
+
+def get_observatory_cache(
+    times,
+    obs="lst",
+    step=60,
+    include_planets=True,
+    include_bipm=True,
+    include_gps=True,
+    ephem="DE421",
+    cache_dir=None,
+):
+    """
+    Gets the observatory cache covering the nights of the given arrival times.
+    The cache covers whole nights (from noon to noon UTC), so it is computed once per night and observatory and reused by all the runs and subruns of the night.
+
+    Parameters
+    ----------
+    times : array or astropy.time.Time
+        Times of arrival in MJD (UTC)
+    obs : str
+        Observatory code to give to PINT
+    step : float
+        Spacing of the grid in seconds
+    include_planets : bool
+        True if want to store the positions of the planets (needed for the Shapiro delay)
+    include_bipm : bool
+        True if want to apply the BIPM clock correction
+    include_gps : bool
+        True if want to apply the GPS clock correction
+    ephem : str
+        Solar system ephemeris
+    cache_dir : str
+        Directory where to store the caches so that they can be reused by other processes. If None, the directory set with set_observatory_cache is used (if any). Otherwise the caches are only kept in memory
+
+    Returns
+    -------
+    ObservatoryCache
+    """
+    if isinstance(times, Time):
+        times = times.utc.mjd
+    times = np.asarray(times, dtype=np.float64)
+
+    first_night = int(np.floor(np.min(times) - 0.5))
+    last_night = int(np.floor(np.max(times) - 0.5))
+
+    key = (
+        obs,
+        first_night,
+        last_night,
+        step,
+        include_planets,
+        include_bipm,
+        include_gps,
+        ephem,
+    )
+    if key in _observatory_cache:
+        return _observatory_cache[key]
+
+    if cache_dir is None:
+        cache_dir = utils._observatory_cache_dir
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(
+            cache_dir,
+            f"obs_{obs}_{first_night}_{last_night}_{step}_{ephem}_"
+            f"{int(include_planets)}{int(include_bipm)}{int(include_gps)}.npz",
+        )
+
+    if cache_file is not None and os.path.exists(cache_file):
+        cache = ObservatoryCache.read(cache_file)
+    else:
+        with stage("observatory_cache"):
+            cache = ObservatoryCache.compute(
+                first_night + 0.5,
+                last_night + 1.5,
+                obs=obs,
+                step=step,
+                include_planets=include_planets,
+                include_bipm=include_bipm,
+                include_gps=include_gps,
+                ephem=ephem,
+            )
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary name and rename so that concurrent jobs never read a partial file
+            tmp_file = cache_file.replace(".npz", f".{os.getpid()}.tmp.npz")
+            cache.save(tmp_file)
+            os.replace(tmp_file, cache_file)
+
+    _observatory_cache[key] = cache
+
+    return cache
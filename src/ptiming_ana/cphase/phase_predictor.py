@@ -0,0 +1,397 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import numba as nb
+from numpy.polynomial import chebyshev
+from astropy.time import Time
+from pint.models.timing_model import TimingModel
+
+import ptiming_ana.cphase.utils as utils
+from ptiming_ana.cphase.utils import (
+    get_ephem_hash,
+    get_ephem_index,
+    get_ephem_segments,
+    get_timing_model,
+    read_ephemfile,
+)
+
+__all__ = ["PhasePredictor", "get_phase_predictor"]
+
+logger = logging.getLogger(__name__)
+
+# Predictors already built in this process, keyed by ephemeris, observatory, nights and settings
+_predictor_cache = {}
+
+
+class PhasePredictor:
+    """
+    A class to predict pulsar phases and barycentric times with piecewise Chebyshev polynomials (in the spirit of TEMPO polycos).
+    The polynomials of each segment are fitted to exact PINT phases computed at a few nodes, and evaluated for all the events at once.
+
+    Parameters
+    ----------
+    edges : array
+        Edges of the segments in topocentric MJD (UTC). The polynomials of each segment are centered at the middle point of its edges (in double precision)
+    ref_frac : array
+        Fractional part of the absolute phase at the first node of each segment
+    coeffs_phase : array
+        Chebyshev coefficients of the phase (relative to the reference phase) of each segment, shape (n_segments, n_coeff)
+    coeffs_btoa : array
+        Chebyshev coefficients of the difference between barycentric and topocentric time (in seconds) of each segment
+    residuals_phase : array
+        Maximum difference between the fit and the exact phases at the nodes of each segment (in cycles)
+    residuals_btoa : array
+        Maximum difference between the fit and the exact barycentric times at the nodes of each segment (in seconds)
+    obs : str
+        Observatory code used to compute the exact phases
+
+    Attributes
+    ----------
+    n_segments : int
+        Number of segments of the predictor
+    max_residual : float
+        Maximum phase residual (in cycles) over all the segments
+    """
+
+    def __init__(
+        self,
+        edges,
+        ref_frac,
+        coeffs_phase,
+        coeffs_btoa,
+        residuals_phase,
+        residuals_btoa,
+        obs="lst",
+    ):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.ref_frac = np.asarray(ref_frac, dtype=np.float64)
+        self.coeffs_phase = np.asarray(coeffs_phase, dtype=np.float64)
+        self.coeffs_btoa = np.asarray(coeffs_btoa, dtype=np.float64)
+        self.residuals_phase = np.asarray(residuals_phase, dtype=np.float64)
+        self.residuals_btoa = np.asarray(residuals_btoa, dtype=np.float64)
+        self.obs = obs
+
+        self.n_segments = len(self.edges) - 1
+        self.max_residual = float(np.max(self.residuals_phase))
+
+        # Center (in days from the first edge) and half width (in seconds) of the segments
+        self._edges_rel = self.edges - self.edges[0]
+        self._mid_rel = _segment_centers(self.edges) - self.edges[0]
+        self._half_width = (self.edges[1:] - self.edges[:-1]) / 2 * 86400
+
+    @classmethod
+    def from_ephem(
+        cls,
+        ephem,
+        tstart,
+        tstop,
+        obs="lst",
+        segment_length=60,
+        n_coeff=12,
+        include_bipm=True,
+        include_gps=True,
+    ):
+        """
+        Builds the predictor fitting the exact PINT phases in the time range given.
+
+        Parameters
+        ----------
+        ephem : str or TimingModel
+            Ephemeris to be used (.par or .gro file) or timing model. For .gro files the segments never cross the limits of the lines of the ephemeris
+        tstart : float
+            Start of the time range in MJD
+        tstop : float
+            End of the time range in MJD
+        obs : str
+            Observatory code to give to PINT
+        segment_length : float
+            Maximum length of the segments in minutes
+        n_coeff : int
+            Number of Chebyshev coefficients per segment. The exact phases are computed at twice this number of nodes per segment
+        include_bipm : bool
+            Whether to apply the BIPM clock correction to the exact phases (needs the clock files of PINT)
+        include_gps : bool
+            Whether to apply the GPS clock correction to the exact phases (needs the clock files of PINT)
+
+        Returns
+        -------
+        PhasePredictor
+        """
+        from ptiming_ana.cphase.pulsarphase_cal import compute_phases_from_times_model
+
+        tstart = np.longdouble(tstart)
+        tstop = np.longdouble(tstop)
+        if tstop <= tstart:
+            raise ValueError("The end of the time range must be after the start")
+
+        nseg = int(np.ceil((tstop - tstart) * 1440 / segment_length))
+        edges = np.asarray(
+            tstart + (tstop - tstart) * np.arange(nseg + 1) / nseg, dtype=np.float64
+        )
+
+        # Do not let the segments cross the limits of the lines of a .gro ephemeris
+        is_gro = isinstance(ephem, str) and ephem.endswith(".gro")
+        if is_gro:
+            start, finish = get_ephem_index(read_ephemfile(ephem))[:2]
+            limits = np.concatenate((start, finish))
+            limits = limits[(limits > tstart) & (limits < tstop)]
+            edges = np.unique(np.concatenate((edges, limits)))
+            nseg = len(edges) - 1
+
+        # Chebyshev nodes (of the first kind) inside each segment
+        n_nodes = 2 * n_coeff
+        x_nodes = np.cos(np.pi * (np.arange(n_nodes)[::-1] + 0.5) / n_nodes)
+        mid = _segment_centers(edges).astype(np.longdouble)
+        half = (edges[1:] - edges[:-1]) / 2
+        nodes = (mid[:, None] + half[:, None] * x_nodes[None, :]).ravel()
+
+        # Exact absolute phases and barycentric times at all the nodes
+        logger.info(f"Computing exact phases at {len(nodes)} nodes")
+        if is_gro:
+            segments = get_ephem_segments(nodes, ephem)
+        else:
+            segments = [(get_timing_model(ephem), slice(None))]
+
+        phase_int = np.empty(len(nodes), dtype=np.longdouble)
+        phase_frac = np.empty(len(nodes), dtype=np.longdouble)
+        btoa = np.empty(len(nodes), dtype=np.longdouble)
+        for model, index in segments:
+            b, p = compute_phases_from_times_model(
+                nodes[index],
+                model,
+                obs=obs,
+                include_bipm=include_bipm,
+                include_gps=include_gps,
+            )
+            phase_int[index] = np.asarray(p.int)
+            phase_frac[index] = np.asarray(p.frac)
+            btoa[index] = np.asarray(b)
+
+        phase_int = phase_int.reshape(nseg, n_nodes)
+        phase_frac = phase_frac.reshape(nseg, n_nodes)
+        btoa = btoa.reshape(nseg, n_nodes)
+
+        # Phases relative to the first node and barycentric delays in seconds (only the fractional phases are predicted)
+        ref_int = phase_int[:, 0]
+        ref_frac = phase_frac[:, 0]
+        y_phase = np.asarray(
+            (phase_int - ref_int[:, None]) + (phase_frac - ref_frac[:, None]),
+            dtype=np.float64,
+        )
+        y_btoa = np.asarray(
+            (btoa - nodes.reshape(nseg, n_nodes)) * 86400, dtype=np.float64
+        )
+
+        # Least squares fit of all the segments at once (same nodes in x)
+        vander = chebyshev.chebvander(x_nodes, n_coeff - 1)
+        coeffs_phase = np.linalg.lstsq(vander, y_phase.T, rcond=None)[0].T
+        coeffs_btoa = np.linalg.lstsq(vander, y_btoa.T, rcond=None)[0].T
+
+        residuals_phase = np.max(np.abs(coeffs_phase @ vander.T - y_phase), axis=1)
+        residuals_btoa = np.max(np.abs(coeffs_btoa @ vander.T - y_btoa), axis=1)
+
+        predictor = cls(
+            edges,
+            ref_frac,
+            coeffs_phase,
+            coeffs_btoa,
+            residuals_phase,
+            residuals_btoa,
+            obs=obs,
+        )
+        logger.info(
+            f"Phase predictor with {nseg} segments. Maximum residual: {predictor.max_residual:.2e} cycles"
+        )
+
+        return predictor
+
+    def evaluate(self, times):
+        """
+        Evaluates the phases and barycentric times of a set of arrival times.
+
+        Parameters
+        ----------
+        times : array or astropy.time.Time
+            Times of arrival in MJD (UTC)
+
+        Returns
+        -------
+        Fractional phases (between -0.5 and 0.5) and barycentered times in MJD
+        """
+        if isinstance(times, Time):
+            times = times.utc.to_value("mjd", "long")
+        times = np.asarray(times)
+        if times.dtype != np.longdouble:
+            times = times.astype(np.float64, copy=False)
+
+        # Times relative to the first edge, so that double precision is enough
+        t_rel = np.asarray(times - self.edges[0], dtype=np.float64)
+        if (len(t_rel) > 0) and (
+            (t_rel.min() < 0) or (t_rel.max() > self._edges_rel[-1])
+        ):
+            raise ValueError("Times outside the time range of the predictor")
+
+        phase, delay = _evaluate_segments(
+            t_rel,
+            self._edges_rel,
+            self._mid_rel,
+            self._half_width,
+            self.ref_frac,
+            self.coeffs_phase,
+            self.coeffs_btoa,
+        )
+        barycent_toas = times + delay / 86400
+
+        return (phase, barycent_toas)
+
+    def save(self, filename):
+        """
+        Saves the predictor in a .npz file.
+        """
+        np.savez(
+            filename,
+            edges=self.edges,
+            ref_frac=self.ref_frac,
+            coeffs_phase=self.coeffs_phase,
+            coeffs_btoa=self.coeffs_btoa,
+            residuals_phase=self.residuals_phase,
+            residuals_btoa=self.residuals_btoa,
+            obs=self.obs,
+        )
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Reads a predictor saved with the save method.
+        """
+        with np.load(filename) as data:
+            return cls(
+                data["edges"],
+                data["ref_frac"],
+                data["coeffs_phase"],
+                data["coeffs_btoa"],
+                data["residuals_phase"],
+                data["residuals_btoa"],
+                obs=str(data["obs"]),
+            )
+
+
+def _segment_centers(edges):
+    return edges[:-1] + (edges[1:] - edges[:-1]) / 2
+
+
+@nb.njit(parallel=True, cache=True)
+def _evaluate_segments(t_rel, edges, mid, half_width, ref_frac, coeffs_phase, coeffs_btoa):
+    # Finds the segment of each time and evaluates its Chebyshev series (Clenshaw recurrence) in a single pass
+    n = len(t_rel)
+    nseg = len(mid)
+    ncoeff = coeffs_phase.shape[1]
+    phase = np.empty(n)
+    delay = np.empty(n)
+    for i in nb.prange(n):
+        seg = min(max(np.searchsorted(edges, t_rel[i], side="right") - 1, 0), nseg - 1)
+        x = (t_rel[i] - mid[seg]) * 86400 / half_width[seg]
+
+        b1 = 0.0
+        b2 = 0.0
+        d1 = 0.0
+        d2 = 0.0
+        for k in range(ncoeff - 1, 0, -1):
+            b1, b2 = 2 * x * b1 - b2 + coeffs_phase[seg, k], b1
+            d1, d2 = 2 * x * d1 - d2 + coeffs_btoa[seg, k], d1
+
+        p = ref_frac[seg] + x * b1 - b2 + coeffs_phase[seg, 0]
+        phase[i] = p - np.floor(p + 0.5)
+        delay[i] = x * d1 - d2 + coeffs_btoa[seg, 0]
+
+    return (phase, delay)
+
+
+def get_phase_predictor(
+    times,
+    ephem,
+    obs="lst",
+    segment_length=60,
+    n_coeff=12,
+    cache_dir=None,
+    include_bipm=True,
+    include_gps=True,
+):
+    """
+    Gets the phase predictor covering the nights of the given arrival times.
+    The predictor covers whole nights (from noon to noon UTC), so it is built once per night, observatory and ephemeris and reused by all the runs and subruns of the night.
+
+    Parameters
+    ----------
+    times : array or astropy.time.Time
+        Times of arrival in MJD (UTC)
+    ephem : str or TimingModel
+        Ephemeris to be used (.par or .gro file) or timing model
+    obs : str
+        Observatory code to give to PINT
+    segment_length : float
+        Maximum length of the segments in minutes
+    n_coeff : int
+        Number of Chebyshev coefficients per segment
+    cache_dir : str
+        Directory where to store the predictors so that they can be reused by other processes. If None, the directory set with set_model_cache_dir is used (if any). Otherwise the predictors are only kept in memory
+    include_bipm : bool
+        Whether to apply the BIPM clock correction (needs the clock files of PINT)
+    include_gps : bool
+        Whether to apply the GPS clock correction (needs the clock files of PINT)
+
+    Returns
+    -------
+    PhasePredictor
+    """
+    if isinstance(times, Time):
+        times = times.utc.mjd
+    times = np.asarray(times, dtype=np.float64)
+
+    first_night = int(np.floor(np.min(times) - 0.5))
+    last_night = int(np.floor(np.max(times) - 0.5))
+
+    if isinstance(ephem, TimingModel):
+        ephem_id = hashlib.sha256(ephem.as_parfile().encode()).hexdigest()
+    else:
+        ephem_id = get_ephem_hash(ephem)
+
+    clock = f"bipm{int(include_bipm)}gps{int(include_gps)}"
+    key = (ephem_id, obs, first_night, last_night, segment_length, n_coeff, clock)
+    if key in _predictor_cache:
+        return _predictor_cache[key]
+
+    if cache_dir is None:
+        cache_dir = utils._model_cache_dir
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(
+            cache_dir,
+            f"{ephem_id}_{obs}_{first_night}_{last_night}_{segment_length}_{n_coeff}_{clock}.npz",
+        )
+
+    if cache_file is not None and os.path.exists(cache_file):
+        predictor = PhasePredictor.read(cache_file)
+    else:
+        predictor = PhasePredictor.from_ephem(
+            ephem,
+            first_night + 0.5,
+            last_night + 1.5,
+            obs=obs,
+            segment_length=segment_length,
+            n_coeff=n_coeff,
+            include_bipm=include_bipm,
+            include_gps=include_gps,
+        )
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary name and rename so that concurrent jobs never read a partial file
+            tmp_file = cache_file.replace(".npz", f".{os.getpid()}.tmp.npz")
+            predictor.save(tmp_file)
+            os.replace(tmp_file, cache_file)
+
+    _predictor_cache[key] = predictor
+
+    return predictor
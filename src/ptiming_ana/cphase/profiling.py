@@ -0,0 +1,200 @@
+import sys
+import json
+import time
+import resource
+import logging
+from contextlib import contextmanager
+
+__all__ = [
+    "set_profiling",
+    "stage",
+    "start_profile",
+    "finish_profile",
+    "aggregate_profiles",
+    "TaggingProfile",
+]
+
+logger = logging.getLogger(__name__)
+
+_profiling_enabled = False
+# Profile of the file being processed in this process (None if profiling is not enabled)
+_active_profile = None
+
+
+def set_profiling(enabled=True):
+    """
+    Enables (or disables) the profiling of the phase-tagging functions. When enabled, the wall time and number of events of each stage
+    (reading, TOA construction, clock corrections, TDBs, posvels, phase evaluation, writing...) are recorded and saved in a JSON file next to each output file
+    ({output}.timing.json).
+    """
+    global _profiling_enabled
+    _profiling_enabled = enabled
+
+
+def _peak_rss_mb():
+    # Peak resident memory of the process (ru_maxrss is given in kB in Linux and in bytes in macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+class TaggingProfile:
+    """
+    A class to accumulate the wall time and number of events of the stages of the phase tagging of one file.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name, wall_time, nevents=None):
+        """
+        Adds the wall time (in seconds) and the number of events of a call of a stage.
+        """
+        entry = self.stages.setdefault(name, {"wall_time": 0.0, "calls": 0, "events": 0})
+        entry["wall_time"] += wall_time
+        entry["calls"] += 1
+        if nevents is not None:
+            entry["events"] += int(nevents)
+
+    def to_dict(self, nevents=None, output=None):
+        """
+        Summary of the profile, with the total and per-stage wall times, throughputs (events per second) and the peak resident memory of the process.
+        """
+        wall_time = time.perf_counter() - self.start
+        stages = {}
+        for name, entry in self.stages.items():
+            stages[name] = dict(entry)
+            if entry["events"] > 0 and entry["wall_time"] > 0:
+                stages[name]["events_per_s"] = entry["events"] / entry["wall_time"]
+
+        summary = {
+            "output": output,
+            "events": nevents,
+            "wall_time": wall_time,
+            "events_per_s": nevents / wall_time if nevents else None,
+            "peak_rss_mb": _peak_rss_mb(),
+            "stages": stages,
+        }
+        return summary
+
+
+@contextmanager
+def stage(name, nevents=None):
+    """
+    Context manager that records the wall time of a stage in the active profile. It does nothing if profiling is not enabled.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    nevents : int
+        Number of events processed in the stage
+    """
+    profile = _active_profile
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start, nevents)
+
+
+def start_profile():
+    """
+    Starts the profile of a file (if profiling is enabled). The stages run until finish_profile is called are added to it.
+    """
+    global _active_profile
+    _active_profile = TaggingProfile() if _profiling_enabled else None
+    return _active_profile
+
+
+def finish_profile(output_file, nevents=None):
+    """
+    Finishes the active profile and saves it as JSON next to the output file ({output_file}.timing.json).
+
+    Parameters
+    ----------
+    output_file : str
+        Output file of the phase tagging
+    nevents : int
+        Total number of events of the file
+
+    Returns
+    -------
+    dict
+        Summary of the profile (None if profiling is not enabled)
+    """
+    global _active_profile
+    profile = _active_profile
+    _active_profile = None
+    if profile is None:
+        return None
+
+    summary = profile.to_dict(
+        nevents=int(nevents) if nevents is not None else None, output=output_file
+    )
+    with open(str(output_file) + ".timing.json", "w") as f:
+        json.dump(summary, f, indent=1)
+
+    logger.info(
+        f"Processed {summary['events']} events in {summary['wall_time']:.2f} s "
+        f"(peak memory {summary['peak_rss_mb']:.0f} MB)"
+    )
+    return summary
+
+
+def aggregate_profiles(filenames, output=None):
+    """
+    Aggregates the profiles (JSON files written by finish_profile) of a batch of files.
+
+    Parameters
+    ----------
+    filenames : list
+        Profile files
+    output : str
+        If given, the aggregated profile is also saved in this JSON file
+
+    Returns
+    -------
+    dict
+        Total events and wall time (summed over the files), maximum peak memory and totals per stage, with their throughputs
+    """
+    total = {
+        "files": 0,
+        "events": 0,
+        "wall_time": 0.0,
+        "peak_rss_mb": 0.0,
+        "stages": {},
+    }
+    for filename in filenames:
+        with open(filename) as f:
+            profile = json.load(f)
+        total["files"] += 1
+        total["events"] += profile["events"] or 0
+        total["wall_time"] += profile["wall_time"]
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], profile["peak_rss_mb"])
+        for name, entry in profile["stages"].items():
+            stage_total = total["stages"].setdefault(
+                name, {"wall_time": 0.0, "calls": 0, "events": 0}
+            )
+            for key in ["wall_time", "calls", "events"]:
+                stage_total[key] += entry[key]
+
+    if total["wall_time"] > 0:
+        total["events_per_s"] = total["events"] / total["wall_time"]
+    for entry in total["stages"].values():
+        if entry["events"] > 0 and entry["wall_time"] > 0:
+            entry["events_per_s"] = entry["events"] / entry["wall_time"]
+        if total["wall_time"] > 0:
+            entry["fraction"] = entry["wall_time"] / total["wall_time"]
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(total, f, indent=1)
+
+    return total
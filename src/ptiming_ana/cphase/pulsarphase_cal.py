@@ -8,28 +8,53 @@
 
 import pandas as pd
 import os
+import copy
+import tempfile
 import numpy as np
 from astropy.time import Time
 from astropy.io import fits
 from pint.observatory.satellite_obs import get_satellite_observatory
 import pint.toa as toa
-from pint.fermi_toas import load_Fermi_TOAs
+from pint.fermi_toas import get_Fermi_TOAs
+from pint.observatory import get_observatory
+from pint.observatory.topo_obs import TopoObs
+import ptiming_ana.cphase.utils as utils
+from ptiming_ana.cphase.profiling import stage, start_profile, finish_profile
 from ptiming_ana.cphase.utils import (
+    create_toas,
     add_mjd,
     dl2time_totim,
     model_fromephem,
+    get_model_fromephem,
+    get_ephem_segments,
+    get_timing_model,
+    add_source_info_dl2,
+    run_batch,
+    get_phase_sidecar_name,
+    write_phase_sidecar,
+    remove_phase_sidecar,
 )
 from lstchain.io.io import dl2_params_lstcam_key
 
 import pint.models as models
+from pint.models.timing_model import TimingModel
 
-from gammapy.data import DataStore, EventList
-
-from pint.models import get_model
+from gammapy.data import DataStore, EventList, Observation, Observations
 
 import logging
 
-__all__ = ["fermi_calphase", "DL3_calphase_gammapy", "DL3_calphase", "DL2_calphase"]
+__all__ = [
+    "fermi_calphase",
+    "DL3_calphase_gammapy",
+    "calphase_events",
+    "calphase_observations",
+    "DL3_calphase",
+    "DL2_calphase",
+    "DL3_calphase_batch",
+    "DL2_calphase_batch",
+    "get_toas_from_times",
+    "audit_phases",
+]
 
 LOG_FORMAT = "%(asctime)2s %(levelname)-6s [%(name)3s] %(message)s"
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt="%Y-%m-%d %H:%M:%S")
@@ -38,23 +63,10 @@ logger = logging.getLogger(__name__)
 logging.getLogger("matplotlib.font_manager").disabled = True
 
 
-def update_fermi(timelist, ephem, t):
-    model = create_files(timelist, ephem, None, "model.par")
-
-    # Upload TOAs and model
-    m = models.get_model(model)
-
-    # Calculate the phases
-    logger.info("Calculating barycentric time and absolute phase")
-    bt = m.get_barycentric_toas(t)
-    p = m.phase(t, abs_phase=True)
-
-    return (bt, p)
-
-
 def fermi_calphase(file, ephem, output_dir, pickle=False, ft2_file=None):
     """
     Calculates barycentered times and pulsar phases from the DL2 dile using ephemeris.
+    The TOAs of all the photons are created at once and, for .gro ephemerides, the phases of the photons of each line of the ephemeris are computed together with its model.
 
     Parameters:
     -----------------
@@ -62,7 +74,7 @@ def fermi_calphase(file, ephem, output_dir, pickle=False, ft2_file=None):
     DL2 input file with the arrival times
 
     ephem: string
-    Ephemeris to be used (.txt file or similar)
+    Ephemeris to be used (.par or .gro file)
 
 
     output_dir:string
@@ -74,46 +86,51 @@ def fermi_calphase(file, ephem, output_dir, pickle=False, ft2_file=None):
 
     """
     logger.info("Input file:" + str(file))
+    start_profile()
     # Load observatory and TOAs
-    get_satellite_observatory("fermi", ft2_file, overwrite=True)
-    tl = load_Fermi_TOAs(file, fermiobs="fermi")
-
-    # Extract the timelist in MJD
-    timelist = []
-    for i in range(0, len(tl)):
-        timelist.append(tl[i].mjd.value)
-
-    # Create TOAs object
-    t = toa.get_TOAs_list(tl, planets=True)
-
-    # Calculate the phases in intervals of 1000 events so that ephemeris are updated
-    barycent_toas = []
-    phase = []
-    k = 0
-    for i in range(10000, len(t), 1000):
-        b, p = update_fermi(timelist[k:i], ephem, t[k:i])
-        barycent_toas = barycent_toas + list(b.value)
-        phase = phase + list(p.frac.value)
-        k = i
-
-    b, p = update_fermi(timelist[k:], ephem, t[k:])
-    barycent_toas = barycent_toas + list(b.value)
-    phase = phase + list(p.frac.value)
+    with stage("read"):
+        get_satellite_observatory("fermi", ft2_file, overwrite=True)
+    with stage("toas"):
+        t = get_Fermi_TOAs(
+            file, fermiobs="fermi", planets=True, include_bipm=True, include_gps=True
+        )
 
-    # Write if dir given
-    hdul = fits.open(file)
-    orig_cols = hdul[1].columns
-    new_col1 = fits.Column(name="BARYCENTRIC_TIME", format="D", array=barycent_toas)
-    new_col2 = fits.Column(name="PULSE_PHASE", format="D", array=phase)
-    hdu = fits.BinTableHDU.from_columns(orig_cols + new_col1 + new_col2)
+    # Times in MJD to select the lines of the ephemeris
+    timelist = t.get_mjds().value
+
+    if ephem.endswith(".gro"):
+        segments = get_ephem_segments(timelist, ephem)
+    else:
+        segments = [(get_timing_model(ephem), slice(None))]
+
+    # Calculate the phases of each segment of the ephemeris at once
+    barycent_toas = np.empty(len(t))
+    phase = np.empty(len(t))
+    for model, index in segments:
+        t_seg = t[index]
+        # Row of each TOA in the input file
+        rows = np.asarray(t_seg.table["index"])
+
+        logger.info("Calculating barycentric time and absolute phase")
+        with stage("phases", len(rows)):
+            barycent_toas[rows] = model.get_barycentric_toas(t_seg).value
+            phase[rows] = model.phase(t_seg, abs_phase=True).frac.value
 
+    # Write if dir given
     dir_output = (
         output_dir + str(os.path.basename(file).replace(".fits", "")) + "_pulsar.fits"
     )
 
-    logger.info("Writing outputfile in" + str(dir_output))
-    hdu.writeto(dir_output, overwrite=True)
+    # Memory mapping only takes effect for uncompressed files
+    with stage("write", len(t)), fits.open(file, memmap=True) as hdul:
+        write_pulsar_file(
+            hdul,
+            None,
+            {"BARYCENTRIC_TIME": barycent_toas, "PULSE_PHASE": phase},
+            dir_output,
+        )
 
+    finish_profile(dir_output, len(t))
     logger.info("Finished")
 
 
@@ -126,6 +143,7 @@ def DL3_calphase_gammapy(
     create_tim_file=False,
     pickle=False,
     overwrite=True,
+    jobs=1,
 ):
     """
     Function that reads the DL3 files and creates new EventLists with info about the PHASE of the pulsar.
@@ -153,6 +171,12 @@ def DL3_calphase_gammapy(
     pickle: boolean
     True if want to save a pickle file with the loaded TOAs
 
+    jobs: int
+    Number of processes used to analyze the observations in parallel
+
+    Returns:
+    ------------------
+    Dictionary with the error message of each observation that failed
 
     """
 
@@ -165,57 +189,192 @@ def DL3_calphase_gammapy(
     else:
         total_obs_list = obs_ids
 
-    observations = total_datastore.get_observations(
-        total_obs_list, required_irf="point-like"
+    tasks = [(int(obs_id),) for obs_id in sorted(total_obs_list)]
+
+    failures = run_batch(
+        DL3_calphase_observation,
+        tasks,
+        jobs=jobs,
+        DL3_direc=DL3_direc,
+        output_dir=output_dir,
+        ephem=ephem,
+        obs=obs,
+        create_tim_file=create_tim_file,
+        pickle=pickle,
+        overwrite=overwrite,
+    )[1]
+
+    return failures
+
+
+def DL3_calphase_observation(
+    obs_id,
+    DL3_direc,
+    output_dir,
+    ephem,
+    obs="lst",
+    create_tim_file=False,
+    pickle=False,
+    overwrite=True,
+):
+    """
+    Creates the new EventList with the PHASE of the pulsar for one observation of a DL3 directory (see DL3_calphase_gammapy).
+    """
+
+    datastore = DataStore.from_dir(DL3_direc)
+    obser = datastore.get_observations([obs_id], required_irf="point-like")[0]
+
+    # Calculate phases
+    new_event_list = calphase_events(
+        obser.events,
+        ephem,
+        obs=obs,
+        create_tim_file=create_tim_file,
+        pickle=pickle,
     )
 
-    # Extract times from EventList
-    for obser in observations:
-        times = obser.events.time
-        timelist = list(times.to_value("mjd", "long"))
+    # Write them in a dictionary
+    filename = f"dl3_pulsar_{obser.obs_id:04d}.fits.gz"
+    file_path = output_dir + filename
+
+    logger.info("Writing outputfile in " + str(file_path))
+    new_event_list.write(filename=file_path, gti=obser.gti, overwrite=overwrite)
+
+
+def calphase_events(
+    events,
+    ephem,
+    obs="lst",
+    use_interpolation=False,
+    n_interp=1000,
+    use_predictor=False,
+    interp_tolerance=None,
+    n_audit=None,
+    create_tim_file=False,
+    pickle=False,
+):
+    """
+    Calculates the pulsar phases of a gammapy EventList in memory, without writing or reading any file, so that the analysis can continue directly with the result.
+
+    Parameters:
+    ------------------
+    events: gammapy.data.EventList
+    Events to phase
+
+    ephem: string or TimingModel
+    Ephemeris to be used (.par or .gro file) or timing model
+
+    obs: string
+    Observatory code to give to PINT
+
+    use_interpolation: boolean
+    Set to True if want to use the interpolation method (faster but loses some precision)
+
+    n_interp: int
+    Number of events between two interpolation points.
+
+    use_predictor: boolean
+    Set to True if want to evaluate the phases with a polynomial phase predictor built for the whole night
+
+    interp_tolerance: float
+    Maximum phase error (in cycles) of the interpolation method. If given, the interpolation nodes are placed adaptively instead of every n_interp events
+
+    n_audit: int
+    Number of events whose phases are checked against the exact phases when the interpolation or the phase predictor are used (see audit_phases).
+    The maximum and RMS phase errors are saved in the metadata of the table
+
+    create_tim_file: boolean
+    Whether to create a temporal tim file to read and reduce TOAs with PINT or to build the TOAs in memory directly from the arrays of times (default).
+
+    pickle: boolean
+    True if want to save a pickle file with the loaded TOAs
+
+    Returns:
+    ------------------
+    New EventList sorted in time with two new columns: 'PHASE' (between 0 and 1) and 'BARYCENT_TIME' (MJD)
+
+    """
+    order = np.argsort(events.table["TIME"], kind="stable")
+    table = events.table[order]
+
+    phase = np.empty(0)
+    barycent_toas = np.empty(0)
+    if len(table) > 0:
+        times = events.time[order].utc.to_value("mjd", "long")
 
-        # Get the name of the files
         if create_tim_file:
-            timname = "times.tim"
+            tmp_dir = tempfile.TemporaryDirectory(prefix="ptiming_")
+            timname = os.path.join(tmp_dir.name, "times.tim")
         else:
             timname = None
 
-        parname = "model.par"
+        phase, barycent_toas = compute_phases_from_times(
+            times,
+            ephem,
+            timname,
+            obs,
+            use_interpolation,
+            n_interp,
+            pickle,
+            use_predictor,
+            interp_tolerance,
+        )
 
-        # Calculate phases
-        model = create_files(timelist, ephem, timname, parname, obs=obs)
-        if timname is None:
-            phases = compute_phases_from_times_model(times, model)[1]
-        else:
-            barycent_toas, phases = get_phase_list_from_tim(timname, model, pickle)
+        # Removing tim file
+        if create_tim_file:
+            tmp_dir.cleanup()
 
-        phases = phases.frac
+        if n_audit and (use_interpolation or use_predictor):
+            audit = audit_phases(
+                times, phase, ephem, obs, n_audit, tolerance=interp_tolerance
+            )
+            for key, (value, comment) in get_audit_header(audit).items():
+                table.meta[key] = value
 
-        # Shift phases
-        phases = np.where(phases < 0.0, phases + 1.0, phases)
+    # Shift phases
+    phase = np.where(phase < 0.0, phase + 1.0, phase)
 
-        # Create new EventList with the phases
-        table = obser.events.table
-        table["PHASE"] = phases.astype("float64")
-        table.sort("TIME")
+    table["PHASE"] = np.asarray(phase, dtype=np.float64)
+    table["BARYCENT_TIME"] = np.asarray(barycent_toas, dtype=np.float64)
 
-        new_event_list = EventList(table)
-        obser._events = new_event_list
+    return EventList(table)
 
-        # Write them in a dictionary
-        filename = f"dl3_pulsar_{obser.obs_id:04d}.fits.gz"
-        file_path = output_dir + filename
 
-        logger.info("Writing outputfile in " + str(file_path))
-        obser.events.write(filename=file_path, gti=obser.gti, overwrite=overwrite)
+def calphase_observations(observations, ephem, **kwargs):
+    """
+    Calculates the pulsar phases of the events of gammapy observations in memory (see calphase_events).
+    The input observations are not modified: the new observations share their IRFs and GTIs, and only the events are replaced.
 
-        # Removing tim file
-        if timname is not None:
-            os.remove(str(os.getcwd()) + "/" + timname)
+    Parameters:
+    ------------------
+    observations: gammapy.data.Observation or list of them (e.g. gammapy.data.Observations)
+    Observations to phase
+
+    ephem: string or TimingModel
+    Ephemeris to be used (.par or .gro file) or timing model
+
+    kwargs:
+    Options of calphase_events
 
-        # Removing .par file if it was created during execution
-        if ephem.endswith(".gro"):
-            os.remove(str(os.getcwd()) + "/" + parname)
+    Returns:
+    ------------------
+    Observation (if a single one was given) or gammapy.data.Observations with the phased events
+
+    """
+    single = isinstance(observations, Observation)
+    if single:
+        observations = [observations]
+
+    new_observations = []
+    for observation in observations:
+        logger.info(f"Calculating phases of observation {observation.obs_id}")
+        new_observation = copy.copy(observation)
+        new_observation._events = calphase_events(observation.events, ephem, **kwargs)
+        new_observations.append(new_observation)
+
+    if single:
+        return new_observations[0]
+    return Observations(new_observations)
 
 
 def DL3_calphase(
@@ -227,6 +386,10 @@ def DL3_calphase(
     use_interpolation=False,
     n_interp=1000,
     pickle=False,
+    chunk_size=None,
+    use_predictor=False,
+    interp_tolerance=None,
+    n_audit=None,
 ):
     """
     Function that reads the DL3 files, calculates the phases and create a new DL3 file. The new DL3 file will have two new columns: 'PHASE' and 'BAYCENT_TIME'.
@@ -254,167 +417,772 @@ def DL3_calphase(
     n_interp: int
     Number of events between two interpolation points.
 
-    Returns:
-    -------------------------
-    A new DL3 file with two new columns: 'PHASE' and 'BAYCENT_TIME'. The name of the file will be {filename}_pulsar.fits
+    chunk_size: int
+    Number of events per chunk. If given, the phases are computed and written to the output file chunk by chunk so that the memory used does not grow with the size of the file.
+
+    use_predictor: boolean
+    Set to True if want to evaluate the phases with a polynomial phase predictor built for the whole night (faster, with a precision given by the residuals of the predictor)
+
+    interp_tolerance: float
+    Maximum phase error (in cycles) of the interpolation method. If given, the interpolation nodes are placed adaptively instead of every n_interp events
+
+    n_audit: int
+    Number of events whose phases are checked against the exact phases computed with PINT when the interpolation or the phase predictor are used (see audit_phases).
+    The maximum and RMS phase errors are saved in the output. If None, the phases are not checked
+
+    Returns:
+    -------------------------
+    A new DL3 file with two new columns: 'PHASE' and 'BAYCENT_TIME'. The name of the file will be {filename}_pulsar.fits
+
+    """
+
+    if chunk_size is not None:
+        DL3_calphase_chunked(
+            file,
+            ephem,
+            output_dir,
+            chunk_size,
+            create_tim_file=create_tim_file,
+            obs=obs,
+            use_interpolation=use_interpolation,
+            n_interp=n_interp,
+            pickle=pickle,
+            use_predictor=use_predictor,
+            interp_tolerance=interp_tolerance,
+            n_audit=n_audit,
+        )
+        return
+
+    start_profile()
+
+    # Memory mapping only takes effect for uncompressed files
+    with stage("read"):
+        data = fits.open(file, memmap=True)
+        event_hdu = data[1]
+
+        # Events are written sorted in time through an index (the original records are not copied)
+        order = np.argsort(event_hdu.data["TIME"], kind="stable")
+
+        lst_epoch = Time(
+            event_hdu.header["MJDREFI"],
+            event_hdu.header["MJDREFF"],
+            format="mjd",
+            scale=event_hdu.header["TIMESYS"].lower(),
+        )
+        time = event_hdu.data["TIME"][order] + lst_epoch.to_value(format="unix")
+        times = Time(time, format="unix").to_value("mjd", "long")
+
+    if create_tim_file:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="ptiming_")
+        timname = os.path.join(
+            tmp_dir.name, str(os.path.basename(file).replace(".fits", "")) + ".tim"
+        )
+    else:
+        timname = None
+
+    # Calculate phases
+    phase, barycent_toas = compute_phases_from_times(
+        times,
+        ephem,
+        timname,
+        obs,
+        use_interpolation,
+        n_interp,
+        pickle,
+        use_predictor,
+        interp_tolerance,
+    )
+
+    # Check the precision of the approximate phases
+    header_keys = None
+    if n_audit and (use_interpolation or use_predictor):
+        audit = audit_phases(
+            times, phase, ephem, obs, n_audit, tolerance=interp_tolerance
+        )
+        header_keys = get_audit_header(audit)
+
+    # Shift phases
+    phase = np.where(phase < 0.0, phase + 1.0, phase)
+
+    # Save new file
+    output_file = get_DL3_output_name(file, output_dir)
+    with stage("write", len(order)):
+        write_pulsar_file(
+            data,
+            order,
+            {"PHASE": phase, "BARYCENT_TIME": barycent_toas},
+            output_file,
+            header_keys=header_keys,
+        )
+    data.close()
+
+    finish_profile(output_file, len(order))
+
+    # Removing tim file
+    if create_tim_file:
+        tmp_dir.cleanup()
+
+
+def DL3_calphase_batch(
+    filelist,
+    ephem,
+    output_dir,
+    create_tim_file=False,
+    obs="lst",
+    use_interpolation=False,
+    n_interp=1000,
+    pickle=False,
+    chunk_size=None,
+    use_predictor=False,
+    interp_tolerance=None,
+    jobs=1,
+    n_audit=None,
+):
+    """
+    Runs DL3_calphase over a list of DL3 files, optionally in parallel. The files are processed in sorted order and a failure in one file does not stop the rest.
+
+    Parameters:
+    ------------------
+    filelist: list
+    List of paths to the DL3 files
+
+    jobs: int
+    Number of processes used to analyze the files in parallel
+
+    The rest of the parameters are the same as in DL3_calphase.
+
+    Returns:
+    ------------------
+    Dictionary with the error message of each file that failed
+
+    """
+
+    tasks = [(file,) for file in sorted(filelist)]
+
+    failures = run_batch(
+        DL3_calphase,
+        tasks,
+        jobs=jobs,
+        ephem=ephem,
+        output_dir=output_dir,
+        create_tim_file=create_tim_file,
+        obs=obs,
+        use_interpolation=use_interpolation,
+        n_interp=n_interp,
+        pickle=pickle,
+        chunk_size=chunk_size,
+        use_predictor=use_predictor,
+        interp_tolerance=interp_tolerance,
+        n_audit=n_audit,
+    )[1]
+
+    return failures
+
+
+def DL3_calphase_chunked(
+    file,
+    ephem,
+    output_dir,
+    chunk_size,
+    create_tim_file=False,
+    obs="lst",
+    use_interpolation=False,
+    n_interp=1000,
+    pickle=False,
+    use_predictor=False,
+    interp_tolerance=None,
+    n_audit=None,
+):
+    """
+    Same as DL3_calphase, but the phases are computed and written in chunks of events so that the peak memory does not depend on the size of the file.
+    Only the TIME column and the sorting index are kept in memory for the whole file. Each chunk of sorted events is written directly to the output file.
+    This only holds for uncompressed files: the events of a compressed file (e.g. .fits.gz) cannot be memory mapped, so the whole table is decompressed in memory.
+
+    Parameters:
+    ------------------
+    file: string
+    path to the DL3 file in a .fits format
+
+    ephem: string
+    path to the ephemeris file. It can be a .par file or a .gro file (for the case of Crab)
+
+    output_dir: string
+    path to the output directory where to store the modified DL3 file
+
+    chunk_size: int
+    Number of events per chunk
+
+    create_tim_file: boolean
+    Set to True if want to create a .tim file for each chunk
+
+    obs: string
+    Observatory code to give to PINT
+
+    use_interpolation: boolean
+    Set to True if want to use the interpolation method (faster but loses some precision)
+
+    n_interp: int
+    Number of events between two interpolation points.
+
+    pickle: boolean
+    True if want to save a pickle file with the loaded TOAs
+
+    use_predictor: boolean
+    Set to True if want to evaluate the phases with a polynomial phase predictor built for the whole night
+
+    interp_tolerance: float
+    Maximum phase error (in cycles) of the interpolation method. If given, the interpolation nodes are placed adaptively instead of every n_interp events
+
+    n_audit: int
+    Number of events whose phases are checked against the exact phases computed with PINT when the interpolation or the phase predictor are used (see audit_phases).
+    The maximum and RMS phase errors are saved in the output. If None, the phases are not checked
+
+    """
+    if chunk_size < 1:
+        raise ValueError("The chunk size must be a positive number of events")
+
+    output_file = get_DL3_output_name(file, output_dir)
+    start_profile()
+
+    # Memory mapping only takes effect for uncompressed files
+    data = fits.open(file, memmap=True)
+    event_hdu = data[1]
+    if data.fileinfo(0)["file"].compression is not None:
+        logger.warning(
+            "Compressed input file: the whole event table is loaded in memory, the chunks only bound the memory of the phase computation"
+        )
+
+    # Raw (big-endian) records as stored in the file
+    raw_events = event_hdu.data.view(np.ndarray)
+    order = np.argsort(event_hdu.data["TIME"], kind="stable")
+
+    lst_epoch = Time(
+        event_hdu.header["MJDREFI"],
+        event_hdu.header["MJDREFF"],
+        format="mjd",
+        scale=event_hdu.header["TIMESYS"].lower(),
+    )
+
+    # Header and records of the output table with the two new columns (this also checks that there are no variable-length columns)
+    header, record_dtype = get_pulsar_table_header(event_hdu)
+
+    # The audit keywords are written with placeholder values and updated at the end, when the audit of all the chunks is known
+    audit = n_audit and (use_interpolation or use_predictor)
+    if audit:
+        header.update(get_audit_header(combine_audits([])))
+        audits = []
+
+    if create_tim_file:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="ptiming_")
+        timname = os.path.join(
+            tmp_dir.name, str(os.path.basename(file).replace(".fits", "")) + ".tim"
+        )
+    else:
+        timname = None
+
+    logger.info("Writing outputfile in" + str(output_file))
+    fits.PrimaryHDU(header=data[0].header, data=data[0].data).writeto(
+        output_file, overwrite=True
+    )
+    stream = fits.StreamingHDU(output_file, header)
+
+    nevents = len(order)
+    for start in range(0, nevents, chunk_size):
+        logger.info(
+            f"Processing events {start}-{min(start + chunk_size, nevents)} of {nevents}"
+        )
+        index = order[start : start + chunk_size]
+        with stage("read", len(index)):
+            records = np.empty(len(index), dtype=record_dtype)
+            for name in raw_events.dtype.names:
+                records[name] = raw_events[name][index]
+
+            time = event_hdu.data["TIME"][index] + lst_epoch.to_value(format="unix")
+            times = Time(time, format="unix").to_value("mjd", "long")
+
+        phase, barycent_toas = compute_phases_from_times(
+            times,
+            ephem,
+            timname,
+            obs,
+            use_interpolation,
+            n_interp,
+            pickle,
+            use_predictor,
+            interp_tolerance,
+        )
+        if audit:
+            # Each chunk checks its share of the events of the audit
+            audits.append(
+                audit_phases(
+                    times,
+                    phase,
+                    ephem,
+                    obs,
+                    int(np.ceil(n_audit * len(index) / nevents)),
+                    tolerance=interp_tolerance,
+                )
+            )
+
+        records["PHASE"] = np.where(phase < 0.0, phase + 1.0, phase)
+        records["BARYCENT_TIME"] = barycent_toas
+
+        with stage("write", len(index)):
+            stream.write(records.view(np.uint8))
+
+    stream.close()
+
+    # Copy the rest of HDUs (GTI, pointing...)
+    with stage("write"):
+        for hdu in data[2:]:
+            fits.append(output_file, hdu.data, hdu.header)
+
+    data.close()
+
+    if audit:
+        # The header keeps its size, so it is updated in place
+        with fits.open(output_file, mode="update") as hdul:
+            hdul[1].header.update(get_audit_header(combine_audits(audits)))
+
+    finish_profile(output_file, nevents)
+
+    # Removing tim file
+    if create_tim_file:
+        tmp_dir.cleanup()
+
+
+def get_DL3_output_name(orig_file, output_dir):
+    output_file = (
+        output_dir
+        + str(os.path.basename(orig_file).replace(".fits", ""))
+        + "_pulsar.fits"
+    )
+
+    if not os.path.exists(output_dir):
+        logger.info("Creating directory: " + output_dir)
+        os.makedirs(output_dir)
+
+    return output_file
+
+
+def get_pulsar_table_header(event_hdu, new_columns=("PHASE", "BARYCENT_TIME")):
+    """
+    Creates the header and the record data type of the event table of a pulsar file, i.e. the original ones with the new (double precision) columns appended.
+
+    Parameters:
+    -----------------
+    event_hdu: astropy.io.fits.BinTableHDU
+    Event table of the original file
+
+    new_columns: list
+    Names of the columns to append
+
+    Returns:
+    -----------------
+    Header and numpy data type (big-endian, as stored in the FITS file) of the new event table
+
+    """
+    if any(col.format.startswith(("P", "Q")) for col in event_hdu.columns):
+        raise ValueError("Variable-length columns cannot be streamed to the output file")
+
+    header = event_hdu.header.copy()
+    for key in ["CHECKSUM", "DATASUM"]:
+        header.remove(key, ignore_missing=True)
+    nfields = header["TFIELDS"]
+    for i, name in enumerate(new_columns, start=nfields + 1):
+        header["TTYPE" + str(i)] = name
+        header["TFORM" + str(i)] = "D"
+    header["TFIELDS"] = nfields + len(new_columns)
+    header["NAXIS1"] = header["NAXIS1"] + 8 * len(new_columns)
+
+    raw_dtype = event_hdu.data.dtype
+    record_dtype = np.dtype(
+        [(name, raw_dtype.fields[name][0]) for name in raw_dtype.names]
+        + [(name, ">f8") for name in new_columns]
+    )
+
+    return header, record_dtype
+
+
+def write_pulsar_file(data, order, new_columns, output_file, header_keys=None):
+    """
+    Writes a pulsar file from an opened original file in one pass: the primary HDU, the event table (optionally sorted with the given index) with
+    the new columns appended, and the rest of HDUs (GTI, pointing...).
+    The original records are copied once, directly into the output records, so the memory used stays close to one copy of the event table.
+
+    Parameters:
+    -----------------
+    data: astropy.io.fits.HDUList
+    Original file (the event table is the first extension). It should be opened with memmap=True so that the records are not loaded in memory before
+
+    order: array
+    Index that sorts the events (e.g. in time). If None, the events are kept in the original order
+
+    new_columns: dict
+    Arrays of the columns to append (in the order of the output events), by name
+
+    output_file: string
+    Path of the output file
+
+    header_keys: dict
+    Keywords to add to the header of the event table, as {key: (value, comment)}
+
+    """
+    event_hdu = data[1]
+    header, record_dtype = get_pulsar_table_header(event_hdu, list(new_columns))
+    if header_keys is not None:
+        header.update(header_keys)
+
+    # Raw (big-endian) records as stored in the file
+    raw_events = event_hdu.data.view(np.ndarray)
+    records = np.empty(len(raw_events) if order is None else len(order), dtype=record_dtype)
+    for name in raw_events.dtype.names:
+        if order is None:
+            records[name] = raw_events[name]
+        else:
+            np.take(raw_events[name], order, axis=0, out=records[name])
+    for name, values in new_columns.items():
+        records[name] = values
+
+    logger.info("Writing outputfile in" + str(output_file))
+    fits.PrimaryHDU(header=data[0].header, data=data[0].data).writeto(
+        output_file, overwrite=True
+    )
+    stream = fits.StreamingHDU(output_file, header)
+    if len(records) > 0:
+        stream.write(records.view(np.uint8))
+    stream.close()
+
+    # Copy the rest of HDUs (GTI, pointing...)
+    for hdu in data[2:]:
+        fits.append(output_file, hdu.data, hdu.header)
+
+
+def save_new_DL3_file(orig_file, new_table, output_dir):
+    data = fits.open(orig_file)
+    # orig_table = data[1].data
+    # orig_cols = orig_table.columns
+
+    tables = []
+    for d in data:
+        tables.append(d)
+
+    hdu_list = fits.HDUList([tables[0], new_table] + tables[2:])
+    output_file = get_DL3_output_name(orig_file, output_dir)
+
+    logger.info("Writing outputfile in" + str(output_file))
+    hdu_list.writeto(output_file, overwrite=True)
+
+
+def get_toas_from_times(
+    times, obs="lst", include_planets=True, include_bipm=True, include_gps=True
+):
+    """
+    Creates the PINT TOAs object directly from an array of arrival times, without building one TOA object per event.
+
+    Parameters:
+    -----------------
+    times: array, list or astropy.time.Time
+    Times of arrival. If not given as a Time object, they are interpreted as MJDs (long double precision is kept)
+
+    obs: string
+    Observatory code to give to PINT
+
+    include_planets: boolean
+    True if want to compute the positions of the planets (needed for the Shapiro delay)
+
+    include_bipm: boolean
+    True if want to apply the BIPM clock correction
+
+    include_gps: boolean
+    True if want to apply the GPS clock correction
+
+    Returns:
+    --------
+    PINT TOAs object with clock corrections, TDBs and posvels computed.
+
+    If the observatory cache is enabled (see set_observatory_cache), the TOAs of ground-based observatories are built by interpolating the quantities
+    precomputed for the whole night, so the expensive astrometry is only done once per night and site.
+
+    """
+    if not isinstance(times, Time):
+        times = np.asarray(times, dtype=np.longdouble)
+
+    if (
+        utils._observatory_cache_enabled
+        and (not isinstance(times, Time) or times.scale == "utc")
+        and isinstance(get_observatory(obs), TopoObs)
+    ):
+        from ptiming_ana.cphase.observatory_cache import get_observatory_cache
+
+        try:
+            cache = get_observatory_cache(
+                times,
+                obs=obs,
+                include_planets=include_planets,
+                include_bipm=include_bipm,
+                include_gps=include_gps,
+            )
+        except ValueError as e:
+            logger.warning(f"Observatory cache not used: {e}")
+        else:
+            return cache.get_toas(times)
+
+    # Same steps as pint.toa.get_TOAs_array (the TOAs are identical), done one by one to profile them
+    n = len(np.atleast_1d(times))
+    with stage("toas", n):
+        t = create_toas(times, obs)
+    with stage("clock_corrections", n):
+        t.apply_clock_corrections(include_gps=include_gps, include_bipm=include_bipm)
+    with stage("tdb", n):
+        t.compute_TDBs(ephem="DE421")
+    with stage("posvels", n):
+        t.compute_posvels("DE421", include_planets)
+
+    return t
+
+
+def compute_phases_from_times_model(
+    times, ephem, obs="lst", include_planets=True, include_bipm=True, include_gps=True
+):
+    # Read model
+    model = get_timing_model(ephem)
+
+    # Load TOAs
+    t = get_toas_from_times(
+        times,
+        obs=obs,
+        include_planets=include_planets,
+        include_bipm=include_bipm,
+        include_gps=include_gps,
+    )
+
+    # Compute phases and barycentric toas
+    with stage("phases", len(np.atleast_1d(times))):
+        phases = model.phase(t, abs_phase=True)
+        barycent_toas = model.get_barycentric_toas(t)
+
+    return (barycent_toas, phases)
+
+
+def compute_phases_from_times(
+    times,
+    ephem,
+    timname,
+    obs="lst",
+    use_interpolation=False,
+    n_interp=1000,
+    pickle=False,
+    use_predictor=False,
+    interp_tolerance=None,
+):
+    """
+    Calculates the pulsar phases and barycentered times of a set of arrival times.
+    If a .gro ephemeris is given, the times are split according to the validity intervals of the ephemeris and each part is phased with its own model.
+
+    Parameters:
+    -----------------
+    times: array or astropy.time.Time
+    Times of arrival in MJD
+
+    ephem: string or TimingModel
+    Ephemeris to be used (.par or .gro file) or timing model
+
+    timname: string
+    Name of the .tim file. If None, the TOAs are built in memory
+
+    obs: string
+    Observatory code to give to PINT
+
+    use_interpolation: boolean
+    Set to True if want to use the interpolation method (faster but loses some precision)
+
+    n_interp: int
+    Number of events between two interpolation points.
+
+    pickle: boolean
+    True if want to save a pickle file with the loaded TOAs
 
-    """
+    use_predictor: boolean
+    Set to True if want to evaluate the phases with a polynomial phase predictor built for the whole night (see PhasePredictor)
 
-    data = fits.open(file)
-    orig_table = data[1].data
-    orig_cols = orig_table.columns
+    interp_tolerance: float
+    Maximum phase error (in cycles) of the interpolation method. If given, the interpolation nodes are placed adaptively instead of every n_interp events
 
-    # Extract the times from the dataframe and transform scales
-    df = pd.DataFrame(data[1].data)
-    df = df.sort_values("TIME")
+    Returns:
+    --------
+    Fractional phases (between -0.5 and 0.5) and barycentered times in MJD
 
-    lst_epoch = Time(
-        data[1].header["MJDREFI"],
-        data[1].header["MJDREFF"],
-        format="mjd",
-        scale=data[1].header["TIMESYS"].lower(),
-    )
-    time_orig = df["TIME"]
+    """
+    if use_predictor:
+        from ptiming_ana.cphase.phase_predictor import get_phase_predictor
+
+        logger.info("Using phase predictor...")
+        with stage("predictor"):
+            predictor = get_phase_predictor(times, ephem, obs=obs)
+        with stage("phases", len(times)):
+            return predictor.evaluate(times)
+
+    if isinstance(ephem, str) and ephem.endswith(".gro"):
+        if isinstance(times, Time):
+            segments = get_ephem_segments(times.mjd, ephem)
+        else:
+            segments = get_ephem_segments(times, ephem)
+    else:
+        segments = [(ephem, slice(None))]
+
+    if len(segments) == 1:
+        return compute_phases_from_times_segment(
+            times,
+            segments[0][0],
+            timname,
+            obs,
+            use_interpolation,
+            n_interp,
+            pickle,
+            interp_tolerance,
+        )
 
-    time = time_orig + lst_epoch.to_value(format="unix")
-    times = Time(time, format="unix").to_value("mjd", "long")
-    timelist = list(times)
+    # The times span several lines of the ephemeris: each slice is phased with its own model
+    logger.info(f"Times span {len(segments)} ephemeris intervals")
+    phase = np.empty(len(times), dtype=np.longdouble)
+    barycent_toas = np.empty(len(times), dtype=np.longdouble)
+    for model, index in segments:
+        phase[index], barycent_toas[index] = compute_phases_from_times_segment(
+            times[index],
+            model,
+            timname,
+            obs,
+            use_interpolation,
+            n_interp,
+            pickle,
+            interp_tolerance,
+        )
 
-    if create_tim_file:
-        timname = str(os.path.basename(file).replace(".fits", "")) + ".tim"
-    else:
-        timname = None
+    return (phase, barycent_toas)
 
-    # Get the name of the files
-    parname = str(os.path.basename(file).replace(".fits", "")) + ".par"
 
-    # Calculate phases
+def compute_phases_from_times_segment(
+    times, model, timname, obs, use_interpolation, n_interp, pickle, interp_tolerance
+):
+    # Phases of a set of times using a single timing model (.par file or TimingModel)
     if not use_interpolation:
-        model = create_files(timelist, ephem, timname, parname, obs=obs)
+        model = create_files(times, model, timname, obs=obs)
         if timname is None:
-            barycent_toas, phases = compute_phases_from_times_model(times, model)
+            barycent_toas, phases = compute_phases_from_times_model(
+                times, model, obs=obs
+            )
         else:
             logger.info("Computing phases from tim and par files")
-            barycent_toas, phases = get_phase_list_from_tim(timname, model, pickle)
+            with stage("tim_file", len(times)):
+                barycent_toas, phases = get_phase_list_from_tim(timname, model, pickle)
 
         phase = phases.frac
     else:
         logger.info("Using interpolation...")
         phase, barycent_toas = compute_phase_interpolation(
-            times, ephem, timname, parname, n_interp, obs, pickle
+            times, model, timname, None, n_interp, obs, pickle, interp_tolerance
         )
 
-    # Shift phases
-    phase = np.where(phase < 0.0, phase + 1.0, phase)
-
-    # Generate needed columns
-    cols_list = []
-    for j in range(0, len(orig_cols)):
-        try:
-            cols_list.append(
-                fits.Column(
-                    name=orig_cols[j].name,
-                    format=orig_cols[j].format,
-                    unit=orig_cols[j].unit,
-                    array=df[orig_cols[j].name],
-                )
-            )
+    return (np.asarray(phase), np.asarray(barycent_toas))
 
-        except AttributeError:
-            cols_list.append(
-                fits.Column(
-                    name=orig_cols[j].name,
-                    format=orig_cols[j].format,
-                    array=df[orig_cols[j].name],
-                )
-            )
 
-    orig_cols_sorted = fits.ColDefs(cols_list)
+def audit_phases(times, phase, ephem, obs="lst", n_audit=100, seed=None, tolerance=None):
+    """
+    Checks the precision of approximate (interpolated or predicted) phases. The exact phases are computed with PINT for a stratified random subsample of the events
+    (the events sorted in time are split in n_audit groups of consecutive events and one event is drawn from each group), so that the whole time range is covered
+    at the cost of phasing only n_audit events.
 
-    # New columns to add to the DL3 files
-    new_cols = fits.ColDefs(
-        [
-            fits.Column(name="PHASE", format="D", array=phase),
-            fits.Column(name="BARYCENT_TIME", format="D", array=barycent_toas),
-        ]
-    )
+    Parameters:
+    -----------------
+    times: array
+    Times of arrival in MJD
 
-    # Create the files
-    hdu = fits.BinTableHDU.from_columns(
-        orig_cols_sorted + new_cols, header=data[1].header
-    )
+    phase: array
+    Approximate phases of the events (in cycles)
 
-    # Save new file
-    save_new_DL3_file(file, hdu, output_dir)
+    ephem: string or TimingModel
+    Ephemeris used to compute the phases (.par or .gro file) or timing model
 
-    # Removing tim file
-    if create_tim_file:
-        os.remove(str(os.getcwd()) + "/" + timname)
+    obs: string
+    Observatory code to give to PINT
 
-    # Removing .par file if it was created during execution
-    if ephem.endswith(".gro"):
-        os.remove(str(os.getcwd()) + "/" + parname)
+    n_audit: int
+    Number of events to check
 
+    seed: int
+    Seed of the random generator used to draw the events
 
-def save_new_DL3_file(orig_file, new_table, output_dir):
-    data = fits.open(orig_file)
-    # orig_table = data[1].data
-    # orig_cols = orig_table.columns
+    tolerance: float
+    Expected maximum phase error (in cycles). If given, a warning is logged when the audited error is larger
 
-    tables = []
-    for d in data:
-        tables.append(d)
+    Returns:
+    -----------------
+    Dictionary with the number of events checked ('n_audit') and the maximum and RMS phase errors in cycles ('max_error', 'rms_error')
 
-    hdu_list = fits.HDUList([tables[0], new_table] + tables[2:])
-    output_file = (
-        output_dir
-        + str(os.path.basename(orig_file).replace(".fits", ""))
-        + "_pulsar.fits"
+    """
+    times = np.asarray(times, dtype=np.longdouble)
+    n_audit = min(int(n_audit), len(times))
+    if n_audit < 1:
+        return {"n_audit": 0, "max_error": 0.0, "rms_error": 0.0}
+
+    with stage("audit", n_audit):
+        order = np.argsort(times, kind="stable")
+        edges = np.linspace(0, len(times), n_audit + 1).astype(int)
+        rng = np.random.default_rng(seed)
+        index = order[rng.integers(edges[:-1], edges[1:])]
+
+        exact_phase = compute_phases_from_times(times[index], ephem, None, obs)[0]
+
+        # Differences are wrapped so that phases shifted by a whole cycle (e.g. to [0, 1)) are not counted as errors
+        error = np.asarray(phase, dtype=np.longdouble)[index] - exact_phase
+        error = np.asarray(error - np.round(error), dtype=np.float64)
+
+    audit = {
+        "n_audit": n_audit,
+        "max_error": float(np.max(np.abs(error))),
+        "rms_error": float(np.sqrt(np.mean(error**2))),
+    }
+    logger.info(
+        f"Phase audit of {n_audit} events: maximum error {audit['max_error']:.2e}, RMS error {audit['rms_error']:.2e} cycles"
     )
+    if tolerance is not None and audit["max_error"] > tolerance:
+        logger.warning(
+            f"The maximum phase error of the audit ({audit['max_error']:.2e}) is above the tolerance ({tolerance:.2e})"
+        )
+    return audit
 
-    logger.info("Writing outputfile in" + str(output_file))
-    if not os.path.exists(output_dir):
-        logger.info("Creating directory: " + output_dir)
-        os.makedirs(output_dir)
-
-    hdu_list.writeto(output_file, overwrite=True)
-
-
-def compute_phases_from_times_model(
-    times, ephem, obs="lst", include_planets=True, include_bipm=True, include_gps=True
-):
-    # Read model
-    model = get_model(ephem)
 
-    # Get TOA list
-    toa_list = list(
-        toa.TOA(
-            t,
-            0,
-            obs=obs,
-            ephem="DE421",
-            include_bipm=str(include_bipm),
-            include_gps=str(include_gps),
-        )
-        for t in times
-    )
-    # Load TOAs
-    t = toa.get_TOAs_list(
-        toa_list,
-        ephem="DE421",
-        include_gps=include_gps,
-        include_bipm=include_bipm,
-        planets="True",
-    )
+def combine_audits(audits):
+    """
+    Combines the results of audit_phases of several chunks of a file into the result of the whole file.
+    """
+    n_audit = sum(audit["n_audit"] for audit in audits)
+    if n_audit == 0:
+        return {"n_audit": 0, "max_error": 0.0, "rms_error": 0.0}
+
+    return {
+        "n_audit": n_audit,
+        "max_error": max(audit["max_error"] for audit in audits),
+        "rms_error": float(
+            np.sqrt(
+                sum(audit["n_audit"] * audit["rms_error"] ** 2 for audit in audits)
+                / n_audit
+            )
+        ),
+    }
 
-    # Compute phases and barycentric toas
-    phases = model.phase(t, abs_phase=True)
-    barycent_toas = model.get_barycentric_toas(t)
 
-    return (barycent_toas, phases)
+def get_audit_header(audit):
+    # Header keywords of the event table with the result of the phase audit
+    return {
+        "PHAUDITN": (audit["n_audit"], "Events checked in the phase precision audit"),
+        "PHERRMAX": (audit["max_error"], "Max phase error of the audited events (cycles)"),
+        "PHERRRMS": (audit["rms_error"], "RMS phase error of the audited events (cycles)"),
+    }
 
 
-def create_files(timelist, ephem, timname, parname, obs="lst"):
+def create_files(timelist, ephem, timname, parname=None, obs="lst"):
     """
     Creates the .tim and .par file needed for the use of PINT.
 
@@ -423,14 +1191,18 @@ def create_files(timelist, ephem, timname, parname, obs="lst"):
     timelist: list
     Times of obervation in MJD
 
-    ephem: string
-    Ephemeris to be used (.par or .gro). If given .par it will not create a new model.
+    ephem: string or TimingModel
+    Ephemeris to be used (.par or .gro) or timing model. If given .par or a model it will not create a new one.
 
     timname:string
     Name of the output timfile
 
     parname: string
-    Name of the output parfile
+    Name of the output parfile. If None, the model created from a .gro file is only kept in memory
+
+    Returns:
+    --------
+    Name of the .par file given as ephemeris or TimingModel created from the .gro file
 
     """
 
@@ -439,19 +1211,33 @@ def create_files(timelist, ephem, timname, parname, obs="lst"):
         dl2time_totim(timelist, name=timname, obs=obs)
 
     logger.info("Setting the .par file")
-    if ephem.endswith(".par"):
+    if isinstance(ephem, TimingModel) or ephem.endswith(".par"):
         model = ephem
 
     elif ephem.endswith(".gro"):
-        logger.info("No .par file given. Creating .par file from .gro file...")
-        # Create model from ephemeris
-        model = model_fromephem(timelist, ephem, parname)
+        logger.info("No .par file given. Creating model from .gro file...")
+        # Create model from ephemeris (cached between calls)
+        model = get_model_fromephem(timelist, ephem)
+        if parname is not None:
+            with open(parname, "w+") as f:
+                f.write(model.as_parfile())
 
     return model
 
 
 def DL2_calphase(
-    dl2file, ephem, obs="lst", use_interpolation=False, n_interp=1000, pickle=False
+    dl2file,
+    ephem,
+    obs="lst",
+    use_interpolation=False,
+    n_interp=1000,
+    pickle=False,
+    chunk_size=None,
+    use_predictor=False,
+    interp_tolerance=None,
+    create_tim_file=False,
+    n_audit=None,
+    sidecar=False,
 ):
     """
     Calculates barycentered times and pulsar phases from the DL2 dile using ephemeris.
@@ -476,40 +1262,86 @@ def DL2_calphase(
     n_interp: int
     Number of events between two interpolation points.
 
+    chunk_size: int
+    Number of events per chunk. If given, the phases are computed and appended to the 'phase_info' table chunk by chunk so that the memory used does not grow with the size of the file.
+
+    use_predictor: boolean
+    Set to True if want to evaluate the phases with a polynomial phase predictor built for the whole night (faster, with a precision given by the residuals of the predictor)
+
+    interp_tolerance: float
+    Maximum phase error (in cycles) of the interpolation method. If given, the interpolation nodes are placed adaptively instead of every n_interp events
+
+    n_audit: int
+    Number of events whose phases are checked against the exact phases computed with PINT when the interpolation or the phase predictor are used (see audit_phases).
+    The maximum and RMS phase errors are saved in the output. If None, the phases are not checked
+
+    create_tim_file: boolean
+    Whether to create a temporal tim file to read and reduce TOAs with PINT or to build the TOAs in memory directly from the arrays of times (default, much faster).
+
+    sidecar: boolean
+    If True, the phases are written to a Parquet file next to the DL2 file ({name}.phase.parquet, see write_phase_sidecar) instead of the 'phase_info' table, so the DL2 file is not modified
+
     Returns:
     --------
     Returns same DL2 with a new table (key='phase_info')  with the phase information.
 
     """
 
+    if chunk_size is not None:
+        DL2_calphase_chunked(
+            dl2file,
+            ephem,
+            chunk_size,
+            obs=obs,
+            use_interpolation=use_interpolation,
+            n_interp=n_interp,
+            pickle=pickle,
+            use_predictor=use_predictor,
+            interp_tolerance=interp_tolerance,
+            n_audit=n_audit,
+            create_tim_file=create_tim_file,
+            sidecar=sidecar,
+        )
+        return
+
     # Read the file
     logger.info("Input file:" + str(dl2file))
-    df_i = pd.read_hdf(dl2file, key=dl2_params_lstcam_key, float_precision=20)
-    add_mjd(df_i)
-
-    # Create the .tim file
-    timelist = df_i.mjd_time.tolist()
+    start_profile()
+    with stage("read"):
+        df_i = pd.read_hdf(dl2file, key=dl2_params_lstcam_key, float_precision=20)
+        times = np.asarray(add_mjd(df_i), dtype=np.longdouble)
 
-    # Name of the files
-    timname = str(os.path.basename(dl2file).replace(".h5", "")) + ".tim"
-    parname = str(os.path.basename(dl2file).replace(".h5", "")) + ".par"
-
-    if not use_interpolation:
-        model = create_files(timelist, ephem, timname, parname, obs=obs)
-        barycent_toas, phase = get_phase_list_from_tim(timname, model, pickle)
-        phase = phase.frac
-    else:
-        logger.info("Interpolating...")
-        phase, barycent_toas = compute_phase_interpolation(
-            timelist, ephem, timname, parname, n_interp, obs, pickle
+    if create_tim_file:
+        # Name of the .tim file (in a private temporary directory)
+        tmp_dir = tempfile.TemporaryDirectory(prefix="ptiming_")
+        timname = os.path.join(
+            tmp_dir.name, str(os.path.basename(dl2file).replace(".h5", "")) + ".tim"
         )
+    else:
+        timname = None
+
+    phase, barycent_toas = compute_phases_from_times(
+        times,
+        ephem,
+        timname,
+        obs,
+        use_interpolation,
+        n_interp,
+        pickle,
+        use_predictor,
+        interp_tolerance,
+    )
 
     # Removing tim file
-    os.remove(str(os.getcwd()) + "/" + timname)
+    if create_tim_file:
+        tmp_dir.cleanup()
 
-    # Removing .par file if it was created during execution
-    if ephem.endswith(".gro"):
-        os.remove(str(os.getcwd()) + "/" + parname)
+    # Check the precision of the approximate phases
+    audit = None
+    if n_audit and (use_interpolation or use_predictor):
+        audit = audit_phases(
+            times, phase, ephem, obs, n_audit, tolerance=interp_tolerance
+        )
 
     # Create new dataframe:
     df_phase = pd.DataFrame(
@@ -520,12 +1352,279 @@ def DL2_calphase(
             "pulsar_phase": phase,
         }
     )
-    df_phase.to_hdf(dl2file, key="phase_info")
+    output_file = get_phase_sidecar_name(dl2file) if sidecar else dl2file
+    with stage("write", len(df_phase)):
+        if sidecar:
+            write_phase_sidecar(
+                df_phase,
+                output_file,
+                metadata=None if audit is None else {"phase_audit": audit},
+            )
+        else:
+            remove_phase_sidecar(dl2file)
+            df_phase.to_hdf(dl2file, key="phase_info")
+            if audit is not None:
+                # The result of the audit is kept as metadata of the phase table
+                with pd.HDFStore(dl2file, mode="a") as store:
+                    store.get_storer("phase_info").attrs.phase_audit = audit
+
+    finish_profile(output_file, len(df_phase))
+    logger.info("Finished")
+
+
+def DL2_calphase_chunked(
+    dl2file,
+    ephem,
+    chunk_size,
+    obs="lst",
+    use_interpolation=False,
+    n_interp=1000,
+    pickle=False,
+    use_predictor=False,
+    interp_tolerance=None,
+    create_tim_file=False,
+    n_audit=None,
+    sidecar=False,
+):
+    """
+    Same as DL2_calphase, but the DL2 parameters are read and the phases are computed and appended to the 'phase_info' table in chunks of events.
+    The 'phase_info' table is written in pandas table format so that it can be appended.
+
+    Parameters:
+    -----------------
+    dl2file: string
+    DL2 input file with the arrival times
+
+    ephem: string
+    Ephemeris to be used (.par or .gro file)
+
+    chunk_size: int
+    Number of events per chunk
+
+    obs: string
+    Observatory code to give to PINT
+
+    use_interpolation: boolean
+    Set to True if want to use the interpolation method (faster but loses some precision)
+
+    n_interp: int
+    Number of events between two interpolation points.
+
+    pickle: boolean
+    True if want to save a pickle file with the loaded TOAs
+
+    use_predictor: boolean
+    Set to True if want to evaluate the phases with a polynomial phase predictor built for the whole night
+
+    interp_tolerance: float
+    Maximum phase error (in cycles) of the interpolation method. If given, the interpolation nodes are placed adaptively instead of every n_interp events
+
+    n_audit: int
+    Number of events whose phases are checked against the exact phases computed with PINT when the interpolation or the phase predictor are used (see audit_phases).
+    The maximum and RMS phase errors are saved in the output. If None, the phases are not checked
+
+    create_tim_file: boolean
+    Whether to create a temporal tim file to read and reduce TOAs with PINT or to build the TOAs in memory directly from the arrays of times (default).
+
+    sidecar: boolean
+    If True, the phases are written to a Parquet file next to the DL2 file ({name}.phase.parquet, see write_phase_sidecar) instead of the 'phase_info' table, so the DL2 file is not modified
+
+    """
+    if chunk_size < 1:
+        raise ValueError("The chunk size must be a positive number of events")
+
+    logger.info("Input file:" + str(dl2file))
+    start_profile()
+
+    if create_tim_file:
+        # Name of the .tim file (in a private temporary directory)
+        tmp_dir = tempfile.TemporaryDirectory(prefix="ptiming_")
+        timname = os.path.join(
+            tmp_dir.name, str(os.path.basename(dl2file).replace(".h5", "")) + ".tim"
+        )
+    else:
+        timname = None
+
+    with pd.HDFStore(dl2file, mode="r" if sidecar else "a") as store:
+        if not sidecar:
+            remove_phase_sidecar(dl2file)
+            if "phase_info" in store:
+                store.remove("phase_info")
+
+        events = store.get_node(dl2_params_lstcam_key)
+        nevents = events.nrows
+        audits = []
+
+        if sidecar:
+            # The columns of the sidecar file are small, so they are filled chunk by chunk and written at once
+            columns = {
+                "obs_id": np.empty(nevents, dtype=events.coldtypes["obs_id"]),
+                "event_id": np.empty(nevents, dtype=events.coldtypes["event_id"]),
+                "mjd_barycenter_time": np.empty(nevents),
+                "pulsar_phase": np.empty(nevents),
+            }
+
+        for start in range(0, nevents, chunk_size):
+            stop = min(start + chunk_size, nevents)
+            logger.info(f"Processing events {start}-{stop} of {nevents}")
+
+            with stage("read", stop - start):
+                dragon_time = events.read(start, stop, field="dragon_time")
+                times = Time(dragon_time, format="unix", scale="utc").to_value(
+                    "mjd", "long"
+                )
+
+            phase, barycent_toas = compute_phases_from_times(
+                times,
+                ephem,
+                timname,
+                obs,
+                use_interpolation,
+                n_interp,
+                pickle,
+                use_predictor,
+                interp_tolerance,
+            )
+
+            if n_audit and (use_interpolation or use_predictor):
+                # Each chunk checks its share of the events of the audit
+                audits.append(
+                    audit_phases(
+                        times,
+                        phase,
+                        ephem,
+                        obs,
+                        int(np.ceil(n_audit * (stop - start) / nevents)),
+                        tolerance=interp_tolerance,
+                    )
+                )
+
+            with stage("write", stop - start):
+                if sidecar:
+                    columns["obs_id"][start:stop] = events.read(
+                        start, stop, field="obs_id"
+                    )
+                    columns["event_id"][start:stop] = events.read(
+                        start, stop, field="event_id"
+                    )
+                    columns["mjd_barycenter_time"][start:stop] = barycent_toas
+                    columns["pulsar_phase"][start:stop] = phase
+                    continue
+
+                df_phase = pd.DataFrame(
+                    {
+                        "obs_id": events.read(start, stop, field="obs_id"),
+                        "event_id": events.read(start, stop, field="event_id"),
+                        "mjd_barycenter_time": barycent_toas,
+                        "pulsar_phase": phase,
+                    },
+                    index=np.arange(start, stop),
+                )
+                store.append("phase_info", df_phase, index=False)
+
+        if sidecar:
+            output_file = get_phase_sidecar_name(dl2file)
+            with stage("write"):
+                write_phase_sidecar(
+                    columns,
+                    output_file,
+                    metadata={"phase_audit": combine_audits(audits)}
+                    if len(audits) > 0
+                    else None,
+                )
+        else:
+            output_file = dl2file
+            if len(audits) > 0:
+                # The result of the audit is kept as metadata of the phase table
+                store.get_storer("phase_info").attrs.phase_audit = combine_audits(
+                    audits
+                )
+
+    # Removing tim file
+    if create_tim_file:
+        tmp_dir.cleanup()
+
+    finish_profile(output_file, nevents)
     logger.info("Finished")
 
 
+def DL2_calphase_batch(
+    filelist,
+    ephem,
+    obs="lst",
+    use_interpolation=False,
+    n_interp=1000,
+    pickle=False,
+    chunk_size=None,
+    use_predictor=False,
+    interp_tolerance=None,
+    source_name=None,
+    jobs=1,
+    create_tim_file=False,
+    n_audit=None,
+    sidecar=False,
+):
+    """
+    Runs DL2_calphase over a list of DL2 files (e.g. the subruns of a run), optionally in parallel. The files are processed in sorted order and a failure in one file does not stop the rest.
+
+    Parameters:
+    -----------------
+    filelist: list
+    List of DL2 files
+
+    source_name: string
+    If given, the source position and theta2 values are also added to the files (see add_source_info_dl2)
+
+    jobs: int
+    Number of processes used to analyze the files in parallel
+
+    The rest of the parameters are the same as in DL2_calphase.
+
+    Returns:
+    --------
+    Dictionary with the error message of each file that failed
+
+    """
+
+    tasks = [(file,) for file in sorted(filelist)]
+
+    failures = run_batch(
+        DL2_calphase_file,
+        tasks,
+        jobs=jobs,
+        ephem=ephem,
+        obs=obs,
+        use_interpolation=use_interpolation,
+        n_interp=n_interp,
+        pickle=pickle,
+        chunk_size=chunk_size,
+        use_predictor=use_predictor,
+        interp_tolerance=interp_tolerance,
+        n_audit=n_audit,
+        sidecar=sidecar,
+        source_name=source_name,
+        create_tim_file=create_tim_file,
+    )[1]
+
+    return failures
+
+
+def DL2_calphase_file(dl2file, ephem, source_name=None, **kwargs):
+    # Phases (and optionally source information) of one file of a batch
+    DL2_calphase(dl2file, ephem, **kwargs)
+    if source_name is not None:
+        add_source_info_dl2(dl2file, source_name)
+
+
 def compute_phase_interpolation(
-    timelist, ephem, timname, parname, n_interp=1000, obs="lst", pickle=False
+    timelist,
+    ephem,
+    timname,
+    parname,
+    n_interp=1000,
+    obs="lst",
+    pickle=False,
+    tolerance=None,
 ):
     """
     Calculates barycentered times and pulsar phases using an interpolation method for LST-1
@@ -550,8 +1649,28 @@ def compute_phase_interpolation(
     pickle: boolean
     True if want to save a pickle file with the loaded TOAs
 
+    tolerance: float
+    Maximum phase error (in cycles). If given, the interpolation nodes are placed in time and refined until the error is below the tolerance (see get_adaptive_nodes), and n_interp and timname are not used
+
     """
 
+    if tolerance is not None:
+        model = create_files(timelist, ephem, None, parname, obs=obs)
+        times = np.asarray(timelist, dtype=np.longdouble)
+        nodes, barycent_nodes, phase_nodes, max_error = get_adaptive_nodes(
+            times.min(), times.max(), model, tolerance, obs=obs
+        )
+        logger.info(
+            f"Adaptive interpolation with {len(nodes)} nodes. Maximum phase error: {max_error:.2e}"
+        )
+        with stage("interpolation", len(times)):
+            phase, barycent_toas = interpolate_from_nodes(
+                times, nodes, barycent_nodes, phase_nodes
+            )
+        phase = np.asarray(phase - np.floor(phase + 0.5), dtype=np.float64)
+
+        return (phase, barycent_toas)
+
     timelist = list(timelist)
     # Extraxting reference values of times for interpolation
     timelist_n = timelist[0::n_interp]
@@ -568,7 +1687,7 @@ def compute_phase_interpolation(
     # Calculate the barycent times and phases for reference
     if timname is None:
         barycent_toas_sample, phase_sample = compute_phases_from_times_model(
-            timelist_n, model
+            timelist_n, model, obs=obs
         )
     else:
         barycent_toas_sample, phase_sample = get_phase_list_from_tim(
@@ -579,7 +1698,7 @@ def compute_phase_interpolation(
     btime_sample_sec = np.array(barycent_toas_sample) * 86400
 
     # Getting the period:
-    m = models.get_model(model)
+    m = get_timing_model(model)
     P = 1 / m["F0"].value
     logger.info("The period used for the interpolation is:" + str(P))
 
@@ -603,15 +1722,137 @@ def compute_phase_interpolation(
     phase_s = sp + sN + spc
 
     # Interpolate to all values of times:
-    barycent_toas = interpolate_btoas(timelist, timelist_n, barycent_toas_sample)
-    barycent_toas_sec = np.array(barycent_toas) * 86400
-    phase = interpolate_phase(barycent_toas_sec, btime_sample_sec, phase_s)
+    with stage("interpolation", len(timelist)):
+        barycent_toas = interpolate_btoas(timelist, timelist_n, barycent_toas_sample)
+        barycent_toas_sec = np.array(barycent_toas) * 86400
+        phase = interpolate_phase(barycent_toas_sec, btime_sample_sec, phase_s)
     phase = phase % 1
     phase = phase - 0.5
 
     return (phase, barycent_toas)
 
 
+def get_adaptive_nodes(
+    tstart, tstop, model, tolerance, obs="lst", node_spacing=10, max_iter=30
+):
+    """
+    Places the interpolation nodes in time so that the error of the interpolated phases is below a given tolerance.
+    The nodes start evenly spaced in time. The exact phase is computed at the midpoint of each interval between nodes and compared with the interpolated one. The intervals where the error exceeds the tolerance are split, and their halves are checked in the next iteration.
+
+    Parameters:
+    -----------------
+    tstart: float
+    First time to interpolate (MJD)
+
+    tstop: float
+    Last time to interpolate (MJD)
+
+    model: string or TimingModel
+    Timing model (or .par file) used to compute the exact phases
+
+    tolerance: float
+    Maximum phase error (in cycles)
+
+    obs: string
+    Observatory code to give to PINT
+
+    node_spacing: float
+    Initial spacing between nodes in minutes
+
+    max_iter: int
+    Maximum number of refinements
+
+    Returns:
+    --------
+    Times of the nodes (MJD), barycentered times and absolute phases at the nodes, and maximum error found at the check points of the final intervals
+
+    """
+
+    def exact(times):
+        barycent_toas, phases = compute_phases_from_times_model(times, model, obs=obs)
+        return (
+            np.asarray(barycent_toas, dtype=np.longdouble),
+            np.asarray(phases.int, dtype=np.longdouble)
+            + np.asarray(phases.frac, dtype=np.longdouble),
+        )
+
+    tstart = np.longdouble(tstart)
+    tstop = np.longdouble(tstop)
+    nint = max(int(np.ceil((tstop - tstart) * 1440 / node_spacing)), 1)
+    nodes = tstart + (tstop - tstart) * np.arange(nint + 1, dtype=np.longdouble) / nint
+    if tstop == tstart:
+        nodes = nodes[:1]
+    barycent_nodes, phase_nodes = exact(nodes)
+    if len(nodes) == 1:
+        return (nodes, barycent_nodes, phase_nodes, 0.0)
+
+    # Intervals (given by their first node) still to check and error of the ones checked
+    to_check = np.arange(len(nodes) - 1)
+    errors = np.zeros(len(nodes) - 1)
+
+    for iteration in range(max_iter + 1):
+        check = nodes[to_check] + (nodes[to_check + 1] - nodes[to_check]) / 2
+        barycent_check, phase_check = exact(check)
+        phase_interp = interpolate_from_nodes(
+            check, nodes, barycent_nodes, phase_nodes
+        )[0]
+        error = np.asarray(np.abs(phase_interp - phase_check), dtype=np.float64)
+        errors[to_check] = error
+
+        bad = error > tolerance
+        if not np.any(bad) or iteration == max_iter:
+            break
+
+        # Split the intervals above the tolerance using the check points as new nodes
+        position = to_check[bad] + 1
+        nodes = np.insert(nodes, position, check[bad])
+        barycent_nodes = np.insert(barycent_nodes, position, barycent_check[bad])
+        phase_nodes = np.insert(phase_nodes, position, phase_check[bad])
+        errors = np.insert(errors, position, 0.0)
+
+        # Both halves of each split interval are checked in the next iteration
+        first = to_check[bad] + np.arange(np.sum(bad))
+        to_check = np.sort(np.concatenate((first, first + 1)))
+
+    max_error = float(np.max(errors))
+    if max_error > tolerance:
+        logger.warning(
+            f"Phase tolerance not reached after {max_iter} refinements (maximum error {max_error:.2e})"
+        )
+
+    return (nodes, barycent_nodes, phase_nodes, max_error)
+
+
+def interpolate_from_nodes(times, nodes, barycent_nodes, phase_nodes):
+    """
+    Interpolates linearly the barycentered times (as a function of the arrival time) and the absolute phases (as a function of the barycentered time) from their values at a set of nodes.
+    The interpolation is done relative to the first node to keep the precision of the long double inputs.
+
+    Returns:
+    --------
+    Absolute phases and barycentered times (MJD)
+
+    """
+
+    times = np.asarray(times, dtype=np.longdouble)
+
+    # Barycentric correction (in seconds) as a function of the arrival time
+    t_rel = np.asarray(times - nodes[0], dtype=np.float64)
+    nodes_rel = np.asarray(nodes - nodes[0], dtype=np.float64)
+    delay_nodes = np.asarray((barycent_nodes - nodes) * 86400, dtype=np.float64)
+    barycent_toas = times + np.interp(t_rel, nodes_rel, delay_nodes) / 86400
+
+    # Phase as a function of the barycentered time
+    bt_rel = np.asarray((barycent_toas - barycent_nodes[0]) * 86400, dtype=np.float64)
+    bt_nodes_rel = np.asarray(
+        (barycent_nodes - barycent_nodes[0]) * 86400, dtype=np.float64
+    )
+    phase_rel = np.asarray(phase_nodes - phase_nodes[0], dtype=np.float64)
+    phase = phase_nodes[0] + np.interp(bt_rel, bt_nodes_rel, phase_rel)
+
+    return (phase, barycent_toas)
+
+
 def interpolate_phase(timelist, time_sample, phase_s):
     from scipy.interpolate import interp1d
 
@@ -651,7 +1892,7 @@ def get_phase_list(timname, timelist, ephem, parname, obs="lst", pickle=False):
     barycent_toas = m.get_barycentric_toas(t)
     phase = m.phase(t, abs_phase=True)
 
-    os.remove(str(os.getcwd()) + "/" + timname)
+    os.remove(timname)
 
     return (barycent_toas, phase)
 
@@ -659,7 +1900,8 @@ def get_phase_list(timname, timelist, ephem, parname, obs="lst", pickle=False):
 def get_phase_list_from_tim(timname, model, pickle=False):
     logger.info("creating TOA list")
     # Upload TOAs and model
-    m, t = models.get_model_and_toas(model, timname, planets=True, usepickle=pickle)
+    m = get_timing_model(model)
+    t = toa.get_TOAs(timname, model=m, planets=True, usepickle=pickle)
 
     print(m)
     # Calculate the phases
@@ -17,29 +17,98 @@ from pint.models.timing_model import (
 )
 import astropy.units as u
 import os
+import io
+import json
+import tables
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pint.models import get_model
+import pint.toa as toa
+from pint.observatory import get_observatory
+from astropy.table import Table, Column
 from lstchain.io import global_metadata, write_metadata
 from lstchain.io.io import (
-    write_dataframe,
+    HDF5_ZSTD_FILTERS,
     dl2_params_src_dep_lstcam_key,
-    write_dl2_dataframe,
     dl2_params_lstcam_key,
 )
 from astropy.coordinates import SkyCoord, AltAz
 from astropy.coordinates.erfa_astrom import ErfaAstromInterpolator, erfa_astrom
 from ctapipe.coordinates import CameraFrame
 from lstchain.reco.utils import location
+import ptiming_ana.cphase.profiling as profiling
 
 
 __all__ = [
     "read_ephemfile",
     "dl2time_totim",
     "model_fromephem",
+    "get_model_fromephem",
+    "create_model_fromephem",
+    "find_ephem_row",
+    "find_ephem_rows",
+    "get_ephem_index",
+    "get_ephem_segments",
+    "get_ephem_hash",
+    "get_timing_model",
+    "create_toas",
+    "set_model_cache_dir",
+    "set_observatory_cache",
+    "run_batch",
     "add_mjd",
     "merge_dl2_pulsar",
+    "merge_hdf5_tables",
+    "read_fits_columns",
+    "get_source_position",
+    "add_source_info_dl2",
+    "get_phase_sidecar_name",
+    "write_phase_sidecar",
+    "read_phase_info",
+    "read_phase_metadata",
 ]
 
+_model_cache_dir = None
+
+# Local catalog of source positions (ICRS ra, dec in deg) used to resolve source names without network access
+SOURCE_CATALOG_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "ptiming_ana", "source_catalog.json"
+)
+_default_source_positions = {"crab": (83.63308333, 22.01450000)}
+_source_positions = {}
+_observatory_cache_enabled = False
+_observatory_cache_dir = None
+
+
+def merge_dl2_pulsar(
+    directory, run_number, output_dir, src_dep=False, chunk_size=1000000
+):
+    """
+    Merges the DL2 pulsar files of the subruns of a run into a single file.
+    The tables of the subruns are appended one by one (and chunk by chunk) to a table of the output file preallocated for the total number of events,
+    so the memory used does not depend on the size of the run.
+
+    Parameters:
+    -----------------
+    directory: string
+    Directory with the DL2 subrun files
+
+    run_number: string
+    Run number of the files to merge
+
+    output_dir: string
+    Directory where to write the merged file
+
+    src_dep: boolean
+    True if want to merge also the source-dependent parameters
+
+    chunk_size: int
+    Maximum number of events copied at once
+
+    """
+    if chunk_size < 1:
+        raise ValueError("The chunk size must be a positive number of events")
 
-def merge_dl2_pulsar(directory, run_number, output_dir, src_dep=False):
     # Read the DL2 subrun files for the given run number
     filelist = []
     for x in os.listdir(directory):
@@ -49,24 +118,6 @@ def merge_dl2_pulsar(directory, run_number, output_dir, src_dep=False):
             filelist.append(p_file)
     filelist.sort()
 
-    # Read the Dl2 events and concatenate the dataframes
-    df_list = []
-    df_src_list = []
-    for file in filelist:
-        df_i = pd.read_hdf(file, key=dl2_params_lstcam_key)
-        df_list.append(df_i)
-
-        # Include source dependent information if it is the case
-        if src_dep:
-            df_i_src = pd.read_hdf(
-                file, key=dl2_params_src_dep_lstcam_key, float_precision=20
-            )
-            df_src_list.append(df_i_src)
-
-    df = pd.concat(df_list)
-    if src_dep:
-        df_src = pd.concat(df_src_list)
-
     # Write the new merged dataframe into a file
     output_file = (
         output_dir
@@ -76,71 +127,237 @@ def merge_dl2_pulsar(directory, run_number, output_dir, src_dep=False):
     metadata = global_metadata()
     write_metadata(metadata, output_file)
 
-    if not src_dep:
-        write_dl2_dataframe(df, output_file, meta=metadata)
+    table_paths = [dl2_params_lstcam_key]
+    if src_dep:
+        # Include source dependent information if it is the case
+        table_paths.append(dl2_params_src_dep_lstcam_key)
 
-    else:
-        write_dl2_dataframe(df, output_file, meta=metadata)
-        write_dataframe(
-            df_src, output_file, dl2_params_src_dep_lstcam_key, meta=metadata
+    for table_path in table_paths:
+        merge_hdf5_tables(
+            filelist, output_file, table_path, meta=metadata, chunk_size=chunk_size
         )
 
 
-def add_source_info_dl2(file, source_name):
+def merge_hdf5_tables(filelist, output_file, table_path, meta=None, chunk_size=1000000):
+    """
+    Appends the (PyTables) table stored in table_path of each input file to a single table of the output file, without loading the tables in memory.
+    The output table is created with the layout (columns and compression) of the first file and sized for the total number of rows, so that
+    the chunks of the HDF5 file are adapted to the final size of the table.
+
+    Parameters:
+    -----------------
+    filelist: list
+    List of input files
+
+    output_file: string
+    Output HDF5 file. The table must not exist in it
+
+    table_path: string
+    Path of the table in the files
+
+    meta: lstchain.io.lstcontainers.MetaData
+    Global metadata to store as attributes of the output table
+
+    chunk_size: int
+    Maximum number of rows copied at once
+
+    """
+    if not table_path.startswith("/"):
+        table_path = "/" + table_path
+    path, table_name = table_path.rsplit("/", maxsplit=1)
+
+    # Total number of rows to preallocate the output table
+    nrows = 0
+    for file in filelist:
+        with tables.open_file(file, mode="r") as f:
+            nrows += f.get_node(table_path).nrows
+
+    with tables.open_file(output_file, mode="a") as out:
+        merged = None
+        for file in filelist:
+            with tables.open_file(file, mode="r") as f:
+                table = f.get_node(table_path)
+                if merged is None:
+                    merged = out.create_table(
+                        path,
+                        table_name,
+                        description=table.description,
+                        expectedrows=max(nrows, 1),
+                        createparents=True,
+                        filters=HDF5_ZSTD_FILTERS,
+                    )
+                    if meta:
+                        for k, item in meta.as_dict().items():
+                            merged.attrs[k] = item
+                elif set(table.colnames) != set(merged.colnames):
+                    raise ValueError(
+                        f"The columns of {table_path} in {file} do not match the ones of the first file"
+                    )
+
+                for start in range(0, table.nrows, chunk_size):
+                    rows = table.read(start, min(start + chunk_size, table.nrows))
+                    if rows.dtype != merged.dtype:
+                        # Same columns in a different order or type
+                        converted = np.empty(len(rows), dtype=merged.dtype)
+                        for name in merged.colnames:
+                            converted[name] = rows[name]
+                        rows = converted
+                    merged.append(rows)
+            merged.flush()
+
+
+def get_source_position(source_name, catalog_file=None):
+    """
+    Gets the sky position of a source, resolving its name without network access whenever possible.
+    The name is looked up first in the local source catalog (a JSON file with the ICRS coordinates of each name), and only if it is not there it is resolved
+    online with SkyCoord.from_name and stored in the catalog, so that it can be used later on nodes without network access.
+
+    Parameters:
+    -----------------
+    source_name: string
+    Name of the source
+
+    catalog_file: string
+    Path to the local source catalog. If None, the one given by the PTIMING_SOURCE_CATALOG environment variable is used (by default ~/.cache/ptiming_ana/source_catalog.json)
+
+    Returns:
+    -----------------
+    SkyCoord with the position of the source
+
+    """
+    if catalog_file is None:
+        catalog_file = os.environ.get("PTIMING_SOURCE_CATALOG", SOURCE_CATALOG_FILE)
+
+    key = source_name.strip().lower()
+    if key in _source_positions:
+        return _source_positions[key]
+
+    catalog = {}
+    if os.path.exists(catalog_file):
+        with open(catalog_file) as f:
+            catalog = json.load(f)
+
+    if key in catalog:
+        ra, dec = catalog[key]
+    elif key in _default_source_positions:
+        ra, dec = _default_source_positions[key]
+    else:
+        print("Resolving position of " + source_name + " online")
+        source_pos = SkyCoord.from_name(source_name).icrs
+        ra, dec = source_pos.ra.deg, source_pos.dec.deg
+
+        catalog[key] = [ra, dec]
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(catalog_file)), exist_ok=True)
+            # Write to a temporary name and rename so that concurrent jobs never read a partial file
+            tmp_file = catalog_file + f".{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(catalog, f, indent=1)
+            os.replace(tmp_file, catalog_file)
+        except OSError as e:
+            print("Source catalog could not be updated: " + str(e))
+
+    _source_positions[key] = SkyCoord(ra=ra * u.deg, dec=dec * u.deg, frame="icrs")
+
+    return _source_positions[key]
+
+
+def add_source_info_dl2(file, source_name, chunk_size=1000000, interp_step=1.0):
+    """
+    Adds a table (key='source_position') to a DL2 file with the position of the source in the camera (src_x, src_y) and the theta2 values of the events
+    with respect to the source (theta2) and to the opposite position in the camera (theta2_off).
+    The events are read and processed in chunks of rows, and the table of each chunk is appended to the file, so the memory does not depend on the size of the file.
+    The chunks follow the order of the rows in the file (so the rows of the new table match the ones of the DL2 table) and are not globally sorted in time: the events
+    of each chunk are only sorted internally to place the nodes, where the exact transformation to the camera frame is computed (every interp_step seconds, using
+    the pointing of the telescope at each node). The position of the source is interpolated in time for the rest of the events of the chunk.
+    The columns are written as float32.
+
+    Parameters:
+    -----------------
+    file: string
+    DL2 file
+
+    source_name: string
+    Name of the source (see get_source_position)
+
+    chunk_size: int
+    Number of events per chunk
+
+    interp_step: float
+    Time (in seconds) between the nodes where the position of the source in the camera is computed exactly
+
+    """
     print("Adding source information in" + str(file))
 
+    if chunk_size < 1:
+        raise ValueError("The chunk size must be a positive number of events")
+
     coma_factor = 1.0466
     focal = coma_factor * 28 * u.m
 
-    df1 = pd.read_hdf(file, key=dl2_params_lstcam_key)
+    source_pos = get_source_position(source_name)
 
-    source_pos = SkyCoord.from_name(source_name)
+    with pd.HDFStore(file, mode="a") as store:
+        # The table is written chunk by chunk, so a previous one is removed first
+        if "source_position" in store:
+            store.remove("source_position")
 
-    times = Time(df1["dragon_time"], format="unix", scale="utc")
-    tel_pos = SkyCoord(
-        alt=np.array(df1["alt_tel"]) * u.rad,
-        az=np.array(df1["az_tel"]) * u.rad,
-        frame=AltAz(obstime=times, location=location),
-    )
+        events = store.get_node(dl2_params_lstcam_key)
+        nevents = events.nrows
+        for start in range(0, nevents, chunk_size):
+            # Only the rows of the chunk are read
+            chunk = events.read(start, min(start + chunk_size, nevents))
+            order = np.argsort(chunk["dragon_time"], kind="stable")
+            chunk_times = chunk["dragon_time"][order]
 
-    with erfa_astrom.set(ErfaAstromInterpolator(5 * u.min)):
-        camera_frame = CameraFrame(
-            focal_length=focal,
-            telescope_pointing=tel_pos,
-            location=location,
-            obstime=times,
-        )
-        source_campos = source_pos.transform_to(camera_frame)
+            # Nodes: first event after each step and the last event of the chunk (in time order)
+            grid = np.arange(chunk_times[0], chunk_times[-1], interp_step)
+            nodes = np.unique(
+                np.append(np.searchsorted(chunk_times, grid), len(chunk_times) - 1)
+            )
 
-    src_x = source_campos.data.x.value
-    src_y = source_campos.data.y.value
+            times = Time(chunk_times[nodes], format="unix", scale="utc")
+            tel_pos = SkyCoord(
+                alt=chunk["alt_tel"][order[nodes]] * u.rad,
+                az=chunk["az_tel"][order[nodes]] * u.rad,
+                frame=AltAz(obstime=times, location=location),
+            )
 
-    reco_src_x = df1["reco_src_x"]
-    reco_src_y = df1["reco_src_y"]
+            with erfa_astrom.set(ErfaAstromInterpolator(5 * u.min)):
+                camera_frame = CameraFrame(
+                    focal_length=focal,
+                    telescope_pointing=tel_pos,
+                    location=location,
+                    obstime=times,
+                )
+                source_campos = source_pos.transform_to(camera_frame)
 
-    print("Computing theta2...")
-    theta_meters = np.sqrt(
-        np.power(reco_src_x - src_x, 2) + np.power(reco_src_y - src_y, 2)
-    )
-    theta_on = np.rad2deg(np.arctan2(theta_meters, focal.value))
-    theta2 = np.power(theta_on, 2)
+            src_x = np.interp(
+                chunk["dragon_time"], chunk_times[nodes], source_campos.data.x.value
+            )
+            src_y = np.interp(
+                chunk["dragon_time"], chunk_times[nodes], source_campos.data.y.value
+            )
 
-    theta_meters = np.sqrt(
-        np.power(reco_src_x + src_x, 2) + np.power(reco_src_y + src_y, 2)
-    )
-    theta_off = np.rad2deg(np.arctan2(theta_meters, focal.value))
-    theta2_off = np.power(theta_off, 2)
+            reco_src_x = chunk["reco_src_x"].astype(np.float64)
+            reco_src_y = chunk["reco_src_y"].astype(np.float64)
 
-    print("Writing in new table...")
-    table_source = pd.DataFrame(
-        {
-            "src_x": list(src_x),
-            "src_y": list(src_y),
-            "theta2": list(theta2),
-            "theta2_off": list(theta2_off),
-        }
-    )
-    table_source.to_hdf(file, key="source_position")
+            theta_meters = np.hypot(reco_src_x - src_x, reco_src_y - src_y)
+            theta2 = np.rad2deg(np.arctan2(theta_meters, focal.value)) ** 2
+
+            theta_meters = np.hypot(reco_src_x + src_x, reco_src_y + src_y)
+            theta2_off = np.rad2deg(np.arctan2(theta_meters, focal.value)) ** 2
+
+            table_source = pd.DataFrame(
+                {
+                    "src_x": src_x.astype(np.float32),
+                    "src_y": src_y.astype(np.float32),
+                    "theta2": theta2.astype(np.float32),
+                    "theta2_off": theta2_off.astype(np.float32),
+                },
+                index=np.arange(start, start + len(chunk)),
+            )
+            store.append("source_position", table_source)
 
 
 def read_ephemfile(ephem):
@@ -225,21 +442,290 @@ def model_fromephem(times, ephem, model_name):
 
     """
 
-    # Read the ephemeris txt file
-    df_ephem = read_ephemfile(ephem)
+    tm = get_model_fromephem(times, ephem)
+
+    # Create the .par file
+    name = model_name
+    f = open(name, "w+")
+    f.write(tm.as_parfile())
+
+    f.close()
+
+    return name
+
+
+def set_model_cache_dir(directory):
+    """
+    Sets the directory where the timing models built from .gro ephemerides are stored, so that they can be reused by other processes.
+    The models are always cached in memory. Set to None to only use the in-memory cache.
+
+    Parameters:
+    -----------------
+    directory: string
+    Path to the cache directory. It is created if it does not exist.
+
+    """
+    global _model_cache_dir
+
+    if directory is not None and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    _model_cache_dir = directory
+
+
+def set_observatory_cache(enabled=True, directory=None):
+    """
+    Enables (or disables) the observatory cache used to create the TOAs of the phase-tagging functions.
+    Clock corrections, TDBs and observatory/solar system positions are then computed once per night and site on a time grid and interpolated for every run and subrun,
+    instead of being recomputed by PINT for every file (see ObservatoryCache).
+
+    Parameters:
+    -----------------
+    enabled: boolean
+    True if want to use the observatory cache
+
+    directory: string
+    Path to the directory where the caches are stored, so that they can be reused by other processes. It is created if it does not exist. If None, they are only kept in memory
+
+    """
+    global _observatory_cache_enabled, _observatory_cache_dir
+
+    if directory is not None and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    _observatory_cache_enabled = enabled
+    _observatory_cache_dir = directory
+
+
+def _init_batch_worker(cache_dir, observatory_cache=(False, None), profile=False):
+    # Share the on-disk model and observatory caches (and the profiling setting) with the worker processes
+    set_model_cache_dir(cache_dir)
+    set_observatory_cache(*observatory_cache)
+    profiling.set_profiling(profile)
+
+
+def _run_task(function, task, kwargs):
+    return function(*task, **kwargs)
+
+
+def run_batch(function, tasks, jobs=1, callback=None, **kwargs):
+    """
+    Runs a function over a list of independent tasks (files or observations), optionally in a pool of processes.
+    A task that raises an exception is reported as failed, but the rest of the tasks are still processed.
+
+    Parameters:
+    -----------------
+    function: callable
+    Function to run. It must be defined at module level so that it can be sent to other processes
+
+    tasks: list
+    List of tuples with the positional arguments of each call. The first one is used to identify the task
+
+    jobs: int
+    Number of processes to use. If 1, the tasks are run one after another in the current process
+
+    callback: callable
+    If given, it is called in the current process as callback(i, result, error) as soon as each task finishes (error is None if the task succeeded)
+
+    kwargs:
+    Keyword arguments passed to all the calls
+
+    Returns:
+    -----------------
+    List with the results of the tasks (in the same order as the tasks, None if failed) and dictionary with the error message of each failed task
+
+    """
+    if jobs < 1:
+        raise ValueError("The number of jobs must be a positive integer")
+
+    tasks = [tuple(task) for task in tasks]
+    ntasks = len(tasks)
+    results = [None] * ntasks
+    failures = {}
+
+    def report(i, error):
+        name = str(tasks[i][0])
+        if error is None:
+            print(f"[{ndone}/{ntasks}] Finished {name}")
+        else:
+            failures[name] = repr(error)
+            print(f"[{ndone}/{ntasks}] Failed {name}: {error!r}")
+        if callback is not None:
+            callback(i, results[i], error)
+
+    ndone = 0
+    if jobs == 1 or ntasks <= 1:
+        for i, task in enumerate(tasks):
+            error = None
+            try:
+                results[i] = _run_task(function, task, kwargs)
+            except Exception as e:
+                error = e
+            ndone += 1
+            report(i, error)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(jobs, ntasks),
+            initializer=_init_batch_worker,
+            initargs=(
+                _model_cache_dir,
+                (_observatory_cache_enabled, _observatory_cache_dir),
+                profiling._profiling_enabled,
+            ),
+        ) as executor:
+            futures = {
+                executor.submit(_run_task, function, task, kwargs): i
+                for i, task in enumerate(tasks)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                error = future.exception()
+                if error is None:
+                    results[i] = future.result()
+                ndone += 1
+                report(i, error)
+
+    if len(failures) > 0:
+        print(f"{len(failures)} of {ntasks} tasks failed")
+
+    return (results, failures)
+
+
+def get_ephem_hash(ephem):
+    """
+    Computes the SHA-256 hash of the content of an ephemeris file.
+
+    Parameters:
+    -----------------
+    ephem: string
+    Name of the ephemeris file
+
+    Returns:
+    -----------------
+    Hexadecimal digest of the file content
+
+    """
+
+    with open(ephem, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@lru_cache(maxsize=8)
+def _read_ephemfile_cached(ephem_hash, ephem):
+    return read_ephemfile(ephem)
+
+
+def get_ephem_index(df_ephem):
+    """
+    Builds a sorted index of the validity intervals of the ephemeris, to look up the line valid for any time by binary search.
+
+    Parameters:
+    -----------------
+    df_ephem: Dataframe
+    Ephemeris as returned by read_ephemfile
+
+    Returns:
+    -----------------
+    Arrays with the START and FINISH of the intervals (sorted by START) and the line of the ephemeris of each interval
+
+    """
+
+    start = np.asarray(df_ephem["START"], dtype=np.float64)
+    finish = np.asarray(df_ephem["FINISH"], dtype=np.float64)
+    rows = np.argsort(start, kind="stable")
+
+    return (start[rows], finish[rows], rows)
+
+
+@lru_cache(maxsize=8)
+def _get_ephem_index_cached(ephem_hash, ephem):
+    return get_ephem_index(_read_ephemfile_cached(ephem_hash, ephem))
+
+
+def find_ephem_rows(times, df_ephem, ephem_index=None):
+    """
+    Finds the lines of the ephemeris whose validity intervals contain the given times.
+    Times outside all the intervals are assigned to the closest interval.
+
+    Parameters:
+    -----------------
+    times: array
+    Arrival times in MJD
 
-    # Search the line of the ephemeris at which the interval time of arrivals given belongs
-    for i in range(0, len(df_ephem["START"])):
-        if (times[0] > df_ephem["START"][i]) & (times[0] < df_ephem["FINISH"][i]):
-            break
-        elif (times[0] < df_ephem["START"][i]) & (i == 0):
-            print("No ephemeris available")
-        elif (
-            (times[0] > df_ephem["START"][i])
-            & (times[0] > df_ephem["FINISH"][i])
-            & (i == len(df_ephem["START"]))
-        ):
-            print("No ephemeris available")
+    df_ephem: Dataframe
+    Ephemeris as returned by read_ephemfile
+
+    ephem_index: tuple
+    Index returned by get_ephem_index. If None, it is built from df_ephem
+
+    Returns:
+    -----------------
+    Array with the index of the line of the ephemeris for each time
+
+    """
+
+    if ephem_index is None:
+        ephem_index = get_ephem_index(df_ephem)
+    start, finish, rows = ephem_index
+
+    times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+
+    # Last interval starting before each time
+    pos = np.searchsorted(start, times, side="right") - 1
+    outside = (pos < 0) | (times > finish[np.clip(pos, 0, None)])
+    if np.any(outside):
+        print("No ephemeris available for " + str(np.sum(outside)) + " times")
+        # Take the closest interval
+        pos = np.clip(pos, 0, len(start) - 1)
+        after = np.clip(pos + 1, 0, len(start) - 1)
+        closer_after = (start[after] - times) < (times - finish[pos])
+        pos = np.where(outside & closer_after, after, pos)
+        pos = np.where(times < start[0], 0, pos)
+
+    return rows[pos]
+
+
+def find_ephem_row(time, df_ephem, ephem_index=None):
+    """
+    Finds the line of the ephemeris whose validity interval contains the given time.
+
+    Parameters:
+    -----------------
+    time: float
+    Arrival time in MJD
+
+    df_ephem: Dataframe
+    Ephemeris as returned by read_ephemfile
+
+    ephem_index: tuple
+    Index returned by get_ephem_index. If None, it is built from df_ephem
+
+    Returns:
+    -----------------
+    Index of the line of the ephemeris
+
+    """
+
+    return int(find_ephem_rows([time], df_ephem, ephem_index)[0])
+
+
+def create_model_fromephem(df_ephem, row):
+    """
+    Creates a PINT timing model using the parameters of one line of the ephemeris.
+
+    Parameters:
+    -----------------
+    df_ephem: Dataframe
+    Ephemeris as returned by read_ephemfile
+
+    row: int
+    Index of the line of the ephemeris to use
+
+    Returns:
+    --------
+    Validated TimingModel
+
+    """
 
     # Select componentes of the model
     all_components = Component.component_types
@@ -288,40 +774,40 @@ def model_fromephem(times, ephem, model_name):
     tm.components["Spindown"].add_param(f2, setup=True)
     tm.components["Spindown"].add_param(tres, setup=True)
 
-    f1 = float(str(df_ephem["F1"][i].replace("D", "E")))
-    f2 = float(str(df_ephem["F2"][i].replace("D", "E")))
+    f1 = float(str(df_ephem["F1"][row].replace("D", "E")))
+    f2 = float(str(df_ephem["F2"][row].replace("D", "E")))
 
     # Give values to the parameters
     params = {
-        "PSR": (df_ephem["PSR"][i],),
+        "PSR": (df_ephem["PSR"][row],),
         "RAJ": (
-            str(df_ephem["RAJ1"][i])
+            str(df_ephem["RAJ1"][row])
             + ":"
-            + str(df_ephem["RAJ2"][i])
+            + str(df_ephem["RAJ2"][row])
             + ":"
-            + str(df_ephem["RAJ3"][i]),
+            + str(df_ephem["RAJ3"][row]),
         ),
         "DECJ": (
-            str(df_ephem["DECJ1"][i])
+            str(df_ephem["DECJ1"][row])
             + ":"
-            + str(df_ephem["DECJ2"][i])
+            + str(df_ephem["DECJ2"][row])
             + ":"
-            + str(df_ephem["DECJ3"][i]),
+            + str(df_ephem["DECJ3"][row]),
         ),
-        "START": (Time(df_ephem["START"][i], format="mjd", scale="tdb"),),
-        "FINISH": (Time(df_ephem["FINISH"][i], format="mjd", scale="tdb"),),
-        "EPHEM": (df_ephem["EPHEM"][i],),
-        "PEPOCH": (Time(int(df_ephem["t0geo"][i]), format="mjd", scale="tdb"),),
-        "F0": (df_ephem["F0"][i] * u.Hz,),
+        "START": (Time(df_ephem["START"][row], format="mjd", scale="tdb"),),
+        "FINISH": (Time(df_ephem["FINISH"][row], format="mjd", scale="tdb"),),
+        "EPHEM": (df_ephem["EPHEM"][row],),
+        "PEPOCH": (Time(int(df_ephem["t0geo"][row]), format="mjd", scale="tdb"),),
+        "F0": (df_ephem["F0"][row] * u.Hz,),
         "F1": (f1 * u.Hz / u.s,),
         "F2": (f2 * u.Hz / (u.s**2),),
-        "TZRMJD": (Time(df_ephem["t0geo"][i], format="mjd", scale="tdb"),),
+        "TZRMJD": (Time(df_ephem["t0geo"][row], format="mjd", scale="tdb"),),
         "TZRFRQ": (0.0 * u.Hz,),
         "TZRSITE": ("coe",),
         "T2CMETHOD": "IAU200B",
         "TIMEEPH": "FB90",
         "PLANET_SHAPIRO": "Y",
-        "TRES": ((df_ephem["RMS"][i] * 0.001 / df_ephem["F0"][i] * 1000000),),
+        "TRES": ((df_ephem["RMS"][row] * 0.001 / df_ephem["F0"][row] * 1000000),),
     }
 
     # Create the model using PINT
@@ -336,15 +822,178 @@ def model_fromephem(times, ephem, model_name):
     tm.validate()
     print("New model generated")
 
-    # Create the .par file
-    tm.as_parfile()
-    name = model_name
-    f = open(name, "w+")
-    f.write(tm.as_parfile())
+    return tm
 
-    f.close()
 
-    return name
+@lru_cache(maxsize=64)
+def _get_cached_model(ephem_hash, row, ephem, cache_dir):
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"{ephem_hash}_{row}.par")
+        if os.path.exists(cache_file):
+            return get_model(cache_file)
+
+    df_ephem = _read_ephemfile_cached(ephem_hash, ephem)
+    parfile = create_model_fromephem(df_ephem, row).as_parfile()
+
+    if cache_dir is not None:
+        # Write to a temporary name and rename so that concurrent jobs never read a partial file
+        tmp_file = cache_file + f".{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(parfile)
+        os.replace(tmp_file, cache_file)
+
+    # Reload the model from the .par content (as done when reading the .par file)
+    return get_model(io.StringIO(parfile))
+
+
+def get_model_fromephem(times, ephem):
+    """
+    Gets the timing model valid for the given arrival times from a .gro ephemeris.
+    Models are cached in memory (and on disk if set_model_cache_dir was called), keyed by the hash of the ephemeris file and the line used, so repeated calls do not build the model again.
+    Only the first time is used to select the line of the ephemeris (see get_ephem_segments for times spanning several lines).
+
+    Parameters:
+    -----------------
+    times: list
+    List of arrival times in MJD
+
+    ephem: string
+    Ephemeris to be used (.gro file)
+
+    Returns:
+    --------
+    TimingModel. It is shared between calls, so it should not be modified.
+
+    """
+
+    ephem_hash = get_ephem_hash(ephem)
+    df_ephem = _read_ephemfile_cached(ephem_hash, ephem)
+    row = find_ephem_row(
+        times[0], df_ephem, _get_ephem_index_cached(ephem_hash, ephem)
+    )
+
+    return _get_cached_model(ephem_hash, row, ephem, _model_cache_dir)
+
+
+def get_ephem_segments(times, ephem):
+    """
+    Splits a set of arrival times according to the lines of a .gro ephemeris valid for each of them.
+
+    Parameters:
+    -----------------
+    times: array
+    Arrival times in MJD
+
+    ephem: string
+    Ephemeris to be used (.gro file)
+
+    Returns:
+    --------
+    List of (TimingModel, indices) with the model of each line of the ephemeris and the indices of the times where it is valid.
+    The indices are a slice if the times of the segment are contiguous, and an array of indices otherwise.
+
+    """
+
+    ephem_hash = get_ephem_hash(ephem)
+    df_ephem = _read_ephemfile_cached(ephem_hash, ephem)
+    rows = find_ephem_rows(
+        times, df_ephem, _get_ephem_index_cached(ephem_hash, ephem)
+    )
+
+    # Group the times by line of the ephemeris (keeping their order)
+    order = np.argsort(rows, kind="stable")
+    bounds = np.flatnonzero(np.diff(rows[order])) + 1
+    bounds = np.concatenate(([0], bounds, [len(rows)]))
+
+    segments = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        index = order[first:last]
+        if index[-1] - index[0] == last - first - 1:
+            index = slice(index[0], index[-1] + 1)
+        row = int(rows[order[first]])
+        segments.append(
+            (_get_cached_model(ephem_hash, row, ephem, _model_cache_dir), index)
+        )
+
+    return segments
+
+
+def get_timing_model(model):
+    """
+    Returns the PINT timing model given either the model itself or the name of a .par file.
+    """
+
+    if isinstance(model, TimingModel):
+        return model
+
+    return get_model(model)
+
+
+def create_toas(times, obs="lst"):
+    """
+    Creates the PINT TOAs object of an array of arrival times in the same way as pint.toa.get_TOAs_array, but without applying the clock corrections
+    nor computing the TDBs and posvels, so that these steps can be done (or interpolated) separately.
+
+    Parameters:
+    -----------------
+    times: array or astropy.time.Time
+    Times of arrival. If not given as a Time object, they are interpreted as MJDs in the time scale of the observatory (long double precision is kept)
+
+    obs: string
+    Observatory code to give to PINT
+
+    Returns:
+    -----------------
+    PINT TOAs object
+
+    """
+    site = get_observatory(obs)
+    if isinstance(times, Time):
+        t = np.atleast_1d(times)
+    else:
+        # When the scale is UTC, the pulsar_mjd format must be used (as in PINT)
+        scale = site.timescale
+        t = Time(
+            np.atleast_1d(np.asarray(times, dtype=np.longdouble)),
+            scale=scale,
+            format="pulsar_mjd" if scale.lower() == "utc" else "mjd",
+            precision=9,
+        )
+    # Time with the location of the observatory, for the TDB conversion
+    mjd = Time(t, location=site.earth_location_itrf(time=t), precision=9)
+
+    n = len(mjd)
+    flags_array = np.empty(n, dtype=object)
+    for i in range(n):
+        flags_array[i] = toa.FlagDict()
+
+    out = Table(
+        [
+            np.arange(n),
+            Column(mjd),
+            np.array(mjd.mjd, dtype=float) * u.d,
+            np.zeros(n) * u.us,
+            np.full(n, np.inf) * u.MHz,
+            np.array([site.name] * n),
+            flags_array,
+            np.zeros(n, dtype=float),
+        ],
+        names=(
+            "index",
+            "mjd",
+            "mjd_float",
+            "error",
+            "freq",
+            "obs",
+            "flags",
+            "delta_pulse_number",
+        ),
+    )
+    toas = toa.TOAs(toatable=out)
+    toas.commands = []
+    toas.hashes = {}
+
+    return toas
 
 
 def add_mjd(file_dataframe):
@@ -357,3 +1006,185 @@ def add_mjd(file_dataframe):
     file_dataframe["mjd_time"] = mjd_time.tolist()
 
     return mjd_time.tolist()
+
+
+def read_fits_columns(fits_table, columns, chunk_size=1000000):
+    """
+    Reads some columns of a FITS binary table as native byte order arrays.
+    The columns of a table opened with memmap=True are views of the file, so only the requested columns are read, and the byte order is converted chunk by chunk
+    directly into the output arrays (without intermediate copies of the whole columns).
+
+    Parameters:
+    -----------------
+    fits_table: astropy.io.fits.FITS_rec
+    Data of the binary table (e.g. fits.open(file, memmap=True)[1].data)
+
+    columns: list
+    Names of the columns to read
+
+    chunk_size: int
+    Number of rows converted at once
+
+    Returns:
+    -----------------
+    Dictionary with the array of each column
+
+    """
+    if chunk_size < 1:
+        raise ValueError("The chunk size must be a positive number of rows")
+
+    arrays = {}
+    for name in columns:
+        column = fits_table.field(name)
+        arrays[name] = np.empty(column.shape, dtype=column.dtype.newbyteorder("="))
+        for start in range(0, len(column), chunk_size):
+            arrays[name][start : start + chunk_size] = column[start : start + chunk_size]
+
+    return arrays
+
+
+def get_phase_sidecar_name(dl2file):
+    """
+    Name of the Parquet file with the phases of a DL2 file ({name}.phase.parquet, next to the DL2 file).
+    """
+    root = dl2file[: -len(".h5")] if dl2file.endswith(".h5") else dl2file
+    return root + ".phase.parquet"
+
+
+def write_phase_sidecar(columns, output_file, row_group_size=100000, metadata=None):
+    """
+    Writes the phase information of a DL2 file in a Parquet file instead of rewriting the DL2 file.
+    The table is split in row groups with min/max statistics of each column, so readers can memory-map the file and load only the row ranges (or time ranges) they need.
+
+    Parameters:
+    -----------------
+    columns: dict or pandas.DataFrame
+    Columns to write (obs_id, event_id, mjd_barycenter_time and pulsar_phase)
+
+    output_file: string
+    Path of the Parquet file
+
+    row_group_size: int
+    Number of rows of each row group
+
+    metadata: dict
+    Information to store in the metadata of the file (it must be JSON serializable)
+
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if row_group_size < 1:
+        raise ValueError("The row group size must be a positive number of rows")
+
+    # Parquet has no extended precision type, so long double columns are stored in double precision
+    table = pa.table(
+        {
+            name: np.asarray(
+                values, dtype=np.float64 if np.asarray(values).dtype == np.longdouble else None
+            )
+            for name, values in columns.items()
+        }
+    )
+    if metadata is not None:
+        table = table.replace_schema_metadata(
+            {name: json.dumps(value) for name, value in metadata.items()}
+        )
+
+    # Write to a temporary name and rename so that readers never see a partial file
+    tmp_file = output_file + f".{os.getpid()}.tmp"
+    pq.write_table(
+        table,
+        tmp_file,
+        row_group_size=row_group_size,
+        compression="zstd",
+        write_statistics=True,
+    )
+    os.replace(tmp_file, output_file)
+
+
+def remove_phase_sidecar(dl2file):
+    # Removes the Parquet sidecar file of a DL2 file (if any), so that it does not hide the phases written to the 'phase_info' table
+    sidecar = get_phase_sidecar_name(dl2file)
+    if os.path.exists(sidecar):
+        print("Removing phase sidecar file " + sidecar)
+        os.remove(sidecar)
+
+
+def read_phase_info(dl2file, columns=None, start=None, stop=None):
+    """
+    Reads the phase information of a DL2 file. If the phases were written to a Parquet sidecar file (see write_phase_sidecar), the file is memory-mapped
+    and only the row groups that overlap the requested rows are read. Otherwise, the 'phase_info' table of the DL2 file is read.
+
+    Parameters:
+    -----------------
+    dl2file: string
+    DL2 file
+
+    columns: list
+    Columns to read. If None, all the columns are read
+
+    start: int
+    First row to read
+
+    stop: int
+    Row after the last one to read
+
+    Returns:
+    -----------------
+    Pandas DataFrame with the requested rows, indexed by their row number in the DL2 file
+
+    """
+    sidecar = get_phase_sidecar_name(dl2file)
+    if not os.path.exists(sidecar):
+        with pd.HDFStore(dl2file, mode="r") as store:
+            if store.get_storer("phase_info").is_table:
+                # Tables written in chunks can be read by rows
+                return store.select(
+                    "phase_info", start=start, stop=stop, columns=columns
+                )
+            df = store["phase_info"].iloc[start:stop]
+        return df if columns is None else df[columns]
+
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(sidecar, memory_map=True)
+    start, stop, _ = slice(start, stop).indices(parquet_file.metadata.num_rows)
+
+    # Row groups overlapping the requested rows
+    row_group_rows = [
+        parquet_file.metadata.row_group(i).num_rows
+        for i in range(parquet_file.num_row_groups)
+    ]
+    row_group_start = np.concatenate(([0], np.cumsum(row_group_rows)))
+    first = max(np.searchsorted(row_group_start, start, side="right") - 1, 0)
+    last = np.searchsorted(row_group_start, stop, side="left")
+    row_groups = list(range(first, min(last, parquet_file.num_row_groups)))
+
+    table = parquet_file.read_row_groups(row_groups, columns=columns)
+    offset = start - row_group_start[first]
+    df = table.slice(offset, stop - start).to_pandas()
+    df.index = pd.RangeIndex(start, start + len(df))
+
+    return df
+
+
+def read_phase_metadata(dl2file):
+    """
+    Reads the metadata of the phase information of a DL2 file (e.g. the result of the phase audit, 'phase_audit'), from the Parquet sidecar file if it exists or
+    from the attributes of the 'phase_info' table.
+    """
+    sidecar = get_phase_sidecar_name(dl2file)
+    if os.path.exists(sidecar):
+        import pyarrow.parquet as pq
+
+        metadata = pq.read_schema(sidecar, memory_map=True).metadata or {}
+        return {
+            name.decode(): json.loads(value)
+            for name, value in metadata.items()
+            if not name.startswith(b"pandas") and not name.startswith(b"ARROW")
+        }
+
+    with pd.HDFStore(dl2file, mode="r") as store:
+        audit = getattr(store.get_storer("phase_info").attrs, "phase_audit", None)
+    return {} if audit is None else {"phase_audit": audit}
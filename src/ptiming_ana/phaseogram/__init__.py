@@ -5,6 +5,7 @@ from .phasebinning import PhaseBinning
 from .lightcurve import Lightcurve
 from .phase_regions import PhaseRegions, PulsarPeak
 from .periodicity_test import PeriodicityTest
+from .phase_cube import PhaseCube
 from .ptime_analysis import PulsarTimeAnalysis
 from .filter_object import FilterPulsarAna
 from .read_events import ReadFermiFile, ReadLSTFile, ReadList
@@ -20,6 +21,7 @@ __all__ = [
     "PhaseBinning",
     "PulsarPeak",
     "PeriodicityTest",
+    "PhaseCube",
     "PulsarTimeAnalysis",
     "ReadFermiFile",
     "ReadLSTFile",
@@ -40,6 +40,13 @@ class Lightcurve:
             pulsar_phases.phases, bins=binning.edges
         )  # Create the histogram
 
+    @classmethod
+    def from_counts(cls, counts, binning):
+        # Lightcurve from the counts of each bin (e.g. accumulated over several sets of events)
+        lightcurve = cls.__new__(cls)
+        lightcurve.lc = (np.array(counts), np.asarray(binning.edges, dtype=float))
+        return lightcurve
+
     ##############################################
     # EXECUTION
     #############################################
@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import copy
 import logging
+from .phase_cube import PhaseCube
 
 __all__ = ["PEnergyAnalysis"]
 
@@ -79,19 +80,56 @@ class PEnergyAnalysis:
     # EXECUTION
     #############################################
 
+    def init_cube_events(self, pulsarana):
+        # Sort the events by energy class once, so that the events of each energy bin of the cube are a contiguous range
+        if pulsarana.cube is None:
+            pulsarana.cube = PhaseCube.from_analysis(pulsarana)
+        cube = pulsarana.cube
+
+        classes = PhaseCube.get_energy_classes(
+            pulsarana.info["energy"].values, cube.energy_edges
+        )
+
+        nclasses = 2 * len(self.energy_edges) + 2
+        self.cube_order = np.argsort(classes, kind="stable")
+        self.cube_bounds = np.searchsorted(
+            classes[self.cube_order], np.arange(nclasses + 1)
+        )
+
+    def select_events(self, pulsarana, i, integral=False):
+        # Events of an energy bin, their phases and the energy classes of the cube (if it is used)
+        dataframe = pulsarana.info
+        if pulsarana.use_cube:
+            energy = pulsarana.cube.get_energy_slice(i, integral=integral)
+            rows = np.sort(
+                self.cube_order[
+                    self.cube_bounds[energy.start] : self.cube_bounds[energy.stop]
+                ]
+            )
+            return dataframe.iloc[rows], pulsarana.phases[rows], energy
+
+        if integral:
+            di = dataframe[(dataframe["energy"] > self.energy_edges[i])]
+        else:
+            di = dataframe[
+                (dataframe["energy"] > self.energy_edges[i])
+                & (dataframe["energy"] < self.energy_edges[i + 1])
+            ]
+
+        return di, np.array(di["pulsar_phase"].to_list()), None
+
     def run(self, pulsarana):
         self.energy_units = pulsarana.energy_units
         self.tobs = pulsarana.tobs
 
+        if pulsarana.use_cube:
+            self.init_cube_events(pulsarana)
+
         if self.do_diff:
             # Create array of PulsarPhases objects binning in energy
             self.Parray = []
             for i in range(0, len(self.energy_edges) - 1):
-                dataframe = pulsarana.info
-                di = dataframe[
-                    (dataframe["energy"] > self.energy_edges[i])
-                    & (dataframe["energy"] < self.energy_edges[i + 1])
-                ]
+                di, phases, energy = self.select_events(pulsarana, i)
 
                 logger.info(
                     "Creating object in "
@@ -101,7 +139,7 @@ class PEnergyAnalysis:
                 )
                 self.Parray.append(copy.copy(pulsarana))
                 self.Parray[i].setTimeInterval(self.Parray[i].tint)
-                self.Parray[i].phases = np.array(di["pulsar_phase"].to_list())
+                self.Parray[i].phases = phases
                 self.Parray[i].info = di
 
                 self.Parray[i].init_regions()
@@ -115,13 +153,14 @@ class PEnergyAnalysis:
 
                 # Update the information every 1 hour and store final values
                 logger.info("Calculating statistics...")
-                self.Parray[i].execute_stats(self.tobs)
+                self.Parray[i].execute_stats(self.tobs, energy)
 
         if self.do_integral:
             self.Parray_integral = []
             for i in range(0, len(self.energy_edges) - 1):
-                dataframe = pulsarana.info
-                di = dataframe[(dataframe["energy"] > self.energy_edges[i])]
+                di, phases, energy = self.select_events(
+                    pulsarana, i, integral=True
+                )
 
                 logger.info(
                     "Creating object in "
@@ -131,7 +170,7 @@ class PEnergyAnalysis:
                 )
                 self.Parray_integral.append(copy.copy(pulsarana))
                 self.Parray_integral[i].setTimeInterval(self.Parray_integral[i].tint)
-                self.Parray_integral[i].phases = np.array(di["pulsar_phase"].to_list())
+                self.Parray_integral[i].phases = phases
                 self.Parray_integral[i].info = di
 
                 self.Parray_integral[i].init_regions()
@@ -145,7 +184,7 @@ class PEnergyAnalysis:
 
                 # Update the information every 1 hour and store final values
                 logger.info("Calculating statistics...")
-                self.Parray_integral[i].execute_stats(self.tobs)
+                self.Parray_integral[i].execute_stats(self.tobs, energy)
 
     ##############################################
     # RESULTS
@@ -1,4 +1,5 @@
 import numpy as np
+import numba as nb
 
 # from decimal import *
 from pylab import sum
@@ -7,6 +8,58 @@ import pandas as pd
 
 __all__ = ["PeriodicityTest"]
 
+
+@nb.njit(parallel=True, cache=True)
+def _trig_moments(phases, n, block_size):
+    # Sums of cos(k*2pi*phase) and sin(k*2pi*phase) for k=1..n. The harmonics of each phase are obtained with the angle-addition recurrence
+    # (only one cos and sin evaluation per event) and each block of events is summed separately and in parallel, so no N x n arrays are created
+    nblocks = (len(phases) + block_size - 1) // block_size
+    cos_blocks = np.zeros((nblocks, n))
+    sin_blocks = np.zeros((nblocks, n))
+    for b in nb.prange(nblocks):
+        cos_sum = np.zeros(n)
+        sin_sum = np.zeros(n)
+        for i in range(b * block_size, min((b + 1) * block_size, len(phases))):
+            x = 2 * np.pi * phases[i]
+            c1 = np.cos(x)
+            s1 = np.sin(x)
+            c = c1
+            s = s1
+            for k in range(n):
+                cos_sum[k] += c
+                sin_sum[k] += s
+                c, s = c * c1 - s * s1, s * c1 + c * s1
+        cos_blocks[b] = cos_sum
+        sin_blocks[b] = sin_sum
+
+    return (cos_blocks, sin_blocks)
+
+
+@nb.njit(parallel=True, cache=True)
+def _grouped_trig_moments(phases, groups, ngroups, n, nblocks):
+    # Same as _trig_moments, but summing the moments of each group of events separately (events with a negative group are skipped).
+    # Each block of events (one per thread) accumulates its own sums, so the extra memory is nblocks x ngroups x n
+    block_size = (len(phases) + nblocks - 1) // nblocks
+    cos_blocks = np.zeros((nblocks, ngroups, n))
+    sin_blocks = np.zeros((nblocks, ngroups, n))
+    for b in nb.prange(nblocks):
+        for i in range(b * block_size, min((b + 1) * block_size, len(phases))):
+            g = groups[i]
+            if g < 0:
+                continue
+            x = 2 * np.pi * phases[i]
+            c1 = np.cos(x)
+            s1 = np.sin(x)
+            c = c1
+            s = s1
+            for k in range(n):
+                cos_blocks[b, g, k] += c
+                sin_blocks[b, g, k] += s
+                c, s = c * c1 - s * s1, s * c1 + c * s1
+
+    return (cos_blocks, sin_blocks)
+
+
 class PeriodicityTest:
     """
     A class to apply and store the information of the periodicty tests.
@@ -14,6 +67,8 @@ class PeriodicityTest:
     Parameters
     ----------
     pulsar_phases : PulsarPhases object
+    n_harmonics : int
+        Number of harmonics of the trigonometric moments (used by the H test)
 
     Attributes
     ----------
@@ -31,8 +86,36 @@ class PeriodicityTest:
         Results of the H test. Format: [Statistic, p_value, nsigmas]
     """
 
-    def __init__(self, pulsar_phases):
-        self.apply_all_tests(pulsar_phases)
+    def __init__(self, pulsar_phases=None, n_harmonics=25):
+        self.n_harmonics = n_harmonics
+        if pulsar_phases is not None:
+            self.apply_all_tests(pulsar_phases)
+
+    @classmethod
+    def from_moments(cls, number, cos, sin, histogram):
+        """
+        Applies the tests from the trigonometric moments of the phases instead of the phases themselves (e.g. moments accumulated over several sets of events).
+
+        Parameters
+        ----------
+        number : int
+            Number of phases
+        cos : list of float
+            Cosine moments of the phases
+        sin : list of float
+            Sine moments of the phases
+        histogram : Lightcurve object
+            Phaseogram used for the chi square test
+        """
+        stats = cls(n_harmonics=len(cos))
+        stats.chisqr_res = histogram.chi_sqr_pulsar_test()
+
+        stats.number = number
+        stats.cos = np.array(cos)
+        stats.sin = np.array(sin)
+        stats.apply_moment_tests()
+
+        return stats
 
     ##############################################
     # EXECUTION
@@ -43,7 +126,7 @@ class PeriodicityTest:
         self.chisqr_res = pulsar_phases.histogram.chi_sqr_pulsar_test()
 
         # Apply unbinned statistical tests
-        self.moments(pulsar_phases)
+        self.moments(pulsar_phases, n=self.n_harmonics)
         self.apply_moment_tests()
 
     def apply_moment_tests(self):
@@ -51,17 +134,31 @@ class PeriodicityTest:
         self.zn_test(n=10)
         self.Htest_res = self.H_test()
 
-    def moments(self, pulsar_phases, n=25):
-        # Transform list to be between 0 and 2pi
-        plist = (pulsar_phases.phases) * 2 * np.pi
+    @staticmethod
+    def trig_moments(phases, n=25, block_size=65536):
+        # Calculate moments (sums of the cosine and sine of the first n harmonics of the phases)
+        phases = np.ascontiguousarray(phases, dtype=np.float64)
+        cos_blocks, sin_blocks = _trig_moments(phases, n, block_size)
+
+        return (np.sum(cos_blocks, axis=0), np.sum(sin_blocks, axis=0))
+
+    @staticmethod
+    def grouped_trig_moments(phases, groups, ngroups, n=25):
+        # Moments of each group of events (groups given as an integer index per event, from 0 to ngroups-1)
+        phases = np.ascontiguousarray(phases, dtype=np.float64)
+        groups = np.ascontiguousarray(groups, dtype=np.int64)
+        nblocks = max(1, min(nb.get_num_threads(), len(phases) // 65536))
+        cos_blocks, sin_blocks = _grouped_trig_moments(
+            phases, groups, ngroups, n, nblocks
+        )
+
+        return (np.sum(cos_blocks, axis=0), np.sum(sin_blocks, axis=0))
 
-        # Calculate moments
-        k = np.arange(1, n + 1)
-        cos_moment = sum(np.cos(np.outer(plist, k)), axis=0)
-        sin_moment = sum(np.sin(np.outer(plist, k)), axis=0)
+    def moments(self, pulsar_phases, n=25):
+        cos_moment, sin_moment = self.trig_moments(pulsar_phases.phases, n)
 
         # Store the information
-        self.number = len(plist)
+        self.number = len(pulsar_phases.phases)
         self.cos = cos_moment
         self.sin = sin_moment
 
@@ -84,17 +181,11 @@ class PeriodicityTest:
 
     def H_test(self):
         bn = 0.398
-        h = []
 
-        # Calculate statistic and pvalue
-        for m in np.arange(1, len(self.cos)):
-            h.append(
-                2
-                / self.number
-                * sum(np.power(self.cos[0:m], 2) + np.power(self.sin[0:m], 2))
-                - 4 * m
-                + 4
-            )
+        # Calculate statistic and pvalue, reusing the cumulative power of the harmonics for all m
+        m = np.arange(1, len(self.cos))
+        power = np.cumsum(np.power(self.cos, 2) + np.power(self.sin, 2))
+        h = 2 / self.number * power[m - 1] - 4 * m + 4
         H = max(h)
         pvalue_H = np.exp(-bn * H)
         sigmas_H = norm.isf(float(pvalue_H), loc=0, scale=1)
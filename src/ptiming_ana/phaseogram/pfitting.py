@@ -12,6 +12,7 @@ from .models import (
     lorentzian,
 )
 from more_itertools import sort_together
+from .phasebinning import wrap_phases
 
 __all__ = ["PeakFitting"]
 
@@ -116,17 +117,13 @@ class PeakFitting:
     def fit_ULmodel(self, pulsar_phases):
         self.check_model()
 
-        # Shift the phases if one of the peak is near the interval edge
-        shift_phases = pulsar_phases.phases
+        # Shift the phases if one of the peak is near the interval edge (on a copy, so that the phases of the analysis are not modified)
+        shift_phases = np.array(pulsar_phases.phases)
         if self.shift != 0:
-            for i in range(0, len(shift_phases)):
-                if shift_phases[i] < self.shift:
-                    shift_phases[i] = shift_phases[i] + 1
+            wrap_phases(shift_phases, self.shift)
 
         if self.model == "dgaussian":
-            unbinned_likelihood = cost.UnbinnedNLL(
-                double_gaussian, np.array(shift_phases)
-            )
+            unbinned_likelihood = cost.UnbinnedNLL(double_gaussian, shift_phases)
             minuit = Minuit(
                 unbinned_likelihood,
                 mu=self.init[0],
@@ -144,9 +141,7 @@ class PeakFitting:
             minuit.fixed["A"] = True
 
         if self.model == "tgaussian":
-            unbinned_likelihood = cost.UnbinnedNLL(
-                triple_gaussian, np.array(shift_phases)
-            )
+            unbinned_likelihood = cost.UnbinnedNLL(triple_gaussian, shift_phases)
             minuit = Minuit(
                 unbinned_likelihood,
                 Bkg=self.init[-1],
@@ -180,7 +175,7 @@ class PeakFitting:
 
         elif self.model == "asym_dgaussian":
             unbinned_likelihood = cost.UnbinnedNLL(
-                assymetric_double_gaussian, np.array(shift_phases)
+                assymetric_double_gaussian, shift_phases
             )
             minuit = Minuit(
                 unbinned_likelihood,
@@ -207,9 +202,7 @@ class PeakFitting:
             ]
 
         elif self.model == "double_lorentz":
-            unbinned_likelihood = cost.UnbinnedNLL(
-                double_lorentz, np.array(shift_phases)
-            )
+            unbinned_likelihood = cost.UnbinnedNLL(double_lorentz, shift_phases)
             minuit = Minuit(
                 unbinned_likelihood,
                 mu_1=self.init[0],
@@ -223,7 +216,7 @@ class PeakFitting:
             self.parnames = ["mu_1", "gamma_1", "mu_2", "gamma_2", "A", "B", "C"]
 
         elif self.model == "lorentzian":
-            unbinned_likelihood = cost.UnbinnedNLL(lorentzian, np.array(shift_phases))
+            unbinned_likelihood = cost.UnbinnedNLL(lorentzian, shift_phases)
             minuit = Minuit(
                 unbinned_likelihood,
                 mu_1=self.init[0],
@@ -234,7 +227,7 @@ class PeakFitting:
             self.parnames = ["mu_1", "gamma_1", "A", "B"]
 
         elif self.model == "gaussian":
-            unbinned_likelihood = cost.UnbinnedNLL(gaussian, np.array(shift_phases))
+            unbinned_likelihood = cost.UnbinnedNLL(gaussian, shift_phases)
             minuit = Minuit(
                 unbinned_likelihood,
                 mu=self.init[0],
@@ -266,14 +259,13 @@ class PeakFitting:
         histogram = pulsar_phases.histogram
 
         # Shift the phases if one of the peak is near the interval edge
-        shift_phases = list(histogram.lc[1][:-1])
+        shift_phases = np.array(histogram.lc[1][:-1])
         bin_height = list(histogram.lc[0])
 
         if self.shift != 0:
-            for i in range(0, len(shift_phases)):
-                if shift_phases[i] < self.shift:
-                    shift_phases[i] = shift_phases[i] + 1
+            wrap_phases(shift_phases, self.shift)
 
+        shift_phases = list(shift_phases)
         bin_height = np.array(sort_together([shift_phases, bin_height])[1])
         shift_phases.sort()
         shift_phases.append(shift_phases[0] + 1)
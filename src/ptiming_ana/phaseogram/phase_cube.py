@@ -0,0 +1,380 @@
+import numpy as np
+from .lightcurve import Lightcurve
+from .periodicity_test import PeriodicityTest
+from .phasebinning import PhaseBinning
+
+__all__ = ["PhaseCube"]
+
+
+class PhaseCube:
+    """
+    A class to store the events binned in (time slice, energy class, phase bin), together with the number of events of each phase region and the trigonometric moments
+    of each (time slice, energy class) cell. The cube is filled in a single pass over the events, and the phaseograms, region statistics and periodicity tests of any
+    energy range and time interval (including the time evolution, from prefix sums over the time slices) are obtained from it without reading the events again.
+
+    The time slices are limited by the numbers of events (in time order) of the steps of the time evolution: slice k contains the events added in step k,
+    and the last slice the events after the last step. If the events are not sorted in time, a step can contain fewer events than the previous one,
+    so the limits of the slices are the sorted numbers of events of the steps (see get_step_slices).
+    The energy classes keep the selection of the energy analysis (strict inequalities): class 2i+2 contains the events with energy_edges[i] < E < energy_edges[i+1],
+    the odd classes the events exactly at an edge, class 0 the events below the first edge, class 2M+2 the ones above the last edge and the last class the events without energy.
+
+    Parameters
+    ----------
+    phase_edges : array
+        Edges of the phase bins
+    energy_edges : array
+        Edges of the energy bins (None if there is no energy binning)
+    steps : list
+        Number of events (in time order) and time limit of each step of the time evolution
+    exposure : array
+        Effective time of observation (in seconds) at each step
+    region_names : list
+        Names of the phase regions ('OFF' and the signal regions)
+    counts : array
+        Number of events in each (time slice, energy class, phase bin)
+    number : array
+        Number of events in each (time slice, energy class)
+    region_counts : array
+        Number of events of each region in each (time slice, energy class)
+    cos : array
+        Cosine moments of the phases in each (time slice, energy class)
+    sin : array
+        Sine moments of the phases in each (time slice, energy class)
+    """
+
+    def __init__(
+        self,
+        phase_edges,
+        energy_edges,
+        steps,
+        exposure,
+        region_names,
+        counts,
+        number,
+        region_counts,
+        cos,
+        sin,
+    ):
+        self.phase_edges = np.asarray(phase_edges, dtype=float)
+        self.energy_edges = (
+            None if energy_edges is None else np.asarray(energy_edges, dtype=float)
+        )
+        self.steps = list(steps)
+        self.exposure = np.asarray(exposure, dtype=float)
+        self.region_names = list(region_names)
+        self.counts = counts
+        self.number = number
+        self.region_counts = region_counts
+        self.cos = cos
+        self.sin = sin
+
+    @property
+    def nsteps(self):
+        return len(self.steps)
+
+    @property
+    def n_harmonics(self):
+        return self.cos.shape[-1]
+
+    @staticmethod
+    def get_slice_limits(steps):
+        # Sorted numbers of events of the steps, limiting the time slices
+        return np.unique(np.array([nevents for nevents, _ in steps], dtype=np.int64))
+
+    def get_step_slices(self):
+        """
+        Number of time slices (from the first one) with the events of each step of the time evolution.
+        """
+        step_events = [nevents for nevents, _ in self.steps]
+        return np.searchsorted(self.get_slice_limits(self.steps), step_events) + 1
+
+    ##############################################
+    # EXECUTION
+    #############################################
+
+    @staticmethod
+    def get_energy_classes(energies, energy_edges):
+        """
+        Energy class of each event (see the description of the class).
+        """
+        if energy_edges is None:
+            return np.zeros(len(energies), dtype=np.int64)
+
+        energies = np.asarray(energies, dtype=float)
+        classes = np.searchsorted(energy_edges, energies, side="left") + np.searchsorted(
+            energy_edges, energies, side="right"
+        )
+        classes[np.isnan(energies)] = 2 * len(energy_edges) + 1
+        return classes
+
+    @classmethod
+    def from_events(
+        cls,
+        phases,
+        times,
+        steps,
+        exposure,
+        phase_edges,
+        regions,
+        energies=None,
+        energy_edges=None,
+        n_harmonics=25,
+        chunk_size=1000000,
+    ):
+        """
+        Fills the cube in a single pass over the events (in chunks of events in time order).
+
+        Parameters
+        ----------
+        phases : array
+            Pulsar phases
+        times : array
+            Times of the events (used to sort them)
+        steps : list
+            Number of events (in time order) and time limit of each step of the time evolution (see PulsarTimeAnalysis.get_tsteps)
+        exposure : array
+            Effective time of observation (in seconds) at each step
+        phase_edges : array
+            Edges of the phase bins
+        regions : PhaseRegions object
+            OFF and signal regions
+        energies : array
+            Energies of the events (None if there is no energy binning)
+        energy_edges : array
+            Edges of the energy bins
+        n_harmonics : int
+            Number of harmonics of the trigonometric moments
+        chunk_size : int
+            Number of events processed at once
+
+        Returns
+        -------
+        PhaseCube
+        """
+        phase_edges = np.asarray(phase_edges, dtype=float)
+        if energy_edges is not None:
+            energy_edges = np.asarray(energy_edges, dtype=float)
+        if energies is None:
+            energy_edges = None
+
+        region_objects = {"OFF": regions.OFF}
+        for name, region in regions.dic.items():
+            if region is not None:
+                region_objects[name] = region
+
+        nphase = len(phase_edges) - 1
+        slice_limits = cls.get_slice_limits(steps)
+        nslices = len(slice_limits) + 1
+        nenergy = 1 if energy_edges is None else 2 * len(energy_edges) + 2
+        ncells = nslices * nenergy
+
+        counts = np.zeros(ncells * nphase, dtype=np.int64)
+        number = np.zeros(ncells, dtype=np.int64)
+        region_counts = np.zeros((len(region_objects), ncells), dtype=np.int64)
+        cos = np.zeros((ncells, n_harmonics))
+        sin = np.zeros((ncells, n_harmonics))
+
+        order = np.argsort(times, kind="stable")
+
+        for start in range(0, len(order), chunk_size):
+            rows = order[start : start + chunk_size]
+            phase = np.asarray(phases[rows], dtype=float)
+
+            # Cell (time slice, energy class) of each event
+            position = np.arange(start, start + len(rows))
+            cell = np.searchsorted(slice_limits, position, side="right") * nenergy
+            if energy_edges is not None:
+                cell += cls.get_energy_classes(energies[rows], energy_edges)
+
+            number += np.bincount(cell, minlength=ncells)
+
+            # Phase bins with the same convention as np.histogram (last bin closed, phases outside the edges are not counted)
+            phase_bin = np.searchsorted(phase_edges, phase, side="right") - 1
+            phase_bin[phase == phase_edges[-1]] = nphase - 1
+            inside = (phase_bin >= 0) & (phase_bin < nphase)
+            counts += np.bincount(
+                cell[inside] * nphase + phase_bin[inside], minlength=ncells * nphase
+            )
+
+            for j, region in enumerate(region_objects.values()):
+                for i in range(1, len(region.limits), 2):
+                    in_region = (phase > region.limits[i - 1]) & (
+                        phase < region.limits[i]
+                    )
+                    region_counts[j] += np.bincount(
+                        cell[in_region], minlength=ncells
+                    )
+
+            cos_moment, sin_moment = PeriodicityTest.grouped_trig_moments(
+                phase, cell, ncells, n_harmonics
+            )
+            cos += cos_moment
+            sin += sin_moment
+
+        return cls(
+            phase_edges,
+            energy_edges,
+            steps,
+            exposure,
+            list(region_objects),
+            counts.reshape(nslices, nenergy, nphase),
+            number.reshape(nslices, nenergy),
+            region_counts.reshape(len(region_objects), nslices, nenergy),
+            cos.reshape(nslices, nenergy, n_harmonics),
+            sin.reshape(nslices, nenergy, n_harmonics),
+        )
+
+    @classmethod
+    def from_analysis(cls, pulsar_phases, chunk_size=1000000):
+        """
+        Fills the cube with the events of a PulsarAnalysis object (after initialize), using its phase binning, regions, energy binning (if any) and time interval.
+        """
+        dataframe = pulsar_phases.info
+        time_analysis = pulsar_phases.TimeEv
+        time_analysis.set_diff_del(pulsar_phases)
+
+        steps = time_analysis.get_tsteps(dataframe)
+        order = np.argsort(dataframe.dragon_time.values, kind="stable")
+        exposure = time_analysis.get_exposure(dataframe, order)
+        exposure = [exposure[nevents] for nevents, _ in steps]
+
+        energy_edges = getattr(pulsar_phases, "energy_edges", None)
+        energies = None
+        if energy_edges is not None and "energy" in dataframe:
+            energies = np.asarray(dataframe["energy"].values, dtype=float)
+
+        return cls.from_events(
+            np.array(dataframe.pulsar_phase.to_list()),
+            dataframe.dragon_time.values,
+            steps,
+            exposure,
+            pulsar_phases.binning.edges,
+            pulsar_phases.regions,
+            energies=energies,
+            energy_edges=energy_edges,
+            n_harmonics=pulsar_phases.n_harmonics,
+            chunk_size=chunk_size,
+        )
+
+    def get_energy_slice(self, ebin=None, integral=False):
+        """
+        Energy classes of an energy bin.
+
+        Parameters
+        ----------
+        ebin : int
+            Index of the energy bin. If None, all the events are selected
+        integral : bool
+            If True, all the events with energy above the lower edge of the bin are selected
+
+        Returns
+        -------
+        slice
+        """
+        if ebin is None:
+            return slice(None)
+        if self.energy_edges is None:
+            raise ValueError("The cube has no energy binning")
+        if integral:
+            return slice(2 * ebin + 2, 2 * len(self.energy_edges) + 1)
+        return slice(2 * ebin + 2, 2 * ebin + 3)
+
+    def sum(self, energy=None, time=None):
+        """
+        Sums of the cube over some energy classes and time slices.
+
+        Parameters
+        ----------
+        energy : slice
+            Energy classes (see get_energy_slice). All if None
+        time : slice
+            Time slices. If None, the slices of the last step of the time evolution
+
+        Returns
+        -------
+        dict
+            Phase counts, number of events, number of events of each region and trigonometric moments
+        """
+        if energy is None:
+            energy = slice(None)
+        if time is None:
+            time = slice(0, self.get_step_slices()[-1] if self.nsteps > 0 else 0)
+
+        return {
+            "counts": self.counts[time, energy].sum(axis=(0, 1)),
+            "number": int(self.number[time, energy].sum()),
+            "regions": {
+                name: int(self.region_counts[i, time, energy].sum())
+                for i, name in enumerate(self.region_names)
+            },
+            "cos": self.cos[time, energy].sum(axis=(0, 1)),
+            "sin": self.sin[time, energy].sum(axis=(0, 1)),
+        }
+
+    def cumulative(self, energy=None):
+        """
+        Prefix sums over the time slices, i.e. the sums of all the events included at each step of the time evolution.
+
+        Parameters
+        ----------
+        energy : slice
+            Energy classes (see get_energy_slice). All if None
+
+        Returns
+        -------
+        dict
+            Same as sum, with the step as first axis of each array
+        """
+        if energy is None:
+            energy = slice(None)
+        steps = self.get_step_slices() - 1
+
+        return {
+            "counts": np.cumsum(self.counts[:, energy].sum(axis=1), axis=0)[steps],
+            "number": np.cumsum(self.number[:, energy].sum(axis=1))[steps],
+            "regions": {
+                name: np.cumsum(self.region_counts[i, :, energy].sum(axis=1))[steps]
+                for i, name in enumerate(self.region_names)
+            },
+            "cos": np.cumsum(self.cos[:, energy].sum(axis=1), axis=0)[steps],
+            "sin": np.cumsum(self.sin[:, energy].sum(axis=1), axis=0)[steps],
+        }
+
+    def get_binning(self, rebin=1):
+        """
+        Phase binning of the cube, merging groups of rebin bins.
+        """
+        nbins = len(self.phase_edges) - 1
+        if rebin < 1 or nbins % rebin != 0:
+            raise ValueError(
+                f"The number of phase bins ({nbins}) must be a multiple of the rebinning factor"
+            )
+        return PhaseBinning(self.phase_edges[::rebin])
+
+    def get_lightcurve(self, energy=None, time=None, rebin=1):
+        """
+        Phaseogram of some energy classes and time slices (see sum), merging groups of rebin phase bins.
+
+        Returns
+        -------
+        Lightcurve object
+        """
+        binning = self.get_binning(rebin)
+        counts = self.sum(energy, time)["counts"]
+        return Lightcurve.from_counts(counts.reshape(-1, rebin).sum(axis=1), binning)
+
+    def get_stats(self, energy=None, time=None, rebin=1):
+        """
+        Periodicity tests of some energy classes and time slices (see sum). The chi square test uses the phaseogram with groups of rebin phase bins merged.
+
+        Returns
+        -------
+        PeriodicityTest object
+        """
+        sums = self.sum(energy, time)
+        return PeriodicityTest.from_moments(
+            sums["number"],
+            sums["cos"],
+            sums["sin"],
+            self.get_lightcurve(energy, time, rebin),
+        )
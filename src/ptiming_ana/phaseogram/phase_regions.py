@@ -2,15 +2,23 @@ import numpy as np
 import pandas as pd
 from gammapy.stats import WStatCountsStatistic
 
-__all__ = ["calculate_CountStats", "PhaseRegions", "PulsarPeak"]
+__all__ = [
+    "calculate_CountStats",
+    "calculate_NumberStats",
+    "PhaseRegions",
+    "PulsarPeak",
+]
 
 
 def calculate_CountStats(on_file, off_file=None, factor=None):
     if off_file is None:
         raise ValueError("No off data given for the pulsar analysis")
 
-    Non = len(on_file)
-    Noff = len(off_file)
+    return calculate_NumberStats(len(on_file), len(off_file), factor)
+
+
+def calculate_NumberStats(Non, Noff, factor):
+    # Same as calculate_CountStats, but from the number of events in the ON and OFF regions
     stat = WStatCountsStatistic(n_on=Non, n_off=Noff, alpha=factor)
     yerr = np.sqrt(Non + ((factor**2) * Noff))
 
@@ -77,6 +85,51 @@ class PhaseRegions:
             "P3": P3_object,
         }
 
+    def fill(self, phases, tobs=None, sorted_counts=False, phases_sorted=False):
+        """
+        Fills the OFF and signal regions with a list of phases and, if the time of observation is given, calculates the statistics of the signal regions.
+
+        Parameters
+        ----------
+        phases : numpy array
+            List of phases
+        tobs : float
+            Effective time of observation in hours. If None, the statistics are not calculated
+        sorted_counts : bool
+            If True, the phases are sorted once and the events of each region are counted with a binary search (the phases of each region are not stored,
+            they can be obtained with get_indices). Otherwise, the phases of each region are stored
+        phases_sorted : bool
+            True if the phases are already sorted (only with sorted_counts)
+        """
+        if sorted_counts:
+            if not phases_sorted:
+                phases = np.sort(phases)
+            fill_region = PulsarPeak.countPeak
+        else:
+            fill_region = PulsarPeak.fillPeak
+
+        # Fill the background region first, since it is needed for the statistics of the signal regions
+        fill_region(self.OFF, phases)
+        for region in self.dic.values():
+            if region is not None:
+                fill_region(region, phases)
+                if tobs is not None:
+                    region.make_stats(self, tobs)
+
+    def get_counts(self):
+        # Number of events in each region (after fill)
+        counts = {"OFF": self.OFF.number}
+        for key, value in self.dic.items():
+            if value is not None:
+                counts[key] = value.number
+        return counts
+
+    def get_indices(self, name, phases):
+        # Indices of the events of a region in a list of phases
+        if name == "OFF":
+            return self.OFF.get_indices(phases)
+        return self.dic[name].get_indices(phases)
+
     def remove_peak(self, name):
         del self.dic[name]
         self.npeaks = self.npeaks - 1
@@ -160,7 +213,7 @@ class PulsarPeak:
     deltaP: float
         the total phase range of the region
     phases: numpy array
-        list of phases that fall into the region
+        list of phases that fall into the region (None if the region was filled with countPeak)
     number: int
         number of events in the region
     nregions: int
@@ -212,12 +265,45 @@ class PulsarPeak:
         else:
             raise ValueError("Wrong defined regions")
 
-    # Make statistics if the region is signal type only
+    def countPeak(self, sorted_phases):
+        # Same as fillPeak, but counting the events with a binary search in the sorted phases. The phases of the region are not stored
+        if len(self.limits) % 2 != 0:
+            raise ValueError("Wrong defined regions")
+
+        lower = np.searchsorted(sorted_phases, self.limits[0::2], side="right")
+        upper = np.searchsorted(sorted_phases, self.limits[1::2], side="left")
+        self.phases = None
+        self.number = int(np.sum(np.maximum(upper - lower, 0)))
+        self.nregions = len(self.limits) / 2
+
+    def get_indices(self, phases):
+        # Indices of the phases that fall into the region
+        if len(self.limits) % 2 != 0:
+            raise ValueError("Wrong defined regions")
+
+        mask = np.zeros(len(phases), dtype=bool)
+        for i in range(1, len(self.limits), 2):
+            mask |= (phases > self.limits[i - 1]) & (phases < self.limits[i])
+        return np.flatnonzero(mask)
+
+    def count(self, phases):
+        # Number of phases that fall into the region (without storing them)
+        if len(self.limits) % 2 != 0:
+            raise ValueError("Wrong defined regions")
+
+        number = 0
+        for i in range(1, len(self.limits), 2):
+            number += np.count_nonzero(
+                (phases > self.limits[i - 1]) & (phases < self.limits[i])
+            )
+        return number
+
+    # Make statistics if the region is signal type only. They only depend on the number of events of the region and of the OFF region
     def make_stats(self, regions, tobs):
         if self.type == "signal":
-            stats, yerror, noff = calculate_CountStats(
-                self.phases,
-                off_file=regions.OFF.phases,
+            stats, yerror, noff = calculate_NumberStats(
+                self.number,
+                regions.OFF.number,
                 factor=(self.deltaP) / regions.OFF.deltaP,
             )
             self.sign = stats.sqrt_ts.item()
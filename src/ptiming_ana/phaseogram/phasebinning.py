@@ -1,6 +1,6 @@
 import numpy as np
 
-__all__ = ["PhaseBinning"]
+__all__ = ["PhaseBinning", "wrap_phases"]
 
 
 class PhaseBinning:
@@ -84,3 +84,40 @@ class PhaseBinning:
                     return i
                 else:
                     return i - 1
+
+
+def wrap_phases(phases, xmin=0, copy=False, chunk_size=1000000):
+    """
+    Wraps the pulsar phases below xmin to the next cycle (adding 1 to them), e.g. to center the phaseogram or a fit on a peak near the edge of the phase interval.
+    The phases are processed chunk by chunk, so the temporary arrays are small even for very large or memory-mapped arrays.
+
+    Parameters
+    ----------
+    phases : numpy array, memory-mapped array or list of arrays
+        Pulsar phases. Arrays are modified in place unless copy is True (other sequences are always copied). A list of arrays is wrapped array by array
+    xmin : float
+        Lower edge of the phase interval
+    copy : bool
+        True if want to wrap a copy of the phases and leave the input unchanged
+    chunk_size : int
+        Number of phases wrapped at once
+
+    Returns
+    -------
+    numpy array or list of arrays
+        The wrapped phases (the input array itself, or the list of arrays, if copy is False)
+    """
+    if chunk_size < 1:
+        raise ValueError("The chunk size must be a positive number of phases")
+
+    if isinstance(phases, (list, tuple)) and len(phases) > 0 and np.ndim(phases[0]) > 0:
+        return [wrap_phases(chunk, xmin, copy, chunk_size) for chunk in phases]
+
+    if copy or not isinstance(phases, np.ndarray):
+        phases = np.array(phases)
+
+    for start in range(0, len(phases), chunk_size):
+        chunk = phases[start : start + chunk_size]
+        chunk[chunk < xmin] += 1
+
+    return phases
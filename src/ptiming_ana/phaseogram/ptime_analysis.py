@@ -1,6 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
+import numba as nb
 from scipy.optimize import curve_fit
+from .lightcurve import Lightcurve
+from .periodicity_test import PeriodicityTest
 
 __all__ = ["PulsarTimeAnalysis", "function_sqrt", "function_lin"]
 
@@ -13,6 +16,46 @@ def function_lin(x, A):
     return A * x
 
 
+@nb.njit(cache=True)
+def _unsorted_exposure(times, order):
+    # Effective time of the first n events in time order, summing the differences (below 1 s) between consecutive events in the order of the rows.
+    # Starting from all the events, they are removed in reverse time order from a linked list of the rows, updating the sum at each removal
+    n = len(times)
+    prev_row = np.arange(-1, n - 1)
+    next_row = np.arange(1, n + 1)
+
+    total = 0.0
+    for i in range(n - 1):
+        d = abs(times[i + 1] - times[i])
+        if d < 1:
+            total += d
+
+    exposure = np.zeros(n + 1)
+    exposure[n] = total
+    for k in range(n - 1, 0, -1):
+        row = order[k]
+        p = prev_row[row]
+        q = next_row[row]
+        if p >= 0:
+            d = abs(times[row] - times[p])
+            if d < 1:
+                total -= d
+            next_row[p] = q
+        if q < n:
+            d = abs(times[q] - times[row])
+            if d < 1:
+                total -= d
+            prev_row[q] = p
+        if p >= 0 and q < n:
+            d = abs(times[q] - times[p])
+            if d < 1:
+                total += d
+        exposure[k] = total
+
+    exposure[1] = 0.0
+    return exposure
+
+
 class PulsarTimeAnalysis:
     def __init__(self, tint=3600):
         # Define the arrays to store information
@@ -59,7 +102,7 @@ class PulsarTimeAnalysis:
             self.P1P2exTime.append(pulsar_phases.regions.P1P2.Nex)
             self.P1P2exerror.append(pulsar_phases.regions.P1P2.yerr)
 
-    def update_tinfo(self, pulsar_phases, dataframe):
+    def set_tinfo(self, pulsar_phases, dataframe):
         # Update info in the main object
         pulsar_phases.phases = np.array(dataframe.pulsar_phase.to_list())
         pulsar_phases.times = np.array(dataframe.dragon_time.to_list())
@@ -70,6 +113,9 @@ class PulsarTimeAnalysis:
         except AttributeError:
             pass
 
+    def update_tinfo(self, pulsar_phases, dataframe):
+        self.set_tinfo(pulsar_phases, dataframe)
+
         if "delta_t" in pulsar_phases.info:
             diff = pulsar_phases.info.delta_t
             self.t.append(sum(diff[diff < 1]))
@@ -88,37 +134,214 @@ class PulsarTimeAnalysis:
         # Store the results
         self.store_Tvalues(pulsar_phases)
 
-    def run(self, pulsar_phases):
-        dataframe = pulsar_phases.info
-        diff = abs(dataframe.dragon_time.values[1:] - dataframe.dragon_time.values[:-1])
-        s = 0
-        self.t = [0]
+    def get_tsteps(self, dataframe):
+        # Steps of the time evolution, as the number of events (in time order) and the time limit of each step. The statistics are updated
+        # every time the accumulated time (ignoring the gaps longer than diff_del) exceeds tint, and at the end of the data
+        times = dataframe.dragon_time.values
+        sorted_times = np.sort(times)
+        diff = abs(times[1:] - times[:-1])
+        elapsed = np.cumsum(np.where(diff < self.diff_del, diff, 0))
+
+        steps = []
+        i = np.searchsorted(elapsed, self.tint, side="right")
+        while i < len(diff):
+            nevents = np.searchsorted(sorted_times, times[i + 1], side="left")
+            steps.append((nevents, times[i + 1]))
+            if i == len(diff) - 1:
+                return steps
+            i = np.searchsorted(elapsed, elapsed[i] + self.tint, side="right")
+
+        # Update last interval
+        if len(diff) > 0 and diff[-1] < self.diff_del:
+            steps.append((len(times), None))
+
+        return steps
+
+    def init_tstats(self, pulsar_phases):
+        # Running sums of the events included so far: phaseogram counts, number of events in each region, trigonometric moments
+        self.counts = np.zeros(pulsar_phases.binning.nbins, dtype=np.int64)
+        self.region_counts = {
+            name: 0
+            for name, region in pulsar_phases.regions.dic.items()
+            if region is not None
+        }
+        self.region_counts["OFF"] = 0
+        self.number = 0
+        self.cos = np.zeros(pulsar_phases.n_harmonics)
+        self.sin = np.zeros(pulsar_phases.n_harmonics)
+
+    def add_tstats(self, pulsar_phases, phases, remove=False):
+        # Add a new slice of events to the running sums (or remove it if remove is True)
+        sign = -1 if remove else 1
+        self.counts += sign * np.histogram(phases, bins=pulsar_phases.binning.edges)[0]
+
+        regions = pulsar_phases.regions
+        self.region_counts["OFF"] += sign * regions.OFF.count(phases)
+        for name in self.region_counts:
+            if name != "OFF":
+                self.region_counts[name] += sign * regions.dic[name].count(phases)
+
+        cos_moment, sin_moment = PeriodicityTest.trig_moments(phases, len(self.cos))
+        self.cos += sign * cos_moment
+        self.sin += sign * sin_moment
+        self.number += sign * len(phases)
+
+    def set_tstats(self, pulsar_phases):
+        # Calculate stats from the running sums
+        regions = pulsar_phases.regions
+        regions.OFF.number = self.region_counts["OFF"]
+        for name in self.region_counts:
+            if name != "OFF":
+                regions.dic[name].number = self.region_counts[name]
+                regions.dic[name].make_stats(regions, pulsar_phases.tobs)
+
+        pulsar_phases.histogram = Lightcurve.from_counts(
+            self.counts, pulsar_phases.binning
+        )
+        pulsar_phases.stats = PeriodicityTest.from_moments(
+            self.number, self.cos, self.sin, pulsar_phases.histogram
+        )
+
+    def update_tstats(self, pulsar_phases):
+        self.set_tstats(pulsar_phases)
+
+        # Store the results
+        self.store_Tvalues(pulsar_phases)
 
+    def set_diff_del(self, pulsar_phases):
         # Estimate from each telescope the interval of time at which we can ignore the differences of time
         if pulsar_phases.telescope == "fermi":
             self.diff_del = 3600 * 5
         else:
             self.diff_del = 3600
 
-        # Update the information
-        for i in range(0, len(diff)):
-            if diff[i] < self.diff_del:
-                s = s + diff[i]
+    def get_exposure(self, dataframe, order):
+        # Effective time of observation of the first n events in time order (for n from 0 to the number of events)
+        if "delta_t" in dataframe:
+            diff = dataframe.delta_t.values[order]
+            return np.concatenate([[0], np.cumsum(np.where(diff < 1, diff, 0))])
+
+        times = dataframe.dragon_time.values
+        if np.any(times[1:] < times[:-1]):
+            # The differences are taken between consecutive rows of the events of each step, which are not consecutive in time
+            return _unsorted_exposure(
+                np.ascontiguousarray(times, dtype=np.float64),
+                np.ascontiguousarray(order, dtype=np.int64),
+            )
 
-                # Update information when tobs>=tint
-                if s > self.tint:
-                    pulse_df_partial = dataframe[
-                        dataframe["dragon_time"] < dataframe.dragon_time.values[i + 1]
-                    ]
-                    self.update_tinfo(pulsar_phases, pulse_df_partial)
-                    s = 0
+        sorted_times = times[order]
+        diff = abs(sorted_times[1:] - sorted_times[:-1])
+        return np.concatenate([[0, 0], np.cumsum(np.where(diff < 1, diff, 0))])
 
-                # Update last interval
-                elif i == (len(diff) - 1):
-                    self.update_tinfo(pulsar_phases, dataframe)
+    def set_final_tinfo(self, pulsar_phases, dataframe, tmax):
+        # Leave the main object with the events of the last step
+        if tmax is not None:
+            dataframe = dataframe[dataframe["dragon_time"] < tmax]
+        self.set_tinfo(pulsar_phases, dataframe)
 
+        # The counts of the regions are already set from the running sums, the phases of each region are only stored if requested
+        if not pulsar_phases.sorted_counts:
+            pulsar_phases.regions.fill(pulsar_phases.phases)
+
+    def run(self, pulsar_phases):
+        dataframe = pulsar_phases.info
+        self.t = [0]
+        self.set_diff_del(pulsar_phases)
+
+        steps = self.get_tsteps(dataframe)
+        if len(steps) == 0:
+            return
+
+        # Each step contains the events of the previous one plus a new slice (in time order), so the statistics
+        # are updated with the new events only and the whole time evolution is done in a single pass over the data
+        order = np.argsort(dataframe.dragon_time.values, kind="stable")
+        phases = np.array(dataframe.pulsar_phase.to_list())[order]
+        exposure = self.get_exposure(dataframe, order)
+
+        self.init_tstats(pulsar_phases)
+        start = 0
+        for nevents, _ in steps:
+            if nevents >= start:
+                self.add_tstats(pulsar_phases, phases[start:nevents])
             else:
-                diff[i] = 0
+                # If the events are not sorted in time, a step can contain fewer events than the previous one
+                self.add_tstats(pulsar_phases, phases[nevents:start], remove=True)
+            start = nevents
+
+            self.t.append(exposure[nevents])
+            pulsar_phases.tobs = self.t[-1] / 3600
+            self.update_tstats(pulsar_phases)
+
+        self.set_final_tinfo(pulsar_phases, dataframe, steps[-1][1])
+
+    def run_cube(self, pulsar_phases, cube, energy=None):
+        """
+        Same as run, but taking the statistics of each step from the prefix sums of a PhaseCube, without reading the events.
+        The steps of the time evolution (and their effective time) are the ones of the events used to fill the cube, also when only some energy classes are used.
+        The final state of an energy bin is the same as with run: the totals of the cube over all the events of the bin (including the last time slice
+        of the cube if its events were selected), until the last step of the events of the bin and with their effective time.
+
+        Parameters
+        ----------
+        pulsar_phases : PulsarAnalysis object
+            Analysis to update. If energy is given, its info and phases must already contain the events of the selected energy classes
+            (see PEnergyAnalysis.select_events)
+        cube : PhaseCube object
+            Cube filled with the events of the analysis
+        energy : slice
+            Energy classes to use (see PhaseCube.get_energy_slice). All if None
+        """
+        self.t = [0]
+        if cube.nsteps == 0:
+            return
+
+        sums = cube.cumulative(energy)
+        for k in range(cube.nsteps):
+            self.counts = sums["counts"][k]
+            self.region_counts = {
+                name: sums["regions"][name][k] for name in cube.region_names
+            }
+            self.number = sums["number"][k]
+            self.cos = sums["cos"][k]
+            self.sin = sums["sin"][k]
+
+            self.t.append(cube.exposure[k])
+            pulsar_phases.tobs = self.t[-1] / 3600
+            self.update_tstats(pulsar_phases)
+
+        if energy is None:
+            self.set_final_tinfo(pulsar_phases, pulsar_phases.info, cube.steps[-1][1])
+            return
+
+        # Final state of the energy bin, from the totals of all its events (the last time slice holds the ones after the last step)
+        dataframe = pulsar_phases.info
+        times = dataframe.dragon_time.values
+        self.set_diff_del(pulsar_phases)
+        steps = self.get_tsteps(dataframe)
+        if len(steps) == 0:
+            return
+
+        last_time = cube.steps[-1][1]
+        if last_time is not None and np.any(times >= last_time):
+            totals = cube.sum(energy, slice(None))
+        else:
+            totals = cube.sum(energy)
+        self.counts = totals["counts"]
+        self.region_counts = totals["regions"]
+        self.number = totals["number"]
+        self.cos = totals["cos"]
+        self.sin = totals["sin"]
+
+        # Only the events after the last step of the bin itself are read (to remove them), as run leaves them out
+        nevents, tmax = steps[-1]
+        order = np.argsort(times, kind="stable")
+        if nevents < len(times):
+            phases = pulsar_phases.phases[order[nevents:]]
+            self.add_tstats(pulsar_phases, phases, remove=True)
+
+        pulsar_phases.tobs = self.get_exposure(dataframe, order)[nevents] / 3600
+        self.set_tstats(pulsar_phases)
+        self.set_final_tinfo(pulsar_phases, dataframe, tmax)
 
     ##############################################
     # RESULTS
@@ -8,9 +8,10 @@ from .ptime_analysis import PulsarTimeAnalysis
 from .phase_regions import PhaseRegions, PulsarPeak
 from .lightcurve import Lightcurve
 from .periodicity_test import PeriodicityTest
+from .phase_cube import PhaseCube
 from .pfitting import PeakFitting
 from .models import get_model_list
-from .phasebinning import PhaseBinning
+from .phasebinning import PhaseBinning, wrap_phases
 from .penergy_analysis import PEnergyAnalysis
 from .filter_object import FilterPulsarAna
 from .read_events import ReadDL3File, ReadFermiFile, ReadLSTFile, ReadList
@@ -96,6 +97,15 @@ class PulsarAnalysis:
         # Define default parameters for the binning
         self.setBinning(nbins=nbins)
 
+        # Define default number of harmonics for the periodicity tests
+        self.setHarmonics()
+
+        # Store the phases of each region by default (the sorted counting is optional)
+        self.setRegionCounting(False)
+
+        # Do not use the phase-energy-time cube by default
+        self.setPhaseCube(False)
+
         # Define default parameters for the fitting
         self.setFittingParams(model, binned, do_fit=False)
 
@@ -149,6 +159,28 @@ class PulsarAnalysis:
         self.nbins = nbins
         self.binning = PhaseBinning(nbins, xmin, xmax)
 
+    def setHarmonics(self, n_harmonics=25):
+        # Number of harmonics of the trigonometric moments used in the H test (at least 11 for the Z10 test)
+        if n_harmonics < 11:
+            raise ValueError("At least 11 harmonics are needed for the periodicity tests")
+        self.n_harmonics = n_harmonics
+
+    def setRegionCounting(self, sorted_counts=True):
+        # If sorted_counts is True, the events of the regions are counted in the sorted phases. It is faster, but the phases of each region are not stored
+        # (regions.P1.phases, regions.OFF.phases... are None, the events of a region can be obtained with regions.get_indices)
+        self.sorted_counts = sorted_counts
+
+    def setPhaseCube(self, use_cube=True):
+        """
+        If use_cube is True, the events are binned once in a PhaseCube (phase, energy and time slices) and the time evolution and the energy analysis are computed from it.
+
+        Note that the time evolution of each energy bin is then different from the one obtained without the cube: it uses the time steps and
+        effective times of observation of all the events (instead of the ones of the events of the bin). The final phaseogram, statistics and fit
+        of each energy bin are the same as without the cube.
+        """
+        self.use_cube = use_cube
+        self.cube = None
+
     def setParamCuts(
         self,
         gammaness_cut=None,
@@ -368,9 +400,7 @@ class PulsarAnalysis:
     #############################################
 
     def shift_phases(self, xmin):
-        for i in range(0, len(self.phases)):
-            if self.phases[i] < xmin:
-                self.phases[i] += 1
+        self.phases = wrap_phases(self.phases, xmin)
 
         self.info["pulsar_phase"] = self.phases
 
@@ -404,20 +434,14 @@ class PulsarAnalysis:
         )
 
     def update_info(self):
-        # Fill the background regions
-        self.regions.OFF.fillPeak(self.phases)
-
-        # Fill and calculate statistics of Peaks
-        for i in self.regions.dic:
-            if self.regions.dic[i] is not None:
-                self.regions.dic[i].fillPeak(self.phases)
-                self.regions.dic[i].make_stats(self.regions, self.tobs)
+        # Fill the regions and calculate statistics of Peaks
+        self.regions.fill(self.phases, self.tobs, sorted_counts=self.sorted_counts)
 
         # Create the phaseogram using the Lightcurve class
         self.histogram = Lightcurve(self, self.binning)
 
         # Apply Periodicity stats and store them using the PeriodicityTest Class
-        self.stats = PeriodicityTest(self)
+        self.stats = PeriodicityTest(self, n_harmonics=self.n_harmonics)
 
     def initialize(self):
         # Read the data and filter
@@ -436,9 +460,15 @@ class PulsarAnalysis:
         # Initialize the regions object
         self.init_regions()
 
-    def execute_stats(self, tobs):
+    def execute_stats(self, tobs, energy=None):
         # Update the information at a certain interval of time and store final values
-        self.TimeEv.run(self)
+        if self.use_cube:
+            # The cube is filled with all the events, the energy bins only select some of its energy classes
+            if energy is None:
+                self.cube = PhaseCube.from_analysis(self)
+            self.TimeEv.run_cube(self, self.cube, energy)
+        else:
+            self.TimeEv.run(self)
 
         # COmpute P1/P2 ratio
         self.regions.calculate_P1P2()
@@ -692,6 +722,23 @@ class PulsarAnalysis:
             except AttributeError:
                 pass
 
+            if self.use_cube and self.check_energyana():
+                pdf.savefig(self.draw_cube_note())
+
+    def draw_cube_note(self):
+        # Page of the results explaining the time steps used in the energy bins with the phase cube (see setPhaseCube)
+        fig = plt.figure(figsize=(12, 3))
+        fig.text(
+            0.05,
+            0.5,
+            "Computed with the phase-energy-time cube: the time evolution of each energy bin uses the time steps\n"
+            + "and effective times of observation of all the events. The final results of each energy bin\n"
+            + "are the same as without the cube.",
+            fontsize=15,
+            verticalalignment="center",
+        )
+        return fig
+
     def save_object(self, output_file):
         with open(output_file, "wb") as file:
             pickle.dump(self, file)
@@ -14,6 +14,7 @@ from gammapy.utils.regions import CircleSkyRegion
 from astropy.coordinates import SkyCoord
 import logging
 from regions import PointSkyRegion
+from ptiming_ana.cphase.utils import read_fits_columns, read_phase_info
 
 logger = logging.getLogger(__name__)
 
@@ -42,21 +43,26 @@ def compute_theta2(reco_src_x, reco_src_y, src_x, src_y):
 
 
 class ReadFermiFile:
-    def __init__(self, file):
+    def __init__(self, file, memmap=True):
         if "fits" not in file:
             raise ValueError("No FITS file provided for Fermi-LAT data")
         else:
             self.fname = file
+        self.memmap = memmap
 
     def read_file(self):
-        f = fits.open(self.fname)
+        # With memmap the table is not loaded in memory: only the columns used are read (for uncompressed files)
+        f = fits.open(self.fname, memmap=self.memmap)
         fits_table = f[1].data
         return fits_table
 
     def create_df_from_info(self, fits_table):
-        time = fits_table["BARYCENTRIC_TIME"].byteswap().newbyteorder()
-        phases = fits_table["PULSE_PHASE"].byteswap().newbyteorder()
-        energies = fits_table["ENERGY"].byteswap().newbyteorder()
+        columns = read_fits_columns(
+            fits_table, ["BARYCENTRIC_TIME", "PULSE_PHASE", "ENERGY"]
+        )
+        time = columns["BARYCENTRIC_TIME"]
+        phases = columns["PULSE_PHASE"]
+        energies = columns["ENERGY"]
         dataframe = pd.DataFrame(
             {
                 "mjd_time": time,
@@ -228,7 +234,9 @@ class ReadLSTFile:
             if not self.src_dependent:
                 df_or = pd.read_hdf(fname, key=dl2_params_lstcam_key)
                 if "pulsar_phase" not in df_or:
-                    df_pulsar = pd.read_hdf(fname, key="phase_info")
+                    df_pulsar = read_phase_info(
+                        fname, columns=["mjd_barycenter_time", "pulsar_phase"]
+                    )
                     df_or["pulsar_phase"] = df_pulsar["pulsar_phase"]
                     df_or["mjd_time"] = df_pulsar["mjd_barycenter_time"]
 
@@ -268,7 +276,9 @@ class ReadLSTFile:
                 on_df_srcdep = get_srcdep_params(fname, "on")
 
                 if "pulsar_phase" not in srcindep_df:
-                    df_pulsar = pd.read_hdf(fname, key="phase_info")
+                    df_pulsar = read_phase_info(
+                        fname, columns=["mjd_barycenter_time", "pulsar_phase"]
+                    )
                     srcindep_df["pulsar_phase"] = df_pulsar["pulsar_phase"]
                     srcindep_df["mjd_time"] = df_pulsar["mjd_barycenter_time"]
 
@@ -0,0 +1,198 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pint.toa as toa
+from ptiming_ana.cphase.utils import create_toas, get_ephem_segments, get_timing_model
+from ptiming_ana.cphase.pulsarphase_cal import (
+    compute_phases_from_times_model,
+    get_toas_from_times,
+)
+from ptiming_ana.cphase.profiling import set_profiling, start_profile
+from ptiming_ana.cphase.phase_predictor import PhasePredictor
+from ptiming_ana.cphase.observatory_cache import ObservatoryCache
+from ptiming_ana.cphase.batch_phase_tagging import find_files
+
+PAR_FILE = "tests/files/crab_test.par"
+# Two lines of ephemeris with a limit at MJD 60010.16
+GRO_FILE = "tests/files/crab_test.gro"
+# No clock corrections that need downloading the clock files
+CLOCK = dict(include_bipm=False, include_gps=False)
+
+
+def random_times(n, mjd_start=60010.1, length=0.02, seed=1):
+    rng = np.random.default_rng(seed)
+    return (mjd_start + rng.random(n) * length).astype(np.longdouble)
+
+
+class CreateToasTest(unittest.TestCase):
+    def test_same_as_get_TOAs_array(self):
+        times = random_times(200)
+        model = get_timing_model(PAR_FILE)
+
+        exact = toa.get_TOAs_array(
+            times,
+            "lst",
+            errors=0,
+            ephem="DE421",
+            include_bipm=False,
+            include_gps=False,
+            planets=True,
+        )
+
+        t = create_toas(times, "lst")
+        t.apply_clock_corrections(include_gps=False, include_bipm=False)
+        t.compute_TDBs(ephem="DE421")
+        t.compute_posvels("DE421", True)
+        self.compare(t, exact, model)
+
+    def test_profiled_stages(self):
+        # The exact path builds the TOAs step by step, recording each step as a stage
+        times = random_times(200)
+        exact = toa.get_TOAs_array(
+            times,
+            "lst",
+            errors=0,
+            ephem="DE421",
+            include_bipm=False,
+            include_gps=False,
+            planets=True,
+        )
+
+        set_profiling(True)
+        try:
+            profile = start_profile()
+            t = get_toas_from_times(times, include_bipm=False, include_gps=False)
+        finally:
+            set_profiling(False)
+            start_profile()
+
+        for name in ["toas", "clock_corrections", "tdb", "posvels"]:
+            self.assertEqual(profile.stages[name]["events"], len(times))
+        self.compare(t, exact, get_timing_model(PAR_FILE))
+
+    def compare(self, t, exact, model):
+
+        for column in ["tdbld", "ssb_obs_pos", "ssb_obs_vel", "obs_sun_pos"]:
+            np.testing.assert_array_equal(
+                np.asarray(t.table[column]), np.asarray(exact.table[column])
+            )
+
+        phase = model.phase(t, abs_phase=True)
+        exact_phase = model.phase(exact, abs_phase=True)
+        np.testing.assert_array_equal(phase.int, exact_phase.int)
+        np.testing.assert_array_equal(phase.frac, exact_phase.frac)
+
+
+class ObservatoryCacheTest(unittest.TestCase):
+    def test_same_phases_as_exact_toas(self):
+        times = random_times(1000, mjd_start=60010.05, length=0.2)
+        model = get_timing_model(PAR_FILE)
+        kwargs = dict(include_bipm=False, include_gps=False)
+
+        cache = ObservatoryCache.compute(60010.0, 60010.3, **kwargs)
+        self.assertTrue(cache.covers(times))
+
+        exact = toa.get_TOAs_array(
+            times, "lst", errors=0, ephem="DE421", planets=True, **kwargs
+        )
+        phase = model.phase(cache.get_toas(times), abs_phase=True)
+        exact_phase = model.phase(exact, abs_phase=True)
+
+        diff = (phase.int - exact_phase.int) + (phase.frac - exact_phase.frac)
+        self.assertLess(np.max(np.abs(np.asarray(diff, dtype=float))), 2e-8)
+
+    def test_leap_second(self):
+        # Leap second at the end of 2016 (MJD 57753), on both limits of its day
+        for tstart, tstop in [(57753.9, 57754.1), (57752.95, 57753.05)]:
+            with self.assertRaisesRegex(ValueError, "leap second"):
+                ObservatoryCache.compute(
+                    tstart, tstop, include_bipm=False, include_gps=False
+                )
+
+
+class PhasePredictorTest(unittest.TestCase):
+    def compare(self, predictor, times, phase, barycent_toas):
+        predicted_phase, predicted_toas = predictor.evaluate(times)
+
+        # Differences of the fractional phases (wrapped). The residuals of the predictor are measured at the nodes of the fit only
+        diff = np.asarray(predicted_phase - phase, dtype=float)
+        diff -= np.round(diff)
+        self.assertLess(np.max(np.abs(diff)), 2 * predictor.max_residual)
+        self.assertLess(predictor.max_residual, 1e-6)
+
+        diff_toas = np.asarray(predicted_toas) - np.asarray(barycent_toas)
+        diff_toas = np.asarray(diff_toas, dtype=float) * 86400
+        self.assertLess(np.max(np.abs(diff_toas)), 1e-6)
+
+    def test_par_file(self):
+        times = random_times(500, mjd_start=60010.0, length=0.3)
+        predictor = PhasePredictor.from_ephem(
+            PAR_FILE, 60010.0, 60010.3, segment_length=30, **CLOCK
+        )
+        self.assertEqual(predictor.n_segments, 15)
+
+        barycent_toas, phase = compute_phases_from_times_model(
+            times, PAR_FILE, **CLOCK
+        )
+        self.compare(predictor, times, np.asarray(phase.frac), barycent_toas)
+
+        with self.assertRaises(ValueError):
+            predictor.evaluate(np.array([60010.4]))
+
+    def test_gro_boundary(self):
+        # Times on both sides of the limit between the lines of the ephemeris
+        times = np.concatenate(
+            [
+                random_times(300, mjd_start=60010.0, length=0.3),
+                60010.16 + np.linspace(-1, 1, 21) / 86400,
+            ]
+        ).astype(np.longdouble)
+        predictor = PhasePredictor.from_ephem(
+            GRO_FILE, 60010.0, 60010.3, segment_length=30, **CLOCK
+        )
+        self.assertIn(60010.16, predictor.edges)
+
+        segments = get_ephem_segments(times, GRO_FILE)
+        self.assertEqual(len(segments), 2)
+
+        phase = np.empty(len(times), dtype=np.longdouble)
+        barycent_toas = np.empty(len(times), dtype=np.longdouble)
+        for model, index in segments:
+            b, p = compute_phases_from_times_model(times[index], model, **CLOCK)
+            phase[index] = p.frac
+            barycent_toas[index] = b
+        self.compare(predictor, times, phase, barycent_toas)
+
+        # The result does not depend on the saved coefficients being reused
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "predictor.npz")
+            predictor.save(filename)
+            self.compare(PhasePredictor.read(filename), times, phase, barycent_toas)
+
+
+class FindFilesTest(unittest.TestCase):
+    def test_run_numbers(self):
+        names = [
+            "dl2_LST-1.Run02967.0000.h5",
+            "dl2_LST-1.Run02967.0001.h5",
+            "dl2_LST-1.Run12967.0000.h5",
+            "dl2_LST-1.Run29670.0000.h5",
+            "dl3_LST-1.Run2967.fits.gz",
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in names:
+                open(os.path.join(tmp_dir, name), "w").close()
+
+            files = find_files(directory=tmp_dir, runs="2967")
+            self.assertEqual(
+                [os.path.basename(f) for f in files],
+                [names[0], names[1], names[4]],
+            )
+
+            files = find_files(directory=tmp_dir, runs="02967,29670")
+            self.assertEqual(len(files), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+from types import SimpleNamespace
+import numpy as np
+from ptiming_ana.phaseogram import PulsarAnalysis, PhaseCube, PeriodicityTest
+
+
+def make_regions():
+    h = PulsarAnalysis()
+    h.setBackgroundLimits([0.52, 0.87])
+    h.setPeaklimits(P1_limits=[0, 0.026, 0.983, 1], P2_limits=[0.377, 0.422])
+    h.init_regions()
+    return h.regions
+
+
+class PhaseCubeTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        n = 5000
+        self.times = rng.uniform(0, 1000, n)
+        self.phases = rng.uniform(0, 1, n)
+        signal = rng.random(n) < 0.1
+        self.phases[signal] = rng.normal(0.4, 0.01, signal.sum())
+        # Phases exactly at the edges of the phase bins
+        self.phases[:21] = np.linspace(0, 1, 21)
+
+        self.energy_edges = np.array([0.1, 0.3, 1.0, 3.0])
+        self.energies = 10 ** rng.uniform(-1.5, 1, n)
+        self.energies[20:40] = self.energy_edges[rng.integers(0, 4, 20)]
+        self.energies[40:50] = np.nan
+
+        # Steps of the time evolution (number of events in time order)
+        sorted_times = np.sort(self.times)
+        self.steps = [(1000, sorted_times[1000]), (3000, sorted_times[3000])]
+        self.steps.append((4500, sorted_times[4500]))
+        self.exposure = [100, 300, 450]
+        self.phase_edges = np.linspace(0, 1, 21)
+
+        self.cube = PhaseCube.from_events(
+            self.phases,
+            self.times,
+            self.steps,
+            self.exposure,
+            self.phase_edges,
+            make_regions(),
+            energies=self.energies,
+            energy_edges=self.energy_edges,
+            n_harmonics=20,
+            chunk_size=700,
+        )
+
+    def select(self, i, integral=False, nevents=None):
+        # Same selection as the energy analysis with the events
+        if nevents is None:
+            nevents = self.steps[-1][0]
+        mask = self.times < np.sort(self.times)[nevents]
+        if integral:
+            return mask & (self.energies > self.energy_edges[i])
+        return (
+            mask
+            & (self.energies > self.energy_edges[i])
+            & (self.energies < self.energy_edges[i + 1])
+        )
+
+    def test_energy_classes(self):
+        energies = [0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0, 3.0, 5.0, np.nan]
+        classes = PhaseCube.get_energy_classes(energies, self.energy_edges)
+        np.testing.assert_array_equal(classes, np.arange(10))
+
+    def test_energy_slices(self):
+        for integral in [False, True]:
+            for i in range(len(self.energy_edges) - 1):
+                energy = self.cube.get_energy_slice(i, integral=integral)
+                selected = self.select(i, integral)
+                self.assertEqual(self.cube.sum(energy)["number"], selected.sum())
+
+        # All the events (also the ones without energy) if no energy bin is selected
+        self.assertEqual(self.cube.sum()["number"], self.steps[-1][0])
+        self.assertEqual(self.cube.number.sum(), len(self.phases))
+
+    def test_lightcurve(self):
+        for rebin in [1, 2, 5]:
+            lightcurve = self.cube.get_lightcurve(rebin=rebin)
+            counts, edges = np.histogram(
+                self.phases[self.times < self.steps[-1][1]],
+                bins=self.phase_edges[::rebin],
+            )
+            np.testing.assert_array_equal(lightcurve.lc[0], counts)
+            np.testing.assert_allclose(lightcurve.lc[1], edges)
+
+        with self.assertRaises(ValueError):
+            self.cube.get_lightcurve(rebin=3)
+
+    def test_stats(self):
+        for i in range(len(self.energy_edges) - 1):
+            energy = self.cube.get_energy_slice(i, integral=True)
+            for k, (nevents, _) in enumerate(self.steps):
+                phases = self.phases[self.select(i, True, nevents)]
+                histogram = self.cube.get_lightcurve(energy, slice(0, k + 1), 2)
+                np.testing.assert_array_equal(
+                    histogram.lc[0],
+                    np.histogram(phases, bins=self.phase_edges[::2])[0],
+                )
+
+                stats = self.cube.get_stats(energy, slice(0, k + 1), 2)
+                events = SimpleNamespace(phases=phases, histogram=histogram)
+                expected = PeriodicityTest(events, n_harmonics=20)
+                self.assertEqual(stats.number, expected.number)
+                np.testing.assert_allclose(stats.Htest_res, expected.Htest_res)
+                np.testing.assert_allclose(stats.Zntest_res, expected.Zntest_res)
+                np.testing.assert_allclose(stats.chisqr_res, expected.chisqr_res)
+
+    def test_cumulative(self):
+        energy = self.cube.get_energy_slice(1)
+        sums = self.cube.cumulative(energy)
+        regions = make_regions()
+        for k, (nevents, _) in enumerate(self.steps):
+            phases = self.phases[self.select(1, nevents=nevents)]
+            self.assertEqual(sums["number"][k], len(phases))
+            self.assertEqual(sums["regions"]["OFF"][k], regions.OFF.count(phases))
+            self.assertEqual(sums["regions"]["P1"][k], regions.P1.count(phases))
+            self.assertEqual(sums["regions"]["P2"][k], regions.P2.count(phases))
+
+            cos, sin = PeriodicityTest.trig_moments(phases, 20)
+            np.testing.assert_allclose(sums["cos"][k], cos, atol=1e-9)
+            np.testing.assert_allclose(sums["sin"][k], sin, atol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
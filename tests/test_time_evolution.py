@@ -0,0 +1,197 @@
+import unittest
+import numpy as np
+import pandas as pd
+from ptiming_ana.phaseogram import PulsarAnalysis, PulsarTimeAnalysis, PhaseCube
+
+VALUES = [
+    "t",
+    "HTime",
+    "ZTime",
+    "ChiTime",
+    "P1sTime",
+    "P1exTime",
+    "P1exerror",
+    "P2sTime",
+    "P2exTime",
+    "P2exerror",
+]
+
+
+def make_analysis(times, phases, tint):
+    h = PulsarAnalysis(tint=tint)
+    h.setBackgroundLimits([0.52, 0.87])
+    h.setPeaklimits(P1_limits=[0, 0.026, 0.983, 1], P2_limits=[0.377, 0.422])
+    h.setBinning(50, xmin=0, xmax=1)
+    h.telescope = "LST"
+    h.info = pd.DataFrame({"pulsar_phase": phases, "dragon_time": times})
+    h.phases = np.array(phases)
+    h.init_regions()
+    return h
+
+
+def run_per_step(pulsar_phases):
+    # Statistics recomputed from all the events of each step (as the time evolution was done before the running sums)
+    time_analysis = PulsarTimeAnalysis(tint=pulsar_phases.tint)
+    time_analysis.t = [0]
+    time_analysis.diff_del = 3600
+
+    dataframe = pulsar_phases.info
+    times = dataframe.dragon_time.values
+    diff = abs(times[1:] - times[:-1])
+    s = 0
+    for i in range(0, len(diff)):
+        if diff[i] < time_analysis.diff_del:
+            s = s + diff[i]
+            if s > time_analysis.tint:
+                partial = dataframe[dataframe["dragon_time"] < times[i + 1]]
+                time_analysis.update_tinfo(pulsar_phases, partial)
+                s = 0
+            elif i == (len(diff) - 1):
+                time_analysis.update_tinfo(pulsar_phases, dataframe)
+
+    return time_analysis
+
+
+class TimeEvolutionTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        # Three nights of one hour separated by gaps longer than diff_del
+        self.times = np.concatenate(
+            [
+                start + np.sort(rng.uniform(0, 3600, 4000))
+                for start in [0, 86400, 2 * 86400]
+            ]
+        )
+        self.phases = rng.uniform(0, 1, len(self.times))
+        signal = rng.random(len(self.times)) < 0.05
+        self.phases[signal] = rng.normal(0.4, 0.01, signal.sum())
+
+    def compare(self, times, phases, tint):
+        h = make_analysis(times, phases, tint)
+        h.TimeEv.run(h)
+
+        h_cube = make_analysis(times, phases, tint)
+        h_cube.TimeEv.run_cube(h_cube, PhaseCube.from_analysis(h_cube, chunk_size=3000))
+
+        h_ref = make_analysis(times, phases, tint)
+        reference = run_per_step(h_ref)
+
+        self.assertGreater(len(reference.t), 1)
+        for time_analysis in [h.TimeEv, h_cube.TimeEv]:
+            for name in VALUES:
+                np.testing.assert_allclose(
+                    getattr(time_analysis, name),
+                    getattr(reference, name),
+                    rtol=1e-9,
+                    err_msg=name,
+                )
+
+        # Final state: events of the last step
+        for analysis in [h, h_cube]:
+            np.testing.assert_array_equal(
+                np.sort(analysis.phases), np.sort(h_ref.phases)
+            )
+            np.testing.assert_array_equal(
+                analysis.histogram.lc[0], h_ref.histogram.lc[0]
+            )
+            self.assertEqual(analysis.regions.P1.number, h_ref.regions.P1.number)
+            self.assertEqual(len(analysis.regions.P1.phases), h_ref.regions.P1.number)
+
+        return h.TimeEv
+
+    def test_sorted_times(self):
+        time_analysis = self.compare(self.times, self.phases, 600)
+        self.assertEqual(len(time_analysis.t), 19)
+
+    def test_unsorted_times(self):
+        rng = np.random.default_rng(6)
+        order = np.arange(len(self.times))
+        # Some swapped neighbours and a whole night out of order
+        swap = rng.choice(len(order) - 1, 500, replace=False)
+        order[swap], order[swap + 1] = order[swap + 1], order[swap]
+        order = np.concatenate([order[8000:], order[:8000]])
+        self.compare(self.times[order], self.phases[order], 600)
+
+    def test_last_event(self):
+        # The time interval is only exceeded at the last event, so the last step excludes it
+        times = self.times[:4000]
+        diff = np.diff(times)
+        tint = diff.sum() - diff[-1] / 2
+        time_analysis = self.compare(times, self.phases[:4000], tint)
+        self.assertEqual(len(time_analysis.t), 2)
+
+
+class EnergyBinsTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.energy_edges = np.array([0.1, 0.3, 1.0, 3.0])
+        nights = [
+            start + np.sort(rng.uniform(0, 3600, 3000))
+            for start in [0, 86400, 2 * 86400]
+        ]
+        energies = [10 ** rng.uniform(-1.2, 0.8, 3000) for _ in nights]
+        # A fourth night with the events of the third bin only but one of the first bin, so the last step
+        # of the first bin leaves out the end of the third night. And an isolated event after a gap longer
+        # than diff_del, left out by the last step of all the events
+        nights.append(3 * 86400 + np.sort(rng.uniform(0, 3600, 2000)))
+        energies.append(rng.uniform(1.0, 3.0, 2000))
+        energies[-1][100] = 0.2
+        nights.append(np.array([3 * 86400 + 3 * 3600]))
+        energies.append(np.array([0.5]))
+
+        self.times = np.concatenate(nights)
+        self.energies = np.concatenate(energies)
+        self.energies[:20] = np.nan
+        self.phases = rng.uniform(0, 1, len(self.times))
+        signal = rng.random(len(self.times)) < 0.05
+        self.phases[signal] = rng.normal(0.4, 0.01, signal.sum())
+
+    def run_analysis(self, order, use_cube):
+        h = make_analysis(self.times[order], self.phases[order], 600)
+        h.info["energy"] = self.energies[order]
+        h.energy_units = "TeV"
+        h.setEnergybinning(self.energy_edges, do_diff=True, do_integral=True)
+        h.setPhaseCube(use_cube)
+        h.execute_stats(1.0)
+        h.EnergyAna.run(h)
+        return h.EnergyAna.Parray + h.EnergyAna.Parray_integral
+
+    def compare(self, order):
+        for analysis, reference in zip(
+            self.run_analysis(order, True), self.run_analysis(order, False)
+        ):
+            np.testing.assert_array_equal(
+                np.sort(analysis.phases), np.sort(reference.phases)
+            )
+            np.testing.assert_array_equal(
+                analysis.histogram.lc[0], reference.histogram.lc[0]
+            )
+            for name in ["Htest_res", "Zntest_res", "chisqr_res"]:
+                np.testing.assert_allclose(
+                    getattr(analysis.stats, name),
+                    getattr(reference.stats, name),
+                    rtol=1e-9,
+                    err_msg=name,
+                )
+            for name in ["P1", "P2", "P1+P2"]:
+                region = analysis.regions.dic[name]
+                expected = reference.regions.dic[name]
+                self.assertEqual(region.number, expected.number)
+                self.assertEqual(len(region.phases), expected.number)
+                self.assertAlmostEqual(region.sign, expected.sign, places=9)
+                self.assertAlmostEqual(region.sign_ratio, expected.sign_ratio, places=9)
+            self.assertEqual(analysis.regions.OFF.number, reference.regions.OFF.number)
+
+    def test_sorted_times(self):
+        self.compare(np.arange(len(self.times)))
+
+    def test_unsorted_times(self):
+        rng = np.random.default_rng(8)
+        order = np.arange(len(self.times))
+        swap = rng.choice(len(order) - 1, 500, replace=False)
+        order[swap], order[swap + 1] = order[swap + 1], order[swap]
+        self.compare(np.concatenate([order[3000:], order[:3000]]))
+
+
+if __name__ == "__main__":
+    unittest.main()